@@ -0,0 +1,43 @@
+"""Сколько входов в секунду выдерживает bcrypt: на одно ядро и на все ядра.
+
+    python bench.py              # cost из BCRYPT_ROUNDS ±2
+    python bench.py 10 12 14     # конкретные значения cost
+
+Проверка пароля при входе — один bcrypt.checkpw, поэтому checkpw/с ≈ входов/с
+(без учёта двух коротких обращений к БД, соединение на время bcrypt не держится)
+"""
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+
+PASSWORD = b'correct horse battery staple'
+MIN_SECONDS = 2.0
+
+
+def checks_per_sec(rounds, seconds=MIN_SECONDS):
+    hashed = bcrypt.hashpw(PASSWORD, bcrypt.gensalt(rounds))
+    n, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        bcrypt.checkpw(PASSWORD, hashed)
+        n += 1
+    return n / (time.perf_counter() - started)
+
+
+def main():
+    default = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+    rounds_list = [int(a) for a in sys.argv[1:]] or list(range(max(4, default - 2), default + 3))
+    cores = os.cpu_count() or 1
+    print(f"cores: {cores}")
+    print(f"{'cost':>4}  {'ms/check':>8}  {'logins/s/core':>13}  {'logins/s total':>14}")
+    for rounds in rounds_list:
+        single = checks_per_sec(rounds)
+        with ProcessPoolExecutor(max_workers=cores) as pool:
+            total = sum(pool.map(checks_per_sec, [rounds] * cores))
+        mark = '  <- BCRYPT_ROUNDS' if rounds == default else ''
+        print(f"{rounds:>4}  {1000 / single:>8.1f}  {single:>13.1f}  {total:>14.1f}{mark}")
+
+
+if __name__ == '__main__':
+    main()
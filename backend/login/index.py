@@ -1,9 +1,10 @@
+import hashlib
 import json
 import os
 import re
 import secrets
 import bcrypt
-import psycopg2
+import db
 
 CORS = {
     'Access-Control-Allow-Origin': '*',
@@ -11,32 +12,21 @@ CORS = {
     'Access-Control-Allow-Headers': 'Content-Type',
     'Access-Control-Max-Age': '86400',
 }
-
-def log_error(cur, schema, source, message, details=None, ip=None, user_id=None):
-    safe_msg = message.replace("'", "''")
-    safe_det = (details or '').replace("'", "''")
-    cur.execute(
-        f"INSERT INTO {schema}.error_logs (level, source, message, details, ip, user_id) "
-        f"VALUES ('warn', '{source}', '{safe_msg}', '{safe_det}', '{ip or ''}', {user_id or 'NULL'})"
-    )
-
-def check_rate_limit(cur, schema, key, limit=10, window_sec=60):
-    cur.execute(f"SELECT count, window_start FROM {schema}.rate_limits WHERE key = '{key}'")
-    row = cur.fetchone()
-    if row:
-        count, window_start = row
-        cur.execute(f"SELECT EXTRACT(EPOCH FROM (now() - '{window_start}'::timestamp))")
-        elapsed = cur.fetchone()[0]
-        if elapsed > window_sec:
-            cur.execute(f"UPDATE {schema}.rate_limits SET count = 1, window_start = now() WHERE key = '{key}'")
-            return False
-        if count >= limit:
-            return True
-        cur.execute(f"UPDATE {schema}.rate_limits SET count = count + 1 WHERE key = '{key}'")
-    else:
-        cur.execute(f"INSERT INTO {schema}.rate_limits (key, count, window_start) VALUES ('{key}', 1, now()) ON CONFLICT (key) DO UPDATE SET count = rate_limits.count + 1")
-    return False
-
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+
+def verify_password(password, password_hash):
+    """(верный ли пароль, новый хеш или None). Новый хеш — для старых SHA-256
+    и для bcrypt с cost, отличным от BCRYPT_ROUNDS"""
+    if password_hash.startswith('$2b$') or password_hash.startswith('$2a$'):
+        if not bcrypt.checkpw(password.encode(), password_hash.encode()):
+            return False, None
+        if int(password_hash[4:6]) == BCRYPT_ROUNDS:
+            return True, None
+    elif hashlib.sha256(password.encode()).hexdigest() != password_hash:
+        return False, None
+    return True, bcrypt.hashpw(password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+
+@db.pooled
 def handler(event: dict, context) -> dict:
     """Вход пользователя в Frikords (bcrypt, rate limit, логи)"""
 
@@ -53,69 +43,77 @@ def handler(event: dict, context) -> dict:
                 'body': json.dumps({'error': 'Введи email и пароль'})}
 
     schema = os.environ['MAIN_DB_SCHEMA']
-    safe_email = email.replace("'", "''")
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = db.getconn()
     cur = conn.cursor()
 
-    if check_rate_limit(cur, schema, f'login:{ip}', limit=10, window_sec=60):
-        log_error(cur, schema, 'login', 'Rate limit exceeded', ip=ip)
+    if db.rate_limit(cur, schema, f'login:{ip}', limit=10, window_sec=60):
+        db.log_event('warn', 'login', 'Rate limit exceeded', ip=ip)
+        db.flush_logs(cur, schema)
         conn.commit()
         cur.close()
-        conn.close()
+        db.putconn(conn)
         return {'statusCode': 429, 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Слишком много попыток. Подожди минуту.'})}
 
-    cur.execute(
+    db.query(
+        cur, 'login_user',
         f"SELECT id, username, password_hash, favorite_game, is_banned, is_admin "
-        f"FROM {schema}.users WHERE email = '{safe_email}'"
+        f"FROM {schema}.users WHERE email = %s",
+        (email,)
     )
     row = cur.fetchone()
 
     if not row:
-        log_error(cur, schema, 'login', 'Failed login attempt', details=safe_email, ip=ip)
+        db.log_event('warn', 'login', 'Failed login attempt', details=email, ip=ip)
+        db.flush_logs(cur, schema)
         conn.commit()
         cur.close()
-        conn.close()
+        db.putconn(conn)
         return {'statusCode': 401, 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Неверный email или пароль'})}
 
-    user_id, username, password_hash, favorite_game, is_banned, is_admin = row
+    # bcrypt занимает сотни миллисекунд — соединение на это время возвращаем в пул
+    conn.commit()
+    cur.close()
+    db.putconn(conn)
 
-    # Поддержка старых SHA-256 хешей + автомиграция на bcrypt
-    import hashlib
-    sha256_hash = hashlib.sha256(password.encode()).hexdigest()
-    is_bcrypt = password_hash.startswith('$2b$') or password_hash.startswith('$2a$')
+    user_id, username, password_hash, favorite_game, is_banned, is_admin = row
+    valid, new_hash = verify_password(password, password_hash)
 
-    if is_bcrypt:
-        valid = bcrypt.checkpw(password.encode(), password_hash.encode())
-    else:
-        valid = (sha256_hash == password_hash)
-        if valid:
-            # Мигрируем хеш на bcrypt — используем %s, bcrypt содержит спецсимволы
-            new_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
-            cur.execute(f"UPDATE {schema}.users SET password_hash=%s WHERE id={user_id}", (new_hash,))
+    conn = db.getconn()
+    cur = conn.cursor()
 
     if not valid:
-        log_error(cur, schema, 'login', 'Wrong password', ip=ip, user_id=user_id)
+        db.log_event('warn', 'login', 'Wrong password', ip=ip, user_id=user_id)
+        db.flush_logs(cur, schema)
         conn.commit()
         cur.close()
-        conn.close()
+        db.putconn(conn)
         return {'statusCode': 401, 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Неверный email или пароль'})}
 
+    if new_hash:
+        # Только если хеш не поменяли, пока мы считали
+        cur.execute(
+            f"UPDATE {schema}.users SET password_hash=%s WHERE id=%s AND password_hash=%s",
+            (new_hash, user_id, password_hash)
+        )
+
     if is_banned:
+        db.flush_logs(cur, schema)
         conn.commit()
         cur.close()
-        conn.close()
+        db.putconn(conn)
         return {'statusCode': 403, 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Аккаунт заблокирован'})}
 
     token = secrets.token_hex(32)
-    cur.execute(f"INSERT INTO {schema}.sessions (user_id, token) VALUES ({user_id}, '{token}')")
+    db.query(cur, 'create_session', f"INSERT INTO {schema}.sessions (user_id, token) VALUES (%s, %s)", (user_id, token))
+    db.flush_logs(cur, schema)
     conn.commit()
     cur.close()
-    conn.close()
+    db.putconn(conn)
 
     return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
@@ -0,0 +1,402 @@
+import functools
+import itertools
+import json
+import os
+import re
+import select
+import threading
+import time
+from collections import OrderedDict
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+# Общий модуль работы с БД. Функции деплоятся независимо, поэтому файл
+# скопирован в каждую backend/<функция>/db.py — правки вносить во все копии.
+
+POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+POOL_MAX_IDLE_SEC = float(os.environ.get('DB_POOL_MAX_IDLE_SEC', '300'))
+POOL_PING_AFTER_SEC = float(os.environ.get('DB_POOL_PING_AFTER_SEC', '10'))
+POOL_WAIT_SEC = float(os.environ.get('DB_POOL_WAIT_SEC', '5'))
+RATE_LOCAL_FACTOR = float(os.environ.get('RATE_LOCAL_FACTOR', '2'))
+RATE_LOCAL_MAX_KEYS = 10000
+LOG_FLUSH_SEC = float(os.environ.get('LOG_FLUSH_SEC', '5'))
+LOG_FLUSH_MAX = int(os.environ.get('LOG_FLUSH_MAX', '50'))
+LOG_BUFFER_MAX = int(os.environ.get('LOG_BUFFER_MAX', '500'))
+PREPARE = os.environ.get('DB_PREPARE', '1') != '0'
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+SLOW_TOP_QUERIES = 5
+SOURCE = os.path.basename(os.path.dirname(os.path.abspath(__file__)))  # имя функции: messages, login, ...
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+# Пул живёт между вызовами в «тёплом» контейнере
+_cond = threading.Condition()
+_idle = []  # [(conn, returned_at)], последний возвращённый — в конце
+_borrowed = 0
+_local = threading.local()
+
+
+def _close(conn):
+    _prepared.pop(conn, None)
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _alive(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def getconn():
+    global _borrowed
+    deadline = time.monotonic() + POOL_WAIT_SEC
+    with _cond:
+        while True:
+            now = time.monotonic()
+            stale = [c for c, t in _idle if now - t > POOL_MAX_IDLE_SEC]
+            _idle[:] = [(c, t) for c, t in _idle if now - t <= POOL_MAX_IDLE_SEC]
+            for c in stale:
+                _close(c)
+            if _idle or _borrowed < POOL_MAX:
+                break
+            if now >= deadline:
+                raise PoolExhausted(f'Все {POOL_MAX} соединения заняты')
+            _cond.wait(deadline - now)
+        entry = _idle.pop() if _idle else None
+        _borrowed += 1
+    try:
+        conn = None
+        if entry:
+            conn, returned_at = entry
+            # Пингуем только соединения, которые долго лежали без дела
+            if conn.closed or (time.monotonic() - returned_at > POOL_PING_AFTER_SEC and not _alive(conn)):
+                _close(conn)
+                conn = None
+        if conn is None:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=TimedCursor)
+    except Exception:
+        with _cond:
+            _borrowed -= 1
+            _cond.notify()
+        raise
+    held = getattr(_local, 'held', None)
+    if held is not None:
+        held.append(conn)
+    return conn
+
+
+def putconn(conn, discard=False):
+    global _borrowed
+    held = getattr(_local, 'held', None)
+    if held is not None and conn in held:
+        held.remove(conn)
+    if not discard and not conn.closed:
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            discard = True
+    if discard or conn.closed:
+        _close(conn)
+    with _cond:
+        _borrowed -= 1
+        if not discard and not conn.closed:
+            _idle.append((conn, time.monotonic()))
+        _cond.notify()
+
+
+def pooled(handler=None, slow_ms=SLOW_REQUEST_MS):
+    """Возвращает в пул соединения, которые обработчик не отдал (например, при исключении),
+    и добавляет к ответу Server-Timing. @pooled(slow_ms=...) — свой порог медленного вызова"""
+    if handler is None:
+        return functools.partial(pooled, slow_ms=slow_ms)
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        _local.held = []
+        _local.stats = {'db': 0.0, 'wait': 0.0, 'queries': []}
+        started = time.perf_counter()
+        try:
+            result = handler(*args, **kwargs)
+        finally:
+            for conn in list(_local.held):
+                putconn(conn, discard=True)
+            _local.held = None
+            stats, _local.stats = _local.stats, None
+        if _report(args[0] if args else {}, result, stats, (time.perf_counter() - started) * 1000, slow_ms):
+            _flush_now()
+        return result
+    return wrapper
+
+
+# ─── QUERIES ─────────────────────────────────────────────────
+# Именованные запросы: текст с %s готовится (PREPARE) один раз на соединение пула,
+# дальше — EXECUTE без повторного разбора и планирования. Значения передаются
+# параметрами, экранировать вручную ничего не нужно.
+# DB_PREPARE=0 — обычный параметризованный запрос (например, за pgbouncer в режиме transaction)
+
+_prepared = {}  # conn -> {имя: текст запроса}
+
+
+def _numbered(sql):
+    n = itertools.count(1)
+    return re.sub(r'%[s%]', lambda m: '%' if m.group() == '%%' else f'${next(n)}', sql)
+
+
+def query(cur, name, sql, args=()):
+    """Выполняет запрос name; текст — тот же для всех вызовов с этим именем"""
+    if not re.fullmatch(r'[a-z_][a-z0-9_]*', name):
+        raise ValueError(f'Недопустимое имя запроса: {name!r}')
+    if not PREPARE:
+        cur.execute(sql, args)
+        return cur
+    # Префикс — чтобы имя не совпало с ключевым словом SQL (session_user, user, ...)
+    name = f'q_{name}'
+    done = _prepared.setdefault(cur.connection, {})
+    if done.get(name) != sql:
+        if name in done:
+            cur.execute(f'DEALLOCATE {name}')
+            del done[name]
+        cur.execute(f'PREPARE {name} AS {_numbered(sql)}')
+        done[name] = sql
+    cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(args))})" if args else f'EXECUTE {name}', args)
+    return cur
+
+
+# ─── RATE LIMIT ──────────────────────────────────────────────
+# Token bucket: ёмкость limit, пополнение limit/window_sec в секунду.
+# Локальный фильтр с ёмкостью limit*RATE_LOCAL_FACTOR отсекает явный флуд без похода в БД
+
+_buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+
+def _local_allow(key, limit, window_sec):
+    cap = limit * RATE_LOCAL_FACTOR
+    now = time.monotonic()
+    tokens, ts = _buckets.pop(key, (cap, now))
+    tokens = min(cap, tokens + (now - ts) * limit / window_sec)
+    allowed = tokens >= 1
+    _buckets[key] = (tokens - 1 if allowed else tokens, now)
+    if len(_buckets) > RATE_LOCAL_MAX_KEYS:
+        _buckets.popitem(last=False)
+    return allowed
+
+
+def rate_limit(cur, schema, key, limit, window_sec):
+    """True — лимит превышен. Решение и запись — одним запросом"""
+    if not _local_allow(key, limit, window_sec):
+        return True
+    refill = (
+        "LEAST(%s::float8, COALESCE(r.tokens, %s::float8) "
+        "+ EXTRACT(EPOCH FROM now() - r.window_start)::float8 * %s::float8)"
+    )
+    bucket = (float(limit), float(limit), limit / window_sec)  # параметры refill, он встречается 4 раза
+    query(
+        cur, 'rate_limit',
+        f"INSERT INTO {schema}.rate_limits AS r (key, count, window_start, tokens, allowed) "
+        f"VALUES (%s, 1, now(), %s::float8, TRUE) "
+        f"ON CONFLICT (key) DO UPDATE SET "
+        f"allowed = {refill} >= 1, "
+        f"tokens = CASE WHEN {refill} >= 1 THEN {refill} - 1 ELSE {refill} END, "
+        f"count = r.count + 1, "
+        f"window_start = now() "
+        f"RETURNING allowed",
+        (key, float(limit) - 1, *bucket * 4)
+    )
+    return not cur.fetchone()[0]
+
+
+# ─── LOGS ────────────────────────────────────────────────────
+# События копятся в контейнере, одинаковые (level, source, message, ip, user_id)
+# схлопываются в одну строку с repeat_count. Сброс — одним многострочным INSERT,
+# когда буфер старше LOG_FLUSH_SEC или длиннее LOG_FLUSH_MAX
+
+_log_buf = OrderedDict()  # key -> [details, count, first_at]
+_log_state = {'since': None, 'dropped': 0, 'urgent': False}
+
+
+def log_event(level, source, message, details=None, ip=None, user_id=None, urgent=False):
+    """urgent=True — записать при ближайшем flush_logs (действия админов)"""
+    if urgent:
+        _log_state['urgent'] = True
+    key = (level, source, message, ip or '', user_id)
+    entry = _log_buf.get(key)
+    if entry:
+        entry[1] += 1
+        return
+    if len(_log_buf) >= LOG_BUFFER_MAX:
+        _log_state['dropped'] += 1
+        return
+    _log_buf[key] = [details or '', 1, time.monotonic()]
+    if _log_state['since'] is None:
+        _log_state['since'] = time.monotonic()
+
+
+def flush_logs(cur, schema, force=False):
+    if not _log_buf and not _log_state['dropped']:
+        return
+    age = time.monotonic() - (_log_state['since'] or time.monotonic())
+    if not (force or _log_state['urgent']) and age < LOG_FLUSH_SEC and len(_log_buf) < LOG_FLUSH_MAX:
+        return
+    now = time.monotonic()
+    # Время события — по часам БД: now() минус возраст записи в буфере
+    rows = [(level, source, message, details, ip, user_id, count, now - first_at)
+            for (level, source, message, ip, user_id), (details, count, first_at) in _log_buf.items()]
+    if _log_state['dropped']:
+        rows.append(('warn', 'logs', 'Log buffer overflow', '', '', None, _log_state['dropped'], 0))
+    _log_buf.clear()
+    _log_state.update(since=None, dropped=0, urgent=False)
+    psycopg2.extras.execute_values(
+        cur,
+        f"INSERT INTO {schema}.error_logs(level,source,message,details,ip,user_id,repeat_count,created_at) VALUES %s",
+        rows,
+        template="(%s,%s,%s,%s,%s,%s,%s,now() - make_interval(secs => %s))"
+    )
+
+
+# ─── NOTIFY ──────────────────────────────────────────────────
+# Изменения публикуются через pg_notify в канал схемы, тема — в payload
+# ('ch:general', 'room:5', 'dm:1:2'). Уходят при commit, вместе с данными.
+# Long-poll слушает канал на соединении самого запроса и держит его до wait секунд.
+# Бюджет: ждущих соединений на всю БД не больше slots (session advisory lock на слот) —
+# остальные запросы отвечают сразу, и клиент повторяет их как обычный опрос
+
+def events_channel(schema):
+    return f'{schema}_events'
+
+
+def notify(cur, schema, *topics):
+    cur.execute("SELECT pg_notify(%s, t) FROM unnest(%s::text[]) AS t", (events_channel(schema), list(set(topics))))
+
+
+def listen(conn, schema, slots):
+    """Фиксирует текущую транзакцию и переводит соединение в autocommit с LISTEN до unlisten.
+    False — все slots слотов заняты, ждать нельзя"""
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT s FROM generate_series(1, %s) s WHERE pg_try_advisory_lock(hashtext(%s), s) LIMIT 1",
+            (slots, events_channel(schema))
+        )
+        if not cur.fetchone():
+            conn.autocommit = False
+            return False
+        cur.execute(f'LISTEN "{events_channel(schema)}"')
+    return True
+
+
+def wait_notify(conn, topics, timeout):
+    """True — пришло событие по одной из тем, False — вышло время"""
+    started = time.monotonic()
+    try:
+        while True:
+            conn.poll()
+            while conn.notifies:
+                if conn.notifies.pop(0).payload in topics:
+                    return True
+            remaining = started + timeout - time.monotonic()
+            if remaining <= 0:
+                return False
+            select.select([conn], [], [], remaining)
+    finally:
+        stats = getattr(_local, 'stats', None)
+        if stats is not None:
+            stats['wait'] += (time.monotonic() - started) * 1000
+
+
+def unlisten(conn):
+    """Обратно к транзакциям; при ошибке соединение выбросит pooled"""
+    with conn.cursor() as cur:
+        cur.execute('UNLISTEN *')
+        cur.execute('SELECT pg_advisory_unlock_all()')
+    conn.notifies.clear()
+    conn.autocommit = False
+
+
+# ─── TIMING ──────────────────────────────────────────────────
+# Курсоры пула считают запросы и время в БД текущего вызова. pooled пишет в ответ
+# Server-Timing (db, wait — long-poll, app — остальное), а вызовы дольше порога
+# (SLOW_REQUEST_MS, без ожидания long-poll) сразу пишет в error_logs с source='slow'
+# и самыми дорогими запросами
+
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            stats['db'] += ms
+            stats['queries'].append((query, ms))
+
+
+def _top_queries(queries):
+    """Запросы, сгруппированные по тексту без литералов, — самые долгие сверху"""
+    agg = {}
+    for query, ms in queries:
+        text = query.decode(errors='replace') if isinstance(query, bytes) else str(query)
+        key = re.sub(r"'(?:[^']|'')*'|\b\d+\b", '?', ' '.join(text.split()))[:200]
+        entry = agg.setdefault(key, [0, 0.0])
+        entry[0] += 1
+        entry[1] += ms
+    top = sorted(agg.items(), key=lambda kv: -kv[1][1])[:SLOW_TOP_QUERIES]
+    return [{'sql': sql, 'calls': calls, 'ms': round(ms, 1)} for sql, (calls, ms) in top]
+
+
+def _report(event, result, stats, total_ms, slow_ms):
+    """True — вызов медленный, запись добавлена в буфер логов"""
+    db_ms, wait_ms = stats['db'], stats['wait']
+    app_ms = max(total_ms - db_ms - wait_ms, 0.0)
+    count = len(stats['queries'])
+    if isinstance(result, dict):
+        # Копия: обработчики отдают общие на модуль словари заголовков
+        headers = result['headers'] = dict(result.get('headers') or {})
+        timing = f'db;dur={db_ms:.1f};desc="{count} queries"'
+        if wait_ms:
+            timing += f', wait;dur={wait_ms:.1f}'
+        headers['Server-Timing'] = f'{timing}, app;dur={app_ms:.1f}'
+        headers['Timing-Allow-Origin'] = '*'
+        expose = headers.get('Access-Control-Expose-Headers')
+        headers['Access-Control-Expose-Headers'] = f'{expose}, Server-Timing' if expose else 'Server-Timing'
+    if total_ms - wait_ms < slow_ms:
+        return False
+    event = event if isinstance(event, dict) else {}
+    action = (event.get('queryStringParameters') or {}).get('action') or event.get('httpMethod') or 'timer'
+    ip = (event.get('requestContext') or {}).get('identity', {}).get('sourceIp')
+    details = {'ms': round(total_ms - wait_ms, 1), 'db_ms': round(db_ms, 1), 'app_ms': round(app_ms, 1),
+               'queries': count, 'top': _top_queries(stats['queries'])}
+    log_event('warn', 'slow', f'{SOURCE} {action[:64]}', details=json.dumps(details, ensure_ascii=False), ip=ip)
+    return True
+
+
+def _flush_now():
+    """Сброс буфера логов на своём соединении: обработчик своё уже вернул в пул"""
+    try:
+        conn = getconn()
+    except Exception as e:
+        print(f'flush_logs: {e}')
+        return
+    try:
+        with conn.cursor() as cur:
+            flush_logs(cur, os.environ['MAIN_DB_SCHEMA'], force=True)
+        conn.commit()
+    except Exception as e:
+        print(f'flush_logs: {e}')
+        putconn(conn, discard=True)
+        return
+    putconn(conn)
@@ -0,0 +1,200 @@
+import json
+import os
+import time
+import boto3
+import db
+
+CH = {'Access-Control-Allow-Origin': '*'}
+BATCH_SIZE = int(os.environ.get('MAINTENANCE_BATCH', '1000'))
+BUDGET_SEC = float(os.environ.get('MAINTENANCE_BUDGET_SEC', '20'))
+SLOW_RUN_MS = (BUDGET_SEC + 5) * 1000  # запуск по задумке длится секунды; медленный — вышедший за бюджет
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'files')
+IMAGE_GC_GRACE = '1 day'  # пауза после последнего использования, прежде чем удалить файл
+UPLOAD_EXPIRE = '15 minutes'  # больше 2×UPLOAD_URL_TTL_SEC из messages: такую загрузку уже не подтвердить
+SESSION_MAX_AGE_SEC = 30 * 24 * 3600  # совпадает с кэшем сессий в messages
+
+# Каждая задача удаляет не больше BATCH_SIZE строк за запрос и возвращает их число.
+# SKIP LOCKED — чтобы очистка не ждала строк, занятых пользовательскими запросами
+JOBS = {
+    'error_logs': (
+        "WITH d AS (DELETE FROM {s}.error_logs WHERE id IN ("
+        "SELECT id FROM {s}.error_logs WHERE created_at < now() - interval '7 days' LIMIT %s FOR UPDATE SKIP LOCKED"
+        ") RETURNING 1) SELECT COUNT(*) FROM d"
+    ),
+    'rate_limits': (
+        "WITH d AS (DELETE FROM {s}.rate_limits WHERE key IN ("
+        "SELECT key FROM {s}.rate_limits WHERE window_start < now() - interval '1 day' LIMIT %s FOR UPDATE SKIP LOCKED"
+        ") RETURNING 1) SELECT COUNT(*) FROM d"
+    ),
+    'sessions': (
+        "WITH d AS (DELETE FROM {s}.sessions WHERE id IN ("
+        "SELECT id FROM {s}.sessions WHERE created_at < now() - interval '" + str(SESSION_MAX_AGE_SEC) + " seconds' LIMIT %s FOR UPDATE SKIP LOCKED"
+        ") RETURNING 1) SELECT COUNT(*) FROM d"
+    ),
+    'removed_messages': (
+        "WITH d AS (DELETE FROM {s}.messages WHERE id IN ("
+        "SELECT id FROM {s}.messages WHERE is_removed=TRUE AND created_at < now() - interval '90 days' LIMIT %s FOR UPDATE SKIP LOCKED"
+        ") RETURNING id, image_hash), "
+        "r AS (DELETE FROM {s}.message_reactions WHERE message_id IN (SELECT id FROM d)), "
+        "c AS (DELETE FROM {s}.message_reaction_counts WHERE message_id IN (SELECT id FROM d)), "
+        "i AS (UPDATE {s}.image_objects o SET ref_count=o.ref_count-x.n, touched_at=now() "
+        "FROM (SELECT image_hash, COUNT(*) AS n FROM d WHERE image_hash IS NOT NULL GROUP BY image_hash) x "
+        "WHERE o.hash=x.image_hash) "
+        "SELECT COUNT(*) FROM d"
+    ),
+}
+
+# Пересчёт снимков: один запрос, выполняется после очистки
+REFRESHES = {
+    'stats': (
+        "INSERT INTO {s}.stats_snapshot (id, data, refreshed_at) "
+        "SELECT 1, json_build_object("
+        "'total_users', (SELECT COUNT(*) FROM {s}.users), "
+        "'banned_users', (SELECT COUNT(*) FROM {s}.users WHERE is_banned=TRUE), "
+        "'total_messages', (SELECT COUNT(*) FROM {s}.messages), "
+        "'total_rooms', (SELECT COUNT(*) FROM {s}.rooms), "
+        "'errors_24h', (SELECT COALESCE(SUM(repeat_count), 0) FROM {s}.error_logs WHERE created_at > now()-interval '24 hours'), "
+        "'new_users_24h', (SELECT COUNT(*) FROM {s}.users WHERE created_at > now()-interval '24 hours'), "
+        "'messages_24h', (SELECT COUNT(*) FROM {s}.messages WHERE created_at > now()-interval '24 hours'), "
+        "'db_size', pg_size_pretty(t.bytes), 'db_bytes', t.bytes"
+        ")::jsonb, now() "
+        "FROM (SELECT COALESCE(SUM(pg_total_relation_size(quote_ident(schemaname)||'.'||quote_ident(tablename))), 0)::bigint AS bytes "
+        "FROM pg_tables WHERE schemaname = %s) t "
+        "ON CONFLICT (id) DO UPDATE SET data=EXCLUDED.data, refreshed_at=EXCLUDED.refreshed_at"
+    ),
+}
+
+
+def s3_client():
+    return boto3.client('s3', endpoint_url=S3_ENDPOINT_URL,
+                        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+
+
+def delete_keys(s3, keys):
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True})
+
+
+def run_refresh(conn, schema, name, deadline):
+    if time.monotonic() >= deadline:
+        return {'done': False}
+    started = time.monotonic()
+    with conn.cursor() as cur:
+        cur.execute(REFRESHES[name].format(s=schema), (schema,))
+    conn.commit()
+    ms = int((time.monotonic() - started) * 1000)
+    print(f"maintenance {name}: refreshed in {ms} ms")
+    return {'done': True, 'ms': ms}
+
+
+def run_image_gc(conn, schema, name, deadline):
+    """Удаляет из хранилища изображения, на которые больше никто не ссылается"""
+    s3 = None
+    deleted, batches = 0, 0
+    while time.monotonic() < deadline:
+        with conn.cursor() as cur:
+            # Строки держатся под блокировкой, пока удаляются объекты, и удаляются после них:
+            # повторная загрузка того же файла (find_image / save_image) ждёт commit и создаёт
+            # объект и строку заново, уже после удаления старых. Условие перепроверяется
+            # на свежей версии строки — файл, который успели переиспользовать, не трогаем
+            cur.execute(
+                f"SELECT hash, key, variants FROM {schema}.image_objects "
+                f"WHERE ref_count <= 0 AND touched_at < now() - interval '{IMAGE_GC_GRACE}' "
+                f"LIMIT %s FOR UPDATE SKIP LOCKED",
+                (BATCH_SIZE,)
+            )
+            rows = cur.fetchall()
+            # Вместе с оригиналом удаляются его WebP-копии из backend/thumbnails
+            keys = [k for _, key, variants in rows
+                    for k in [key, *(f"{key.rsplit('.', 1)[0]}_{v}.webp" for v in (variants or {}))]]
+            if keys:
+                s3 = s3 or s3_client()
+                delete_keys(s3, keys)
+                cur.execute(f"DELETE FROM {schema}.image_objects WHERE hash = ANY(%s)", ([r[0] for r in rows],))
+        conn.commit()
+        deleted += len(rows)
+        batches += 1
+        print(f"maintenance {name}: batch {batches}, deleted {len(rows)} (total {deleted})")
+        if len(rows) < BATCH_SIZE:
+            return {'deleted': deleted, 'batches': batches, 'done': True}
+    return {'deleted': deleted, 'batches': batches, 'done': False}
+
+
+def run_upload_gc(conn, schema, name, deadline):
+    """Удаляет записи presigned-загрузок, которые уже нельзя подтвердить, и их файлы в uploads/.
+    Подтверждённая загрузка свой файл уже перенесла; брошенная или отклонённая — оставила"""
+    s3 = None
+    deleted, batches = 0, 0
+    while time.monotonic() < deadline:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT id, key FROM {schema}.uploads WHERE created_at < now() - interval '{UPLOAD_EXPIRE}' "
+                f"LIMIT %s FOR UPDATE SKIP LOCKED",
+                (BATCH_SIZE,)
+            )
+            rows = cur.fetchall()
+            # Старые записи указывали прямо на адрес содержимого — такие файлы не трогаем
+            keys = [key for _, key in rows if key.startswith('uploads/')]
+            if keys:
+                s3 = s3 or s3_client()
+                delete_keys(s3, keys)
+            if rows:
+                cur.execute(f"DELETE FROM {schema}.uploads WHERE id = ANY(%s)", ([r[0] for r in rows],))
+        conn.commit()
+        deleted += len(rows)
+        batches += 1
+        print(f"maintenance {name}: batch {batches}, deleted {len(rows)} (total {deleted})")
+        if len(rows) < BATCH_SIZE:
+            return {'deleted': deleted, 'batches': batches, 'done': True}
+    return {'deleted': deleted, 'batches': batches, 'done': False}
+
+
+def run_job(conn, schema, name, deadline):
+    sql = JOBS[name].format(s=schema)
+    deleted, batches = 0, 0
+    while time.monotonic() < deadline:
+        with conn.cursor() as cur:
+            cur.execute(sql, (BATCH_SIZE,))
+            n = cur.fetchone()[0]
+        conn.commit()
+        deleted += n
+        batches += 1
+        print(f"maintenance {name}: batch {batches}, deleted {n} (total {deleted})")
+        if n < BATCH_SIZE:
+            return {'deleted': deleted, 'batches': batches, 'done': True}
+    return {'deleted': deleted, 'batches': batches, 'done': False}
+
+
+# Порядок выполнения: очистка, затем сборка файлов (после снятия ссылок удалёнными сообщениями), затем снимки
+RUNNERS = {**{n: run_job for n in JOBS}, 'image_gc': run_image_gc, 'uploads': run_upload_gc, **{n: run_refresh for n in REFRESHES}}
+
+
+@db.pooled(slow_ms=SLOW_RUN_MS)
+def handler(event: dict, context) -> dict:
+    """Плановое обслуживание БД пакетами: логи, лимиты, сессии, удалённые сообщения, файлы без ссылок, брошенные загрузки, снимок статистики. Запуск по таймеру"""
+
+    # HTTP-вызов разрешён только с токеном; вызов по расписанию приходит без httpMethod
+    if event.get('httpMethod'):
+        if event.get('httpMethod') == 'OPTIONS':
+            return {'statusCode': 200, 'headers': {**CH, 'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                    'Access-Control-Allow-Headers': 'Content-Type, X-Maintenance-Token'}, 'body': ''}
+        expected = os.environ.get('MAINTENANCE_TOKEN', '')
+        got = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == 'x-maintenance-token'), '')
+        if not expected or got != expected:
+            return {'statusCode': 403, 'headers': CH, 'body': json.dumps({'error': 'Доступ запрещён'})}
+
+    params = event.get('queryStringParameters') or {}
+    names = [n for n in (params.get('jobs') or ','.join(RUNNERS)).split(',') if n in RUNNERS]
+    schema = os.environ['MAIN_DB_SCHEMA']
+    deadline = time.monotonic() + BUDGET_SEC
+
+    conn = db.getconn()
+    report = {}
+    for name in names:
+        report[name] = RUNNERS[name](conn, schema, name, deadline)
+    db.putconn(conn)
+
+    return {'statusCode': 200, 'headers': CH,
+            'body': json.dumps({'ok': True, 'done': all(r['done'] for r in report.values()), 'jobs': report})}
@@ -0,0 +1,62 @@
+"""Цена холодного старта по действиям: импорт index.py и модулей, которые действие подгружает само.
+
+    python bench_imports.py                      # все действия
+    python bench_imports.py messages upload_url  # выбранные
+
+Каждый замер — новый процесс интерпретатора, как в холодном контейнере; из REPEAT
+запусков берётся медиана. Отложенные импорты действия находятся по байткоду обработчика
+"""
+import dis
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import index
+
+REPEAT = 5
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import index
+t1 = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+t2 = time.perf_counter()
+print(json.dumps({'index': (t1 - t0) * 1000, 'lazy': (t2 - t1) * 1000, 'boto3': 'boto3' in sys.modules}))
+"""
+
+
+def lazy_imports(fn):
+    return sorted({i.argval for i in dis.get_instructions(fn) if i.opname == 'IMPORT_NAME'})
+
+
+def actions():
+    out = {f'{a} GET': [] for a in index.READ_ACTIONS}
+    for (action, method), fn in index.ROUTES.items():
+        out[f'{action} {method}'] = lazy_imports(fn)
+    return out
+
+
+def probe(modules):
+    runs = []
+    for _ in range(REPEAT):
+        res = subprocess.run([sys.executable, '-c', PROBE, *modules], cwd=HERE, capture_output=True, text=True, check=True)
+        runs.append(json.loads(res.stdout))
+    return (statistics.median(r['index'] for r in runs), statistics.median(r['lazy'] for r in runs), runs[0]['boto3'])
+
+
+def main():
+    wanted = sys.argv[1:]
+    table = {k: v for k, v in actions().items() if not wanted or k.split()[0] in wanted}
+    print(f"{'action':<24} {'index ms':>9} {'lazy ms':>8} {'total ms':>9}  boto3  lazy modules")
+    for name, modules in table.items():
+        index_ms, lazy_ms, boto = probe(modules)
+        print(f"{name:<24} {index_ms:>9.1f} {lazy_ms:>8.1f} {index_ms + lazy_ms:>9.1f}  {'yes' if boto else 'no':<5}  {', '.join(modules) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,50 @@
 import base64
+import hashlib
 import json
 import os
 import re
 import time
-import random
 # v4
 import secrets
-import boto3
-import psycopg2
+from collections import OrderedDict
+import db
 
 CORS_H = {
     'Access-Control-Allow-Origin': '*',
     'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-    'Access-Control-Allow-Headers': 'Content-Type, X-Authorization',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Authorization, If-None-Match',
     'Access-Control-Max-Age': '86400',
 }
-CH = {'Access-Control-Allow-Origin': '*'}
+CH = {'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'}
+ONLINE_TAG_SEC = 15
+ONLINE_WINDOW_SEC = 120
+ONLINE_LIST_LIMIT = 50
 VALID_CHANNELS = {'general', 'meet', 'memes', 'teammates'}
 VALID_EMOJI = {'👍', '❤️', '😂', '😮', '😢', '🔥', '👎', '🎮'}
+PAGE_SIZE = 100
+# rev берётся из последовательности до commit и становится виден не по порядку:
+# дельта перечитывает столько значений ниже курсора (общих на все каналы — обычно 0–2 строки)
+CURSOR_OVERLAP = 10
+SESSION_CACHE_TTL_SEC = float(os.environ.get('SESSION_CACHE_TTL_SEC', '30'))
+SESSION_CACHE_MAX = int(os.environ.get('SESSION_CACHE_MAX', '5000'))
+SESSION_MAX_AGE_SEC = 30 * 24 * 3600  # сессии старше удаляет backend/maintenance
+FRIENDS_CACHE_TTL_SEC = float(os.environ.get('FRIENDS_CACHE_TTL_SEC', '30'))
+FRIENDS_CACHE_MAX = 5000
+PRESENCE_WRITE_SEC = int(os.environ.get('PRESENCE_WRITE_SEC', '45'))
+UNREAD_CAP = 100
+STATS_CACHE_SEC = 30
+LONG_POLL_MAX_SEC = 20
+# Сколько long-poll могут одновременно держать соединение Postgres (на всю БД, не на контейнер).
+# Должно оставлять запас до max_connections под обычные запросы всех функций
+LONG_POLL_MAX_WAITERS = int(os.environ.get('LONG_POLL_MAX_WAITERS', '20'))
+LONG_POLL_BUSY_RETRY_SEC = 5  # без свободного слота клиент опрашивает с такой паузой
+BATCH_MAX = 10
+UPLOAD_URL_TTL_SEC = 300
+# kind -> (папка, лимит байт, допустимые типы)
+UPLOAD_KINDS = {
+    'image': ('chat_images', 8 * 1024 * 1024, {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp', 'image/gif': 'gif'}),
+    'avatar': ('avatars', 2 * 1024 * 1024, {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp'}),
+}
 
 def sanitize(v: str) -> str:
     v = re.sub(r'<[^>]*>', '', v)
@@ -25,716 +52,1259 @@ def sanitize(v: str) -> str:
     v = re.sub(r'[;&]', '', v)
     return v.strip()
 
-def log(cur, schema, source, msg, level='info', details=None, ip=None, user_id=None):
-    m = msg.replace("'", "''")
-    d = (details or '').replace("'", "''")
-    uid = user_id or 'NULL'
-    cur.execute(f"INSERT INTO {schema}.error_logs(level,source,message,details,ip,user_id) VALUES('{level}','{source}','{m}','{d}','{ip or ''}',{uid})")
-
-def rate_limit(cur, schema, key, limit, window_sec):
-    cur.execute(f"SELECT count, window_start FROM {schema}.rate_limits WHERE key='{key}'")
-    row = cur.fetchone()
-    if row:
-        count, ws = row
-        cur.execute(f"SELECT EXTRACT(EPOCH FROM (now()-'{ws}'::timestamp))")
-        elapsed = cur.fetchone()[0]
-        if elapsed > window_sec:
-            cur.execute(f"UPDATE {schema}.rate_limits SET count=1,window_start=now() WHERE key='{key}'")
-            return False
-        if count >= limit:
-            return True
-        cur.execute(f"UPDATE {schema}.rate_limits SET count=count+1 WHERE key='{key}'")
-    else:
-        cur.execute(f"INSERT INTO {schema}.rate_limits(key,count,window_start) VALUES('{key}',1,now()) ON CONFLICT(key) DO UPDATE SET count=rate_limits.count+1")
-    return False
+# Кэш токен → пользователь между вызовами тёплого контейнера (TTL + LRU).
+# Запись живёт не дольше SESSION_CACHE_TTL_SEC и не дольше самой сессии
+_sessions = OrderedDict()
+_session_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
 
 def get_user(cur, schema, token, require_admin=False):
     if not token:
         return None
-    safe = token.replace("'", "''")
-    af = "AND u.is_admin=TRUE" if require_admin else ""
-    cur.execute(f"SELECT u.id,u.username,u.favorite_game,u.is_banned,u.is_admin FROM {schema}.sessions s JOIN {schema}.users u ON u.id=s.user_id WHERE s.token='{safe}' AND u.is_banned=FALSE {af}")
-    return cur.fetchone()
-
-def s3_client():
-    return boto3.client('s3', endpoint_url='https://bucket.poehali.dev',
-        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
-
-def get_reactions(cur, schema, message_ids):
-    if not message_ids:
-        return {}
-    ids_str = ','.join(str(i) for i in message_ids)
+    now = time.time()
+    entry = _sessions.get(token)
+    if entry and entry[1] > now:
+        _sessions.move_to_end(token)
+        _session_stats['hits'] += 1
+        user = entry[0]
+    else:
+        _session_stats['misses'] += 1
+        _sessions.pop(token, None)
+        db.query(
+            cur, 'get_session_user',
+            f"SELECT u.id,u.username,u.favorite_game,u.is_banned,u.is_admin,u.avatar_url,u.badge,"
+            f"EXTRACT(EPOCH FROM now()-s.created_at) "
+            f"FROM {schema}.sessions s JOIN {schema}.users u ON u.id=s.user_id WHERE s.token=%s AND u.is_banned=FALSE",
+            (token,)
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        user, age = tuple(row[:7]), float(row[7] or 0)
+        _sessions[token] = (user, now + min(SESSION_CACHE_TTL_SEC, SESSION_MAX_AGE_SEC - age))
+        if len(_sessions) > SESSION_CACHE_MAX:
+            _sessions.popitem(last=False)
+            _session_stats['evictions'] += 1
+    if require_admin and not user[4]:
+        return None
+    return user
+
+def invalidate_user(uid):
+    for tok in [t for t, (u, _) in _sessions.items() if u[0] == uid]:
+        del _sessions[tok]
+        _session_stats['invalidations'] += 1
+
+def session_cache_stats():
+    total = _session_stats['hits'] + _session_stats['misses']
+    return {**_session_stats, 'size': len(_sessions), 'hit_rate': round(_session_stats['hits'] / total, 3) if total else 0}
+
+# Друзья пользователя (id без забаненных) кэшируются в контейнере на FRIENDS_CACHE_TTL_SEC.
+# Запись годна, пока не сдвинулись счётчики friends:{uid} и bans — их поднимает любой контейнер
+_friends = OrderedDict()  # uid -> (frozenset ids, версия, expires_at)
+
+def friend_version(cur, schema, uid):
+    return tuple(versions(cur, schema, f'friends:{uid}', 'bans'))
+
+def friend_ids(cur, schema, uid, version=None):
+    now = time.time()
+    version = version or friend_version(cur, schema, uid)
+    entry = _friends.get(uid)
+    if entry and entry[1] == version and entry[2] > now:
+        _friends.move_to_end(uid)
+        return entry[0]
     cur.execute(
-        f"SELECT message_id, emoji, COUNT(*) as cnt, "
-        f"array_agg(user_id) as user_ids "
-        f"FROM {schema}.message_reactions "
-        f"WHERE message_id IN ({ids_str}) AND is_active=TRUE "
-        f"GROUP BY message_id, emoji"
+        f"SELECT f.id FROM (SELECT user_hi AS id FROM {schema}.friendships WHERE user_lo={uid} "
+        f"UNION ALL SELECT user_lo FROM {schema}.friendships WHERE user_hi={uid}) f "
+        f"JOIN {schema}.users u ON u.id=f.id WHERE u.is_banned=FALSE"
+    )
+    ids = frozenset(r[0] for r in cur.fetchall())
+    _friends[uid] = (ids, version, now + FRIENDS_CACHE_TTL_SEC)
+    if len(_friends) > FRIENDS_CACHE_MAX:
+        _friends.popitem(last=False)
+    return ids
+
+def is_friend(cur, schema, uid, other_id):
+    return other_id in friend_ids(cur, schema, uid)
+
+def invalidate_friends(*uids):
+    """Сбросить кэш этих пользователей и всех, у кого они в друзьях"""
+    drop = set(uids)
+    for u in [u for u, (ids, *_) in _friends.items() if u in drop or not drop.isdisjoint(ids)]:
+        del _friends[u]
+
+# Heartbeat пишется не чаще раза в PRESENCE_WRITE_SEC: локально по контейнеру
+# и ещё раз в SQL — на случай, если пользователя обслуживают разные контейнеры
+_presence_written = {}
+
+def touch_presence(cur, schema, uid):
+    now = time.monotonic()
+    if now - _presence_written.get(uid, -PRESENCE_WRITE_SEC) < PRESENCE_WRITE_SEC:
+        return
+    if len(_presence_written) > 50000:
+        _presence_written.clear()
+    _presence_written[uid] = now
+    db.query(
+        cur, 'touch_presence',
+        f"INSERT INTO {schema}.presence(user_id,last_seen) VALUES(%s,now()) "
+        f"ON CONFLICT(user_id) DO UPDATE SET last_seen=now() "
+        f"WHERE presence.last_seen < now() - interval '{PRESENCE_WRITE_SEC} seconds'",
+        (uid,)
     )
-    result = {}
-    for row in cur.fetchall():
-        mid, emoji, cnt, uids = row
-        if mid not in result:
-            result[mid] = []
-        result[mid].append({'emoji': emoji, 'count': cnt, 'users': uids or []})
-    return result
-
-def cleanup(cur, schema):
-    cur.execute(f"DELETE FROM {schema}.error_logs WHERE created_at < now() - interval '7 days'")
-    cur.execute(f"DELETE FROM {schema}.rate_limits WHERE window_start < now() - interval '1 day'")
-    cur.execute(f"DELETE FROM {schema}.sessions WHERE created_at < now() - interval '30 days'")
-    cur.execute(f"DELETE FROM {schema}.messages WHERE is_removed=TRUE AND created_at < now() - interval '90 days'")
-
-def handler(event: dict, context) -> dict:
-    """Единый API: сообщения, реакции, удаление, комнаты, инвайты, друзья, DM, настройки. ?action="""
-
-    if event.get('httpMethod') == 'OPTIONS':
-        return {'statusCode': 200, 'headers': CORS_H, 'body': ''}
 
-    method = event.get('httpMethod', 'GET')
-    params = event.get('queryStringParameters') or {}
-    action = params.get('action', 'messages')
-    ip = (event.get('requestContext') or {}).get('identity', {}).get('sourceIp', 'unknown')
-    token = (event.get('headers') or {}).get('X-Authorization', '').replace('Bearer ', '').strip()
-    schema = os.environ['MAIN_DB_SCHEMA']
-    body = json.loads(event.get('body') or '{}')
-
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
-
-    if random.random() < 0.02:
-        cleanup(cur, os.environ['MAIN_DB_SCHEMA'])
-
-    def resp(code, data):
-        conn.commit(); cur.close(); conn.close()
-        return {'statusCode': code, 'headers': CH, 'body': json.dumps(data, default=str)}
-
-    def err(code, msg):
-        return resp(code, {'error': msg})
-
-    # ─── MESSAGES ────────────────────────────────────────────
-
-    if action == 'messages':
-        if method == 'GET':
-            channel = params.get('channel', 'general')
-            room_id_str = params.get('room_id', '')
-            if room_id_str and str(room_id_str).isdigit():
-                room_id = int(room_id_str)
-                user = get_user(cur, schema, token)
-                if not user: return err(401, 'Необходима авторизация')
-                uid = user[0]
-                cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={uid}")
-                if not cur.fetchone(): return err(403, 'Ты не участник этой комнаты')
-                cur.execute(f"UPDATE {schema}.users SET last_seen=now() WHERE id={uid}")
-                cur.execute(
-                    f"SELECT m.id,m.content,m.created_at,u.username,u.favorite_game,m.is_removed,m.user_id,m.edited,u.avatar_url,u.badge,m.image_url "
-                    f"FROM {schema}.messages m JOIN {schema}.users u ON u.id=m.user_id "
-                    f"WHERE m.room_id={room_id} ORDER BY m.created_at ASC LIMIT 100"
-                )
-            else:
-                if channel not in VALID_CHANNELS: channel = 'general'
-                user = get_user(cur, schema, token)
-                if user:
-                    cur.execute(f"UPDATE {schema}.users SET last_seen=now() WHERE id={user[0]}")
-                cur.execute(
-                    f"SELECT m.id,m.content,m.created_at,u.username,u.favorite_game,m.is_removed,m.user_id,m.edited,u.avatar_url,u.badge,m.image_url "
-                    f"FROM {schema}.messages m JOIN {schema}.users u ON u.id=m.user_id "
-                    f"WHERE m.channel='{channel}' AND m.room_id IS NULL ORDER BY m.created_at ASC LIMIT 100"
-                )
-            rows = cur.fetchall()
-            message_ids = [r[0] for r in rows]
-            reactions = get_reactions(cur, schema, message_ids)
-            msgs = []
-            for r in rows:
-                mid, content, created_at, username, fav, is_removed, msg_uid, edited, avatar_url, badge, image_url = r
-                msgs.append({
-                    'id': mid,
-                    'content': content if not is_removed else '',
-                    'created_at': str(created_at),
-                    'username': username,
-                    'favorite_game': fav or '',
-                    'is_removed': bool(is_removed),
-                    'author_id': msg_uid,
-                    'edited': bool(edited),
-                    'avatar_url': avatar_url or '',
-                    'badge': badge or '',
-                    'image_url': image_url or '',
-                    'reactions': reactions.get(mid, [])
-                })
-            return resp(200, {'messages': msgs})
-
-        if method == 'POST':
-            user = get_user(cur, schema, token)
-            if not user: return err(401, 'Необходима авторизация')
-            uid, uname, fav_game, is_banned, is_admin = user
-
-            if rate_limit(cur, schema, f'msg:{uid}', 5, 10):
-                log(cur, schema, 'messages', 'Spam', level='warn', ip=ip, user_id=uid)
-                return err(429, 'Слишком быстро. Подожди немного.')
-
-            content = sanitize(body.get('content') or '')
-            image_url = body.get('image_url') or ''
-            channel = body.get('channel', 'general')
-            room_id_str = str(body.get('room_id', ''))
-
-            if not content and not image_url: return err(400, 'Сообщение пустое')
-            if len(content) > 2000: return err(400, 'Максимум 2000 символов')
-
-            sc = content.replace("'", "''")
-            img_val = f"'{image_url.replace(chr(39), '')}'" if image_url else 'NULL'
-            if room_id_str.isdigit():
-                room_id = int(room_id_str)
-                cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={uid}")
-                if not cur.fetchone(): return err(403, 'Ты не участник этой комнаты')
-                cur.execute(f"INSERT INTO {schema}.messages(user_id,room_id,content,image_url) VALUES({uid},{room_id},'{sc}',{img_val}) RETURNING id,created_at")
-            else:
-                if channel not in VALID_CHANNELS: channel = 'general'
-                cur.execute(f"INSERT INTO {schema}.messages(user_id,channel,content,image_url) VALUES({uid},'{channel}','{sc}',{img_val}) RETURNING id,created_at")
-
-            msg_id, created_at = cur.fetchone()
-            cur.execute(f"SELECT avatar_url, badge FROM {schema}.users WHERE id={uid}")
-            av_row = cur.fetchone()
-            return resp(200, {'success': True, 'message': {
-                'id': msg_id, 'content': content, 'created_at': str(created_at),
-                'username': uname, 'favorite_game': fav_game or '',
-                'is_removed': False, 'author_id': uid, 'edited': False,
-                'avatar_url': av_row[0] if av_row and av_row[0] else '',
-                'badge': av_row[1] if av_row and av_row[1] else '',
-                'image_url': image_url,
-                'reactions': []
-            }})
-
-    # ─── DELETE MESSAGE ───────────────────────────────────────
-
-    if action == 'delete_msg' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid, uname, _, _, is_admin = user
-        msg_id = int(body.get('msg_id', 0))
-        if not msg_id: return err(400, 'Укажи msg_id')
-        cur.execute(f"SELECT user_id FROM {schema}.messages WHERE id={msg_id}")
-        row = cur.fetchone()
-        if not row: return err(404, 'Сообщение не найдено')
-        if row[0] != uid and not is_admin: return err(403, 'Нет прав')
-        cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE WHERE id={msg_id}")
-        return resp(200, {'ok': True})
+_online_cache = {'bucket': None, 'data': None}
+_stats_cache = {'at': 0.0, 'data': None}
 
-    # ─── REACTIONS ────────────────────────────────────────────
+def keyset_filter(params):
+    """Курсор (created_at, id) последней строки предыдущей страницы — вместо OFFSET. (условие, параметры)"""
+    before_ts, before_id = params.get('before_ts', ''), params.get('before_id', '')
+    if before_ts and before_id.isdigit() and re.fullmatch(r'[\d\-: .]+', before_ts):
+        return " AND (created_at, id) < (%s::timestamp, %s)", (before_ts, int(before_id))
+    return '', ()
 
-    if action == 'react' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid = user[0]
-        msg_id = int(body.get('msg_id', 0))
-        emoji = body.get('emoji', '')
-        if emoji not in VALID_EMOJI: return err(400, 'Недопустимый эмодзи')
-        if not msg_id: return err(400, 'Укажи msg_id')
-        cur.execute(f"SELECT id, is_active FROM {schema}.message_reactions WHERE message_id={msg_id} AND user_id={uid} AND emoji='{emoji}'")
-        existing = cur.fetchone()
-        if existing:
-            new_active = not existing[1]
-            cur.execute(f"UPDATE {schema}.message_reactions SET is_active={'TRUE' if new_active else 'FALSE'} WHERE id={existing[0]}")
-        else:
-            cur.execute(f"INSERT INTO {schema}.message_reactions(message_id,user_id,emoji,is_active) VALUES({msg_id},{uid},'{emoji}',TRUE)")
-            new_active = True
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.message_reactions WHERE message_id={msg_id} AND emoji='{emoji}' AND is_active=TRUE")
-        cnt = cur.fetchone()[0]
-        cur.execute(f"SELECT array_agg(user_id) FROM {schema}.message_reactions WHERE message_id={msg_id} AND emoji='{emoji}' AND is_active=TRUE")
-        uids = cur.fetchone()[0] or []
-        return resp(200, {'ok': True, 'added': new_active, 'count': cnt, 'users': uids})
-
-    # ─── ROOMS ───────────────────────────────────────────────
-
-    if action == 'rooms' and method == 'GET':
-        user = get_user(cur, schema, token)
-        if not user:
-            cur.execute(
-                f"SELECT r.id,r.name,r.description,r.created_at,u.username,"
-                f"(SELECT COUNT(*) FROM {schema}.room_members rm WHERE rm.room_id=r.id) "
-                f"FROM {schema}.rooms r JOIN {schema}.users u ON u.id=r.owner_id "
-                f"WHERE r.is_public=TRUE ORDER BY r.created_at DESC LIMIT 50"
-            )
-            rows = cur.fetchall()
-            return resp(200, {'rooms': [{'id':r[0],'name':r[1],'description':r[2],'created_at':str(r[3]),'owner':r[4],'members':r[5]} for r in rows]})
-        uid = user[0]
-        cur.execute(
-            f"SELECT r.id,r.name,r.description,r.created_at,u.username,"
-            f"(SELECT COUNT(*) FROM {schema}.room_members rm WHERE rm.room_id=r.id) "
-            f"FROM {schema}.rooms r JOIN {schema}.users u ON u.id=r.owner_id "
-            f"JOIN {schema}.room_members me ON me.room_id=r.id AND me.user_id={uid} "
-            f"ORDER BY r.created_at DESC LIMIT 50"
-        )
-        rows = cur.fetchall()
-        return resp(200, {'rooms': [{'id':r[0],'name':r[1],'description':r[2],'created_at':str(r[3]),'owner':r[4],'members':r[5]} for r in rows]})
+def etag(*parts):
+    return 'W/"' + hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()[:20] + '"'
 
-    if action == 'rooms' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid, uname, _, _, is_admin = user
+def cache_headers(tag):
+    return {'ETag': tag, 'Cache-Control': 'private, no-cache', 'Vary': 'X-Authorization'}
 
-        if rate_limit(cur, schema, f'rooms:{uid}', 3, 3600): return err(429, 'Лимит: 3 комнаты в час')
+def bump(cur, schema, *topics):
+    db.query(
+        cur, 'bump',
+        f"INSERT INTO {schema}.change_counters(topic,version) SELECT DISTINCT t, 1 FROM unnest(%s::text[]) AS t "
+        f"ON CONFLICT(topic) DO UPDATE SET version=change_counters.version+1,updated_at=now()",
+        (list(topics),)
+    )
 
-        name = sanitize(body.get('name') or '')
-        description = sanitize(body.get('description') or '')
-        is_public = bool(body.get('is_public', True))
+def versions(cur, schema, *topics):
+    db.query(cur, 'versions', f"SELECT topic, version FROM {schema}.change_counters WHERE topic = ANY(%s::text[])", (list(topics),))
+    found = dict(cur.fetchall())
+    return [found.get(t, 0) for t in topics]
+
+def mark_read(cur, schema, uid, scope, last_id):
+    db.query(
+        cur, 'mark_read',
+        f"INSERT INTO {schema}.read_markers(user_id,scope,last_read_id) VALUES(%s,%s,%s) "
+        f"ON CONFLICT(user_id,scope) DO UPDATE SET last_read_id=EXCLUDED.last_read_id,updated_at=now() "
+        f"WHERE read_markers.last_read_id<EXCLUDED.last_read_id",
+        (uid, scope, int(last_id))
+    )
 
-        if len(name) < 2 or len(name) > 32: return err(400, 'Название: 2–32 символа')
+def mark_room_joined(cur, schema, uid, room_id):
+    # История до вступления не считается непрочитанной
+    cur.execute(
+        f"INSERT INTO {schema}.read_markers(user_id,scope,last_read_id) "
+        f"SELECT {uid},'room:{room_id}',COALESCE(MAX(id),0) FROM {schema}.messages WHERE room_id={room_id} "
+        f"ON CONFLICT(user_id,scope) DO NOTHING"
+    )
 
-        sn = name.replace("'","''"); sd = description.replace("'","''")
-        pub = 'TRUE' if is_public else 'FALSE'
-        cur.execute(f"INSERT INTO {schema}.rooms(name,description,owner_id,is_public) VALUES('{sn}','{sd}',{uid},{pub}) RETURNING id,created_at")
-        room_id, created_at = cur.fetchone()
-        cur.execute(f"INSERT INTO {schema}.room_members(room_id,user_id) VALUES({room_id},{uid})")
-        code = secrets.token_urlsafe(8)
-        cur.execute(f"INSERT INTO {schema}.invites(code,room_id,created_by) VALUES('{code}',{room_id},{uid})")
-        return resp(201, {'room':{'id':room_id,'name':name,'description':description,'is_public':is_public,'created_at':str(created_at),'invite_code':code}})
+def add_room_member(cur, schema, room_id, user_id):
+    """Добавляет участника и увеличивает rooms.member_count. False — уже был участником"""
+    cur.execute(f"INSERT INTO {schema}.room_members(room_id,user_id) VALUES({room_id},{user_id}) ON CONFLICT DO NOTHING RETURNING 1")
+    if not cur.fetchone():
+        return False
+    cur.execute(f"UPDATE {schema}.rooms SET member_count=member_count+1 WHERE id={room_id}")
+    mark_room_joined(cur, schema, user_id, room_id)
+    return True
 
-    if action == 'join' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid, uname, _, _, _ = user
+def dm_topic(a, b):
+    return f"dm:{min(a, b)}:{max(a, b)}"
 
-        code = params.get('code', '').replace("'","''")
-        if not code: return err(400, 'Укажи код инвайта')
+def notify_message(cur, schema, msg_id):
+    """Событие в тему канала или комнаты, где лежит сообщение"""
+    cur.execute(
+        f"SELECT pg_notify(%s, CASE WHEN room_id IS NULL THEN 'ch:'||channel ELSE 'room:'||room_id END) "
+        f"FROM {schema}.messages WHERE id={msg_id}",
+        (db.events_channel(schema),)
+    )
 
-        cur.execute(f"SELECT i.room_id,i.uses,i.max_uses,i.expires_at,r.name FROM {schema}.invites i JOIN {schema}.rooms r ON r.id=i.room_id WHERE i.code='{code}'")
-        inv = cur.fetchone()
-        if not inv: return err(404, 'Инвайт не найден')
+def wait_param(params, since):
+    """Сколько секунд держать long-poll: только для дельты по курсору"""
+    wait = str(params.get('wait', ''))
+    return min(int(wait), LONG_POLL_MAX_SEC) if wait.isdigit() and since.isdigit() else 0
 
-        room_id, uses, max_uses, expires_at, room_name = inv
-        if max_uses and uses >= max_uses: return err(410, 'Инвайт исчерпан')
-        if expires_at:
-            cur.execute(f"SELECT now() > '{expires_at}'::timestamp")
-            if cur.fetchone()[0]: return err(410, 'Инвайт истёк')
+def cdn_url(key):
+    base = os.environ.get('CDN_BASE_URL') or f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket"
+    return f"{base}/{key}"
 
-        cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={uid}")
-        already = bool(cur.fetchone())
-        if not already:
-            cur.execute(f"INSERT INTO {schema}.room_members(room_id,user_id) VALUES({room_id},{uid})")
-            cur.execute(f"UPDATE {schema}.invites SET uses=uses+1 WHERE code='{code}'")
-        return resp(200, {'ok':True,'room_id':room_id,'room_name':room_name,'already_member':already})
-
-    if action == 'invite' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid, uname, _, _, is_admin = user
-
-        rid = params.get('room_id', '')
-        if not str(rid).isdigit(): return err(400, 'Укажи room_id')
-        rid = int(rid)
-        cur.execute(f"SELECT owner_id FROM {schema}.rooms WHERE id={rid}")
-        room = cur.fetchone()
-        if not room: return err(404, 'Комната не найдена')
-        if room[0] != uid and not is_admin: return err(403, 'Только владелец')
-
-        code = secrets.token_urlsafe(8)
-        cur.execute(f"INSERT INTO {schema}.invites(code,room_id,created_by) VALUES('{code}',{rid},{uid})")
-        return resp(201, {'invite_code': code})
-
-    # ─── INVITE FRIEND TO ROOM ────────────────────────────────
-
-    if action == 'invite_friend' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid, uname, _, _, is_admin = user
-
-        room_id = int(body.get('room_id', 0))
-        friend_id = int(body.get('friend_id', 0))
-        if not room_id or not friend_id: return err(400, 'Укажи room_id и friend_id')
+def image_key(sha, ext):
+    return f"images/{sha[:2]}/{sha}.{ext}"
 
-        cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={uid}")
-        if not cur.fetchone(): return err(403, 'Ты не участник этой комнаты')
+def staging_key(uid, ext):
+    """Куда браузер грузит файл: по адресу содержимого его кладёт только confirm_upload после проверки"""
+    return f"uploads/{uid}/{secrets.token_hex(16)}.{ext}"
 
-        cur.execute(
-            f"SELECT 1 FROM {schema}.friend_requests "
-            f"WHERE ((from_user_id={uid} AND to_user_id={friend_id}) OR (from_user_id={friend_id} AND to_user_id={uid})) "
-            f"AND status='accepted'"
-        )
-        if not cur.fetchone(): return err(403, 'Не друзья')
-
-        cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={friend_id}")
-        already = bool(cur.fetchone())
-        if not already:
-            cur.execute(f"INSERT INTO {schema}.room_members(room_id,user_id) VALUES({room_id},{friend_id})")
+def find_image(cur, schema, sha, kind):
+    """URL уже загруженного файла с этим sha256; продлевает ему паузу перед сборкой мусора.
+    Новый вид (аватарка из картинки чата и наоборот) отправляет файл заново в backend/thumbnails"""
+    cur.execute(
+        f"UPDATE {schema}.image_objects SET touched_at=now(), "
+        f"variants=CASE WHEN %s=ANY(kinds) OR kinds='{{}}' THEN variants END, "
+        f"variants_claimed_at=CASE WHEN %s=ANY(kinds) OR kinds='{{}}' THEN variants_claimed_at END, "
+        f"kinds=CASE WHEN %s=ANY(kinds) THEN kinds ELSE array_append(kinds, %s::varchar) END "
+        f"WHERE hash=%s RETURNING url",
+        (kind, kind, kind, kind, sha)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
 
-        return resp(200, {'ok': True, 'already_member': already})
+def save_image(cur, schema, sha, key, ct, size, kind):
+    url = cdn_url(key)
+    cur.execute(
+        f"INSERT INTO {schema}.image_objects(hash,key,url,content_type,size,kinds) VALUES(%s,%s,%s,%s,%s,ARRAY[%s]::varchar[]) "
+        f"ON CONFLICT(hash) DO UPDATE SET touched_at=now(), "
+        f"variants=CASE WHEN %s=ANY(image_objects.kinds) OR image_objects.kinds='{{}}' THEN image_objects.variants END, "
+        f"kinds=CASE WHEN %s=ANY(image_objects.kinds) THEN image_objects.kinds ELSE array_append(image_objects.kinds, %s::varchar) END "
+        f"RETURNING url",
+        (sha, key, url, ct, int(size), kind, kind, kind, kind)
+    )
+    return cur.fetchone()[0]
 
-    # ─── EDIT MESSAGE ─────────────────────────────────────────
+def ref_image(cur, schema, url):
+    """+1 ссылка на файл по его URL; hash или None для внешних и старых картинок"""
+    if not url:
+        return None
+    cur.execute(f"UPDATE {schema}.image_objects SET ref_count=ref_count+1 WHERE url=%s RETURNING hash", (url,))
+    row = cur.fetchone()
+    return row[0] if row else None
 
-    if action == 'edit_msg' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid = user[0]
-        msg_id = int(body.get('msg_id', 0))
-        content = sanitize(body.get('content') or '')
-        if not msg_id: return err(400, 'Укажи msg_id')
-        if not content: return err(400, 'Пустое сообщение')
-        if len(content) > 2000: return err(400, 'Максимум 2000 символов')
-        cur.execute(f"SELECT user_id FROM {schema}.messages WHERE id={msg_id} AND is_removed=FALSE")
-        row = cur.fetchone()
-        if not row: return err(404, 'Сообщение не найдено')
-        if row[0] != uid: return err(403, 'Нет прав')
-        sc = content.replace("'", "''")
-        cur.execute(f"UPDATE {schema}.messages SET content='{sc}', edited=TRUE WHERE id={msg_id}")
-        return resp(200, {'ok': True, 'content': content})
-
-    # ─── PROFILE ─────────────────────────────────────────────
-
-    if action == 'profile' and method == 'GET':
-        target_username = params.get('username', '').replace("'", "''")
-        if not target_username: return err(400, 'Укажи username')
-        cur.execute(f"SELECT id,username,favorite_game,avatar_url,created_at FROM {schema}.users WHERE username='{target_username}' AND is_banned=FALSE")
-        row = cur.fetchone()
-        if not row: return err(404, 'Пользователь не найден')
-        uid2, uname2, fav2, avatar2, created2 = row
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.messages WHERE user_id={uid2} AND is_removed=FALSE")
-        msg_count = cur.fetchone()[0]
-        return resp(200, {'id': uid2, 'username': uname2, 'favorite_game': fav2 or '', 'avatar_url': avatar2 or '', 'created_at': str(created2), 'message_count': msg_count})
+def set_avatar(cur, schema, uid, url, sha=None):
+    cur.execute(f"SELECT avatar_hash FROM {schema}.users WHERE id={uid} FOR UPDATE")
+    row = cur.fetchone()
+    old = row[0] if row else None
+    cur.execute(f"UPDATE {schema}.users SET avatar_url=%s, avatar_hash=%s WHERE id={uid}", (url, sha))
+    if old != sha:
+        if old:
+            cur.execute(f"UPDATE {schema}.image_objects SET ref_count=ref_count-1, touched_at=now() WHERE hash=%s", (old,))
+        if sha:
+            cur.execute(f"UPDATE {schema}.image_objects SET ref_count=ref_count+1 WHERE hash=%s", (sha,))
+    bump(cur, schema, 'profiles')
+    invalidate_user(uid)
+
+def upload_result(cur, schema, uid, kind, url, sha):
+    if kind == 'avatar':
+        set_avatar(cur, schema, uid, url, sha)
+        return {'ok': True, 'avatar_url': url}
+    return {'ok': True, 'image_url': url}
+
+def get_reactions(cur, schema, message_ids, uid=None):
+    if not message_ids:
+        return {}
+    db.query(
+        cur, 'reactions',
+        f"SELECT c.message_id, c.emoji, c.count, r.user_id IS NOT NULL "
+        f"FROM {schema}.message_reaction_counts c "
+        f"LEFT JOIN {schema}.message_reactions r ON r.message_id=c.message_id AND r.emoji=c.emoji "
+        f"AND r.user_id=%s AND r.is_active=TRUE "
+        f"WHERE c.message_id = ANY(%s::int[]) AND c.count>0 ORDER BY c.message_id, c.emoji",
+        (int(uid or 0), list(message_ids))
+    )
+    result = {}
+    for mid, emoji, cnt, mine in cur.fetchall():
+        result.setdefault(mid, []).append({'emoji': emoji, 'count': cnt, 'reacted_by_me': bool(mine)})
+    return result
 
-    # ─── AVATAR UPLOAD ────────────────────────────────────────
+# ─── READ ACTIONS ────────────────────────────────────────────
+# Чтения вынесены из handler, чтобы выполнять их и по одному, и пачкой (action=batch).
+# Каждое возвращает (код, данные, etag); etag из seen — (304, None, etag) без выборки
 
-    if action == 'upload_avatar' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
+def read_messages(cur, schema, user, params, seen):
+    channel = params.get('channel', 'general')
+    room_id_str = params.get('room_id', '')
+    if room_id_str and str(room_id_str).isdigit():
+        room_id = int(room_id_str)
+        if not user: return 401, {'error': 'Необходима авторизация'}, None
         uid = user[0]
-        data_url = body.get('image', '')
-        if not data_url: return err(400, 'Нет изображения')
-        if ',' not in data_url: return err(400, 'Неверный формат')
-        header, b64data = data_url.split(',', 1)
-        if 'image/jpeg' in header or 'image/jpg' in header:
-            ext, ct = 'jpg', 'image/jpeg'
-        elif 'image/png' in header:
-            ext, ct = 'png', 'image/png'
-        elif 'image/webp' in header:
-            ext, ct = 'webp', 'image/webp'
-        else:
-            return err(400, 'Допустимы только JPG, PNG, WebP')
-        img_bytes = base64.b64decode(b64data)
-        if len(img_bytes) > 2 * 1024 * 1024: return err(400, 'Файл больше 2MB')
-        key = f"avatars/{uid}_{int(time.time())}.{ext}"
-        s3 = s3_client()
-        s3.put_object(Bucket='files', Key=key, Body=img_bytes, ContentType=ct)
-        cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
-        cur.execute(f"UPDATE {schema}.users SET avatar_url='{cdn_url}' WHERE id={uid}")
-        return resp(200, {'ok': True, 'avatar_url': cdn_url})
-
-    # ─── IMAGE UPLOAD ────────────────────────────────────────
-
-    if action == 'upload_image' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid = user[0]
-        data_url = body.get('image', '')
-        if not data_url: return err(400, 'Нет изображения')
-        if ',' not in data_url: return err(400, 'Неверный формат')
-        header, b64data = data_url.split(',', 1)
-        if 'image/jpeg' in header or 'image/jpg' in header:
-            ext, ct = 'jpg', 'image/jpeg'
-        elif 'image/png' in header:
-            ext, ct = 'png', 'image/png'
-        elif 'image/webp' in header:
-            ext, ct = 'webp', 'image/webp'
-        elif 'image/gif' in header:
-            ext, ct = 'gif', 'image/gif'
-        else:
-            return err(400, 'Допустимы только JPG, PNG, WebP, GIF')
-        img_bytes = base64.b64decode(b64data)
-        if len(img_bytes) > 8 * 1024 * 1024: return err(400, 'Файл больше 8MB')
-        key = f"chat_images/{uid}_{int(time.time())}.{ext}"
-        s3 = s3_client()
-        s3.put_object(Bucket='files', Key=key, Body=img_bytes, ContentType=ct)
-        cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
-        return resp(200, {'ok': True, 'image_url': cdn_url})
-
-    # ─── SETTINGS ────────────────────────────────────────────
-
-    if action == 'settings':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid, uname, fav_game, _, _ = user
-
-        if method == 'GET':
-            cur.execute(f"SELECT username, favorite_game, email, avatar_url FROM {schema}.users WHERE id={uid}")
-            row = cur.fetchone()
-            if not row: return err(404, 'Пользователь не найден')
-            return resp(200, {'username': row[0], 'favorite_game': row[1] or '', 'email': row[2], 'avatar_url': row[3] or ''})
-
-        if method == 'POST':
-            new_game = sanitize(body.get('favorite_game') or '').replace("'", "''")
-            new_username = sanitize(body.get('username') or '').replace("'", "''")
-            if new_username and (len(new_username) < 2 or len(new_username) > 32):
-                return err(400, 'Никнейм: 2–32 символа')
-            if new_username and new_username != uname:
-                cur.execute(f"SELECT id FROM {schema}.users WHERE username='{new_username}' AND id!={uid}")
-                if cur.fetchone(): return err(409, 'Никнейм занят')
-                cur.execute(f"UPDATE {schema}.users SET username='{new_username}' WHERE id={uid}")
-            if new_game is not None:
-                cur.execute(f"UPDATE {schema}.users SET favorite_game='{new_game}' WHERE id={uid}")
-            cur.execute(f"SELECT username, favorite_game, avatar_url FROM {schema}.users WHERE id={uid}")
-            row = cur.fetchone()
-            return resp(200, {'ok': True, 'username': row[0], 'favorite_game': row[1] or '', 'avatar_url': row[2] or ''})
-
-    # ─── ADMIN ───────────────────────────────────────────────
-
-    if action == 'admin_stats' and method == 'GET':
-        user = get_user(cur, schema, token, require_admin=True)
-        if not user: return err(403, 'Доступ запрещён')
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.users"); tu = cur.fetchone()[0]
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.users WHERE is_banned=TRUE"); bu = cur.fetchone()[0]
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.messages"); tm = cur.fetchone()[0]
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.rooms"); tr = cur.fetchone()[0]
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.error_logs WHERE created_at > now()-interval '24 hours'"); e24 = cur.fetchone()[0]
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.users WHERE created_at > now()-interval '24 hours'"); nu = cur.fetchone()[0]
-        cur.execute(f"SELECT COUNT(*) FROM {schema}.messages WHERE created_at > now()-interval '24 hours'"); m24 = cur.fetchone()[0]
-        cur.execute("""
-            SELECT 
-                pg_size_pretty(sum(pg_total_relation_size(schemaname||'.'||tablename))) AS pretty,
-                sum(pg_total_relation_size(schemaname||'.'||tablename)) AS bytes
-            FROM pg_tables WHERE schemaname = %s
-        """, (schema,)); row = cur.fetchone(); db_size = row[0] if row else '?'; db_bytes = int(row[1]) if row and row[1] else 0
-        return resp(200, {'stats':{'total_users':tu,'banned_users':bu,'total_messages':tm,'total_rooms':tr,'errors_24h':e24,'new_users_24h':nu,'messages_24h':m24,'db_size':db_size,'db_bytes':db_bytes}})
-
-    if action == 'admin_logs' and method == 'GET':
-        user = get_user(cur, schema, token, require_admin=True)
-        if not user: return err(403, 'Доступ запрещён')
-        limit = min(int(params.get('limit', 50)), 200)
-        level = params.get('level', '').replace("'","''")
-        lf = f"AND level='{level}'" if level else ''
-        cur.execute(f"SELECT id,level,source,message,details,ip,user_id,created_at FROM {schema}.error_logs WHERE 1=1 {lf} ORDER BY created_at DESC LIMIT {limit}")
-        rows = cur.fetchall()
-        return resp(200, {'logs':[{'id':r[0],'level':r[1],'source':r[2],'message':r[3],'details':r[4],'ip':r[5],'user_id':r[6],'created_at':str(r[7])} for r in rows]})
-
-    if action == 'admin_users' and method == 'GET':
-        user = get_user(cur, schema, token, require_admin=True)
-        if not user: return err(403, 'Доступ запрещён')
-        limit = min(int(params.get('limit', 50)), 200)
-        offset = int(params.get('offset', 0))
-        q = params.get('q', '').replace("'","''")
-        sf = f"AND (username ILIKE '%{q}%' OR email ILIKE '%{q}%')" if q else ''
-        cur.execute(f"SELECT id,username,email,favorite_game,is_admin,is_banned,created_at FROM {schema}.users WHERE 1=1 {sf} ORDER BY created_at DESC LIMIT {limit} OFFSET {offset}")
-        rows = cur.fetchall()
-        return resp(200, {'users':[{'id':r[0],'username':r[1],'email':r[2],'favorite_game':r[3],'is_admin':r[4],'is_banned':r[5],'created_at':str(r[6])} for r in rows]})
-
-    if action == 'admin_ban' and method == 'POST':
-        user = get_user(cur, schema, token, require_admin=True)
-        if not user: return err(403, 'Доступ запрещён')
-        uid_admin = user[0]
-        target_id = body.get('user_id')
-        ban = bool(body.get('ban', True))
-        if not target_id: return err(400, 'Укажи user_id')
-
-        cur.execute(f"SELECT id,is_admin FROM {schema}.users WHERE id={int(target_id)}")
-        target = cur.fetchone()
-        if not target: return err(404, 'Пользователь не найден')
-        if target[1]: return err(403, 'Нельзя банить администратора')
-
-        action_val = 'TRUE' if ban else 'FALSE'
-        cur.execute(f"UPDATE {schema}.users SET is_banned={action_val} WHERE id={int(target_id)}")
-        if ban:
-            cur.execute(f"SELECT COUNT(*) FROM {schema}.sessions WHERE user_id={int(target_id)}")
-        log(cur, schema, 'admin', f"{'Ban' if ban else 'Unban'} user {target_id}", user_id=uid_admin)
-        return resp(200, {'ok':True,'banned':ban})
-
-    if action == 'admin_messages' and method == 'GET':
-        user = get_user(cur, schema, token, require_admin=True)
-        if not user: return err(403, 'Доступ запрещён')
-        channel = params.get('channel', 'general').replace("'","''")
-        room_id_str = params.get('room_id', '')
-        limit = min(int(params.get('limit', 50)), 200)
-        if room_id_str and str(room_id_str).isdigit():
-            room_id = int(room_id_str)
-            cur.execute(
-                f"SELECT m.id,m.content,m.created_at,u.username,m.is_removed,m.room_id,NULL as channel "
-                f"FROM {schema}.messages m JOIN {schema}.users u ON u.id=m.user_id "
-                f"WHERE m.room_id={room_id} ORDER BY m.created_at DESC LIMIT {limit}"
-            )
-        else:
-            cur.execute(
-                f"SELECT m.id,m.content,m.created_at,u.username,m.is_removed,m.room_id,m.channel "
-                f"FROM {schema}.messages m JOIN {schema}.users u ON u.id=m.user_id "
-                f"WHERE m.channel='{channel}' AND m.room_id IS NULL ORDER BY m.created_at DESC LIMIT {limit}"
-            )
+        cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={uid}")
+        if not cur.fetchone(): return 403, {'error': 'Ты не участник этой комнаты'}, None
+        touch_presence(cur, schema, uid)
+        kind, scope, scope_args = 'room', "m.room_id=%s", (room_id,)
+    else:
+        if channel not in VALID_CHANNELS: channel = 'general'
+        if user:
+            touch_presence(cur, schema, user[0])
+        kind, scope, scope_args = 'ch', "m.channel=%s AND m.room_id IS NULL", (channel,)
+    read_scope = f"room:{room_id}" if room_id_str and str(room_id_str).isdigit() else f"ch:{channel}"
+
+    # Курсоры: since_id (+since_rev) — дельта новых и изменённых, before_id — страница истории
+    since_id = str(params.get('since_id', ''))
+    since_rev = str(params.get('since_rev', ''))
+    before_id = str(params.get('before_id', ''))
+    # Long-poll (wait=N): подписываемся до проверки, чтобы не пропустить событие между ними
+    wait_sec = wait_param(params, since_rev)
+    busy = bool(wait_sec) and not db.listen(cur.connection, schema, LONG_POLL_MAX_WAITERS)
+    if busy:
+        wait_sec = 0
+    max_rev_sql = f"SELECT COALESCE(MAX(m.rev),0) FROM {schema}.messages m WHERE {scope}"
+    max_rev = db.query(cur, f'max_rev_{kind}', max_rev_sql, scope_args).fetchone()[0]
+    if wait_sec:
+        if max_rev <= int(since_rev) and db.wait_notify(cur.connection, {read_scope}, wait_sec):
+            max_rev = db.query(cur, f'max_rev_{kind}', max_rev_sql, scope_args).fetchone()[0]
+        db.unlisten(cur.connection)
+    tag = etag('messages', user[0] if user else 0, read_scope, since_id, since_rev, before_id, max_rev, busy, *versions(cur, schema, 'profiles'))
+    if tag in seen: return 304, None, tag
+    base = (
+        f"SELECT m.id,m.content,m.created_at,u.username,u.favorite_game,m.is_removed,m.user_id,m.edited,u.avatar_url,u.badge,m.image_url,m.rev,"
+        f"io.variants,ao.variants "
+        f"FROM {schema}.messages m JOIN {schema}.users u ON u.id=m.user_id "
+        f"LEFT JOIN {schema}.image_objects io ON io.hash=m.image_hash "
+        f"LEFT JOIN {schema}.image_objects ao ON ao.hash=u.avatar_hash WHERE {scope}"
+    )
+    # Четыре формы запроса на каждый вид scope — у каждой свой подготовленный план.
+    # Дельта идёт по rev: новые сообщения тоже получают rev при вставке
+    if since_rev.isdigit() and since_id.isdigit():
+        rows = db.query(cur, f'messages_{kind}_delta', f"{base} AND m.rev>%s ORDER BY m.rev ASC LIMIT {PAGE_SIZE}",
+                        (*scope_args, int(since_rev) - CURSOR_OVERLAP)).fetchall()
+    elif since_id.isdigit():
+        rows = db.query(cur, f'messages_{kind}_after', f"{base} AND m.id>%s ORDER BY m.id ASC LIMIT {PAGE_SIZE}",
+                        (*scope_args, int(since_id))).fetchall()
+    elif before_id.isdigit():
+        rows = db.query(cur, f'messages_{kind}_before', f"{base} AND m.id<%s ORDER BY m.id DESC LIMIT {PAGE_SIZE}",
+                        (*scope_args, int(before_id))).fetchall()[::-1]
+    else:
+        rows = db.query(cur, f'messages_{kind}_latest', f"{base} ORDER BY m.id DESC LIMIT {PAGE_SIZE}", scope_args).fetchall()[::-1]
+
+    # Неполная страница — отдано всё до max_rev; полная — курсор только до последней отданной строки
+    full = len(rows) == PAGE_SIZE
+    last_rev = max(r[11] for r in rows) if full and since_id.isdigit() else max([max_rev, *(r[11] for r in rows)])
+    rows.sort(key=lambda r: r[0])
+    message_ids = [r[0] for r in rows]
+    reactions = get_reactions(cur, schema, message_ids, user[0] if user else None)
+    msgs = []
+    last_id = int(since_id) if since_id.isdigit() else 0
+    for r in rows:
+        mid, content, created_at, username, fav, is_removed, msg_uid, edited, avatar_url, badge, image_url, rev, image_variants, avatar_variants = r
+        last_id = max(last_id, mid)
+        msgs.append({
+            'id': mid,
+            'content': content if not is_removed else '',
+            'created_at': str(created_at),
+            'username': username,
+            'favorite_game': fav or '',
+            'is_removed': bool(is_removed),
+            'author_id': msg_uid,
+            'edited': bool(edited),
+            'avatar_url': avatar_url or '',
+            'badge': badge or '',
+            'image_url': image_url or '',
+            'image_variants': image_variants or {},
+            'avatar_variants': avatar_variants or {},
+            'reactions': reactions.get(mid, [])
+        })
+    if user and rows and not before_id.isdigit():
+        mark_read(cur, schema, user[0], read_scope, last_id)
+    data = {'messages': msgs, 'cursor': {'last_id': last_id, 'rev': last_rev}, 'has_more': full}
+    if busy:
+        data['retry_after'] = LONG_POLL_BUSY_RETRY_SEC
+    return 200, data, tag
+
+def read_rooms(cur, schema, user, params, seen):
+    tag = etag('rooms', user[0] if user else 0, *versions(cur, schema, 'rooms', 'profiles'))
+    if tag in seen: return 304, None, tag
+    if not user:
+        cur.execute(
+            f"SELECT r.id,r.name,r.description,r.created_at,u.username,r.member_count "
+            f"FROM {schema}.rooms r JOIN {schema}.users u ON u.id=r.owner_id "
+            f"WHERE r.is_public=TRUE ORDER BY r.created_at DESC LIMIT 50"
+        )
         rows = cur.fetchall()
-        msgs = [{'id':r[0],'content':r[1],'created_at':str(r[2]),'username':r[3],'is_removed':r[4],'room_id':r[5],'channel':r[6]} for r in rows]
-        return resp(200, {'messages': msgs})
-
-    if action == 'admin_clear' and method == 'POST':
-        user = get_user(cur, schema, token, require_admin=True)
-        if not user: return err(403, 'Доступ запрещён')
-        uid_admin = user[0]
-        channel = body.get('channel', '').replace("'","''")
-        room_id = body.get('room_id')
-        msg_id = body.get('msg_id')
-        if msg_id:
-            cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE WHERE id={int(msg_id)}")
-            count = cur.rowcount
-            log(cur, schema, 'admin', f"Deleted msg {msg_id}", user_id=uid_admin)
-            return resp(200, {'ok':True,'deleted':count})
-        elif room_id:
-            cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE WHERE room_id={int(room_id)} AND is_removed=FALSE")
-            count = cur.rowcount
-            log(cur, schema, 'admin', f"Cleared room {room_id} ({count} msgs)", user_id=uid_admin)
-            return resp(200, {'ok':True,'deleted':count})
-        elif channel:
-            if channel not in VALID_CHANNELS: return err(400, 'Неверный канал')
-            cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE WHERE channel='{channel}' AND room_id IS NULL AND is_removed=FALSE")
-            count = cur.rowcount
-            log(cur, schema, 'admin', f"Cleared channel #{channel} ({count} msgs)", user_id=uid_admin)
-            return resp(200, {'ok':True,'deleted':count})
-        else:
-            return err(400, 'Укажи channel, room_id или msg_id')
-
-    if action == 'admin_set_badge' and method == 'POST':
-        user = get_user(cur, schema, token, require_admin=True)
-        if not user: return err(403, 'Доступ запрещён')
-        uid_admin = user[0]
-        target_id = body.get('user_id')
-        badge = (body.get('badge') or '').strip()
-        if not target_id: return err(400, 'Укажи user_id')
-        if len(badge) > 64: return err(400, 'Тег слишком длинный (макс. 64 символа)')
-        badge_safe = badge.replace("'", "''")
-        if badge_safe:
-            cur.execute(f"UPDATE {schema}.users SET badge='{badge_safe}' WHERE id={int(target_id)}")
-        else:
-            cur.execute(f"UPDATE {schema}.users SET badge=NULL WHERE id={int(target_id)}")
-        log(cur, schema, 'admin', f"Set badge '{badge}' for user {target_id}", user_id=uid_admin)
-        return resp(200, {'ok': True, 'badge': badge})
-
-    # ─── ONLINE ──────────────────────────────────────────────
-
-    if action == 'online' and method == 'GET':
+        return 200, {'rooms': [{'id':r[0],'name':r[1],'description':r[2],'created_at':str(r[3]),'owner':r[4],'members':r[5]} for r in rows]}, tag
+    uid = user[0]
+    cur.execute(
+        f"SELECT r.id,r.name,r.description,r.created_at,u.username,r.member_count "
+        f"FROM {schema}.rooms r JOIN {schema}.users u ON u.id=r.owner_id "
+        f"JOIN {schema}.room_members me ON me.room_id=r.id AND me.user_id={uid} "
+        f"ORDER BY r.created_at DESC LIMIT 50"
+    )
+    rows = cur.fetchall()
+    return 200, {'rooms': [{'id':r[0],'name':r[1],'description':r[2],'created_at':str(r[3]),'owner':r[4],'members':r[5]} for r in rows]}, tag
+
+def read_online(cur, schema, user, params, seen):
+    # Онлайн считается с точностью до минут — версия меняется раз в ONLINE_TAG_SEC
+    bucket = int(time.time() // ONLINE_TAG_SEC)
+    tag = etag('online', bucket)
+    if tag in seen: return 304, None, tag
+    if _online_cache['bucket'] != bucket:
         cur.execute(
-            f"SELECT username, favorite_game FROM {schema}.users "
-            f"WHERE last_seen > now() - interval '2 minutes' AND is_banned=FALSE "
-            f"ORDER BY username ASC LIMIT 50"
+            f"SELECT u.username, u.favorite_game, COUNT(*) OVER () FROM {schema}.presence p JOIN {schema}.users u ON u.id=p.user_id "
+            f"WHERE p.last_seen > now() - interval '{ONLINE_WINDOW_SEC} seconds' AND u.is_banned=FALSE "
+            f"ORDER BY u.username ASC LIMIT {ONLINE_LIST_LIMIT}"
         )
         rows = cur.fetchall()
         users = [{'username': r[0], 'favorite_game': r[1] or ''} for r in rows]
-        return resp(200, {'online': len(users), 'users': users})
+        _online_cache.update(bucket=bucket, data={'online': rows[0][2] if rows else 0, 'users': users})
+    return 200, _online_cache['data'], tag
+
+def read_friends(cur, schema, user, params, seen):
+    if not user: return 401, {'error': 'Необходима авторизация'}, None
+    uid = user[0]
+    sub = params.get('sub', 'list')
+    v_friends, v_profiles, v_bans = versions(cur, schema, f'friends:{uid}', 'profiles', 'bans')
+    tag = etag('friends', sub, uid, v_friends, v_profiles, v_bans)
+    if tag in seen: return 304, None, tag
+    if sub == 'list':
+        ids = friend_ids(cur, schema, uid, (v_friends, v_bans))
+        friends = []
+        if ids:
+            cur.execute(f"SELECT id, username, favorite_game FROM {schema}.users WHERE id = ANY(%s) AND is_banned=FALSE", (list(ids),))
+            friends = [{'id':r[0],'username':r[1],'favorite_game':r[2] or ''} for r in cur.fetchall()]
+        return 200, {'friends': friends}, tag
+    if sub == 'requests':
+        cur.execute(
+            f"SELECT fr.id, u.id, u.username, u.favorite_game, fr.created_at FROM {schema}.friend_requests fr "
+            f"JOIN {schema}.users u ON u.id=fr.from_user_id "
+            f"WHERE fr.to_user_id={uid} AND fr.status='pending' AND u.is_banned=FALSE "
+            f"ORDER BY fr.created_at DESC"
+        )
+        reqs = [{'request_id':r[0],'user_id':r[1],'username':r[2],'favorite_game':r[3] or '','created_at':str(r[4])} for r in cur.fetchall()]
+        return 200, {'requests': reqs}, tag
+    return 400, {'error': 'Неизвестный sub'}, None
+
+def read_dm(cur, schema, user, params, seen):
+    if not user: return 401, {'error': 'Необходима авторизация'}, None
+    uid = user[0]
+    other_id_str = params.get('with', '')
+    if not str(other_id_str).isdigit(): return 400, {'error': 'Укажи with=user_id'}, None
+    other_id = int(other_id_str)
+    if not is_friend(cur, schema, uid, other_id): return 403, {'error': 'Не друзья'}, None
+    touch_presence(cur, schema, uid)
+    # Курсоры как у каналов: since_id (+since_rev) — дельта, before_id — страница истории
+    since_id = str(params.get('since_id', ''))
+    since_rev = str(params.get('since_rev', ''))
+    before_id = str(params.get('before_id', ''))
+    pair = (min(uid, other_id), max(uid, other_id))
+    wait_sec = wait_param(params, since_rev)
+    busy = bool(wait_sec) and not db.listen(cur.connection, schema, LONG_POLL_MAX_WAITERS)
+    if busy:
+        wait_sec = 0
+    max_rev_sql = f"SELECT COALESCE(MAX(rev),0) FROM {schema}.direct_messages WHERE user_lo=%s AND user_hi=%s"
+    max_rev = db.query(cur, 'dm_max_rev', max_rev_sql, pair).fetchone()[0]
+    if wait_sec:
+        if max_rev <= int(since_rev) and db.wait_notify(cur.connection, {dm_topic(uid, other_id)}, wait_sec):
+            max_rev = db.query(cur, 'dm_max_rev', max_rev_sql, pair).fetchone()[0]
+        db.unlisten(cur.connection)
+    tag = etag('dm', uid, other_id, since_id, since_rev, before_id, max_rev, busy, *versions(cur, schema, dm_topic(uid, other_id), 'profiles'))
+    if tag in seen: return 304, None, tag
+    base = (
+        f"SELECT dm.id, dm.content, dm.created_at, u.username, dm.is_removed, dm.sender_id, dm.rev FROM {schema}.direct_messages dm "
+        f"JOIN {schema}.users u ON u.id=dm.sender_id "
+        f"WHERE dm.user_lo=%s AND dm.user_hi=%s"
+    )
+    # Дельта по rev, как у каналов
+    if since_rev.isdigit() and since_id.isdigit():
+        rows = db.query(cur, 'dm_delta', f"{base} AND dm.rev>%s ORDER BY dm.rev ASC LIMIT {PAGE_SIZE}",
+                        (*pair, int(since_rev) - CURSOR_OVERLAP)).fetchall()
+    elif since_id.isdigit():
+        rows = db.query(cur, 'dm_after', f"{base} AND dm.id>%s ORDER BY dm.id ASC LIMIT {PAGE_SIZE}",
+                        (*pair, int(since_id))).fetchall()
+    elif before_id.isdigit():
+        rows = db.query(cur, 'dm_before', f"{base} AND dm.id<%s ORDER BY dm.id DESC LIMIT {PAGE_SIZE}",
+                        (*pair, int(before_id))).fetchall()[::-1]
+    else:
+        rows = db.query(cur, 'dm_latest', f"{base} ORDER BY dm.id DESC LIMIT {PAGE_SIZE}", pair).fetchall()[::-1]
+    full = len(rows) == PAGE_SIZE
+    last_rev = max(r[6] for r in rows) if full and since_id.isdigit() else max([max_rev, *(r[6] for r in rows)])
+    rows.sort(key=lambda r: r[0])
+    msgs = []
+    last_in = 0
+    last_id = int(since_id) if since_id.isdigit() else 0
+    for r in rows:
+        if r[5] == other_id: last_in = max(last_in, r[0])
+        last_id = max(last_id, r[0])
+        msgs.append({
+            'id': r[0],
+            'content': r[1] if not r[4] else '',
+            'created_at': str(r[2]),
+            'username': r[3],
+            'is_removed': bool(r[4])
+        })
+    if last_in and not before_id.isdigit():
+        mark_read(cur, schema, uid, f"dm:{other_id}", last_in)
+    data = {'messages': msgs, 'cursor': {'last_id': last_id, 'rev': last_rev}, 'has_more': full}
+    if busy:
+        data['retry_after'] = LONG_POLL_BUSY_RETRY_SEC
+    return 200, data, tag
+
+def read_unread_summary(cur, schema, user, params, seen):
+    if not user: return 401, {'error': 'Необходима авторизация'}, None
+    uid = user[0]
+    cur.execute(
+        f"SELECT dm.sender_id, u.username, COUNT(*), MAX(dm.id) FROM {schema}.direct_messages dm "
+        f"JOIN {schema}.users u ON u.id=dm.sender_id "
+        f"LEFT JOIN {schema}.read_markers rm ON rm.user_id={uid} AND rm.scope='dm:'||dm.sender_id "
+        f"WHERE dm.receiver_id={uid} AND dm.is_removed=FALSE AND dm.id>COALESCE(rm.last_read_id,0) "
+        f"GROUP BY dm.sender_id, u.username"
+    )
+    dms = [{'user_id': r[0], 'username': r[1], 'count': r[2], 'last_id': r[3]} for r in cur.fetchall()]
+    # Каналы и комнаты считаются от отметки прочтения, не больше UNREAD_CAP на каждый
+    channels_arr = ','.join(f"'{c}'" for c in sorted(VALID_CHANNELS))
+    cur.execute(
+        f"SELECT 'ch:'||c.name, x.cnt, x.last_id FROM unnest(ARRAY[{channels_arr}]) AS c(name) "
+        f"JOIN {schema}.read_markers r ON r.user_id={uid} AND r.scope='ch:'||c.name "
+        f"CROSS JOIN LATERAL (SELECT COUNT(*) AS cnt, MAX(q.id) AS last_id FROM ("
+        f"SELECT m.id FROM {schema}.messages m WHERE m.channel=c.name AND m.room_id IS NULL "
+        f"AND m.id>r.last_read_id AND m.is_removed=FALSE AND m.user_id<>{uid} LIMIT {UNREAD_CAP}) q) x "
+        f"UNION ALL "
+        f"SELECT 'room:'||rm.room_id, x.cnt, x.last_id FROM {schema}.room_members rm "
+        f"JOIN {schema}.read_markers r ON r.user_id={uid} AND r.scope='room:'||rm.room_id "
+        f"CROSS JOIN LATERAL (SELECT COUNT(*) AS cnt, MAX(q.id) AS last_id FROM ("
+        f"SELECT m.id FROM {schema}.messages m WHERE m.room_id=rm.room_id "
+        f"AND m.id>r.last_read_id AND m.is_removed=FALSE AND m.user_id<>{uid} LIMIT {UNREAD_CAP}) q) x "
+        f"WHERE rm.user_id={uid}"
+    )
+    channels, rooms = {}, {}
+    for scope_name, cnt, last_id in cur.fetchall():
+        if not cnt: continue
+        kind, key = scope_name.split(':', 1)
+        if kind == 'ch': channels[key] = {'count': cnt, 'last_id': last_id}
+        else: rooms[key] = {'count': cnt, 'last_id': last_id}
+    return 200, {'dm': dms, 'dm_total': sum(d['count'] for d in dms), 'channels': channels, 'rooms': rooms}, None
+
+READ_ACTIONS = {
+    'messages': read_messages,
+    'rooms': read_rooms,
+    'online': read_online,
+    'friends': read_friends,
+    'dm': read_dm,
+    'unread_summary': read_unread_summary,
+}
+
+# ─── REQUEST ─────────────────────────────────────────────────
+
+class Request:
+    """Разобранный вызов: параметры, тело, курсор и ответы (commit и возврат соединения в пул)"""
+
+    def __init__(self, event, conn):
+        headers = event.get('headers') or {}
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.action = self.params.get('action', 'messages')
+        self.ip = (event.get('requestContext') or {}).get('identity', {}).get('sourceIp', 'unknown')
+        self.token = headers.get('X-Authorization', '').replace('Bearer ', '').strip()
+        inm = next((v for k, v in headers.items() if k.lower() == 'if-none-match'), '')
+        self.seen_tags = {t.strip() for t in inm.split(',') if t.strip()}
+        self.schema = os.environ['MAIN_DB_SCHEMA']
+        self.body = json.loads(event.get('body') or '{}')
+        self.conn = conn
+        self.cur = conn.cursor()
+
+    def _finish(self):
+        db.flush_logs(self.cur, self.schema)
+        self.conn.commit(); self.cur.close(); db.putconn(self.conn)
+
+    def resp(self, code, data, headers=None):
+        self._finish()
+        return {'statusCode': code, 'headers': {**CH, **(headers or {})}, 'body': json.dumps(data, default=str)}
+
+    def not_modified(self, tag):
+        self._finish()
+        return {'statusCode': 304, 'headers': {**CH, **cache_headers(tag)}, 'body': ''}
+
+    def err(self, code, msg):
+        return self.resp(code, {'error': msg})
+
+# ─── BATCH ───────────────────────────────────────────────
+# Несколько чтений за один вызов: одно соединение и один get_user.
+# {"requests": {"<ключ>": {"action": "rooms", <параметры>, "etag": "<прошлый ETag>"}}}
+# Каждое выполняется в своём savepoint — ошибка одного не мешает остальным
+
+def batch(rq):
+    cur, schema, body, token, ip = rq.cur, rq.schema, rq.body, rq.token, rq.ip
+    subs = body.get('requests')
+    if not isinstance(subs, dict) or not subs: return rq.err(400, 'Укажи requests')
+    if len(subs) > BATCH_MAX: return rq.err(400, f'Не больше {BATCH_MAX} запросов')
+    user = get_user(cur, schema, token)
+    results = {}
+    for key, sub in subs.items():
+        sub = {k: str(v) for k, v in sub.items()} if isinstance(sub, dict) else {}
+        fn = READ_ACTIONS.get(sub.get('action'))
+        if not fn:
+            results[key] = {'status': 400, 'body': {'error': 'Неизвестное действие'}}
+            continue
+        sub.pop('wait', None)  # long-poll в пачке не держим
+        seen = {sub.pop('etag')} if sub.get('etag') else set()
+        cur.execute('SAVEPOINT batch_item')
+        try:
+            code, data, tag = fn(cur, schema, user, sub, seen)
+            cur.execute('RELEASE SAVEPOINT batch_item')
+        except Exception as e:
+            cur.execute('ROLLBACK TO SAVEPOINT batch_item')
+            db.log_event('error', 'batch', f"{sub['action']} failed", details=str(e)[:500], ip=ip, user_id=user[0] if user else None)
+            results[key] = {'status': 500, 'body': {'error': 'Внутренняя ошибка'}}
+            continue
+        results[key] = {'status': code, 'body': data, **({'etag': tag} if tag else {})}
+    return rq.resp(200, {'results': results})
+
+# ─── MESSAGES ────────────────────────────────────────────
+
+def send_message(rq):
+    cur, schema, body, token, ip = rq.cur, rq.schema, rq.body, rq.token, rq.ip
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid, uname, fav_game, is_banned, is_admin, avatar_url, badge = user
+
+    if db.rate_limit(cur, schema, f'msg:{uid}', 5, 10):
+        db.log_event('warn', 'messages', 'Spam', ip=ip, user_id=uid)
+        return rq.err(429, 'Слишком быстро. Подожди немного.')
+
+    content = sanitize(body.get('content') or '')
+    image_url = body.get('image_url') or ''
+    channel = body.get('channel', 'general')
+    room_id_str = str(body.get('room_id', ''))
+
+    if not content and not image_url: return rq.err(400, 'Сообщение пустое')
+    if len(content) > 2000: return rq.err(400, 'Максимум 2000 символов')
+
+    if room_id_str.isdigit():
+        room_id = int(room_id_str)
+        cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={uid}")
+        if not cur.fetchone(): return rq.err(403, 'Ты не участник этой комнаты')
+        img_hash = ref_image(cur, schema, image_url)
+        cur.execute(f"INSERT INTO {schema}.messages(user_id,room_id,content,image_url,image_hash) VALUES({uid},{room_id},%s,%s,%s) RETURNING id,created_at", (content, image_url or None, img_hash))
+    else:
+        if channel not in VALID_CHANNELS: channel = 'general'
+        img_hash = ref_image(cur, schema, image_url)
+        cur.execute(f"INSERT INTO {schema}.messages(user_id,channel,content,image_url,image_hash) VALUES({uid},%s,%s,%s,%s) RETURNING id,created_at", (channel, content, image_url or None, img_hash))
+
+    msg_id, created_at = cur.fetchone()
+    db.notify(cur, schema, f"room:{room_id}" if room_id_str.isdigit() else f"ch:{channel}")
+    return rq.resp(200, {'success': True, 'message': {
+        'id': msg_id, 'content': content, 'created_at': str(created_at),
+        'username': uname, 'favorite_game': fav_game or '',
+        'is_removed': False, 'author_id': uid, 'edited': False,
+        'avatar_url': avatar_url or '',
+        'badge': badge or '',
+        'image_url': image_url,
+        'reactions': []
+    }})
+
+# ─── DELETE MESSAGE ───────────────────────────────────────
+
+def delete_message(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid, uname, _, _, is_admin, *_ = user
+    msg_id = int(body.get('msg_id', 0))
+    if not msg_id: return rq.err(400, 'Укажи msg_id')
+    cur.execute(f"SELECT user_id FROM {schema}.messages WHERE id={msg_id}")
+    row = cur.fetchone()
+    if not row: return rq.err(404, 'Сообщение не найдено')
+    if row[0] != uid and not is_admin: return rq.err(403, 'Нет прав')
+    cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE,rev=nextval('{schema}.messages_rev_seq') WHERE id={msg_id}")
+    notify_message(cur, schema, msg_id)
+    return rq.resp(200, {'ok': True})
+
+# ─── REACTIONS ────────────────────────────────────────────
+
+def react(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+    msg_id = int(body.get('msg_id', 0))
+    emoji = body.get('emoji', '')
+    if emoji not in VALID_EMOJI: return rq.err(400, 'Недопустимый эмодзи')
+    if not msg_id: return rq.err(400, 'Укажи msg_id')
+    # Переключение реакции, счётчик и ревизия сообщения — одним запросом
+    cur.execute(
+        f"WITH t AS ("
+        f"INSERT INTO {schema}.message_reactions AS mr(message_id,user_id,emoji,is_active) VALUES({msg_id},{uid},%s,TRUE) "
+        f"ON CONFLICT(message_id,user_id,emoji) DO UPDATE SET is_active=NOT mr.is_active RETURNING is_active"
+        f"), c AS ("
+        f"INSERT INTO {schema}.message_reaction_counts AS rc(message_id,emoji,count) "
+        f"SELECT {msg_id},%s,CASE WHEN t.is_active THEN 1 ELSE -1 END FROM t "
+        f"ON CONFLICT(message_id,emoji) DO UPDATE SET count=GREATEST(rc.count+EXCLUDED.count,0) "
+        f"RETURNING count"
+        f"), r AS ("
+        f"UPDATE {schema}.messages SET rev=nextval('{schema}.messages_rev_seq') WHERE id={msg_id} RETURNING id"
+        f") SELECT t.is_active, c.count FROM t, c",
+        (emoji, emoji)
+    )
+    added, cnt = cur.fetchone()
+    notify_message(cur, schema, msg_id)
+    return rq.resp(200, {'ok': True, 'added': added, 'count': cnt, 'reacted_by_me': added})
+
+# ─── ROOMS ───────────────────────────────────────────────
+
+def create_room(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid, uname, _, _, is_admin, *_ = user
+
+    if db.rate_limit(cur, schema, f'rooms:{uid}', 3, 3600): return rq.err(429, 'Лимит: 3 комнаты в час')
+
+    name = sanitize(body.get('name') or '')
+    description = sanitize(body.get('description') or '')
+    is_public = bool(body.get('is_public', True))
+
+    if len(name) < 2 or len(name) > 32: return rq.err(400, 'Название: 2–32 символа')
+
+    cur.execute(f"INSERT INTO {schema}.rooms(name,description,owner_id,is_public) VALUES(%s,%s,{uid},%s) RETURNING id,created_at", (name, description, is_public))
+    room_id, created_at = cur.fetchone()
+    add_room_member(cur, schema, room_id, uid)
+    code = secrets.token_urlsafe(8)
+    cur.execute(f"INSERT INTO {schema}.invites(code,room_id,created_by) VALUES(%s,{room_id},{uid})", (code,))
+    bump(cur, schema, 'rooms')
+    return rq.resp(201, {'room':{'id':room_id,'name':name,'description':description,'is_public':is_public,'created_at':str(created_at),'invite_code':code}})
+
+def join_room(rq):
+    cur, schema, params, token = rq.cur, rq.schema, rq.params, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid, uname, *_ = user
+
+    code = params.get('code', '')
+    if not code: return rq.err(400, 'Укажи код инвайта')
+
+    cur.execute(f"SELECT i.room_id,i.uses,i.max_uses,i.expires_at,r.name FROM {schema}.invites i JOIN {schema}.rooms r ON r.id=i.room_id WHERE i.code=%s", (code,))
+    inv = cur.fetchone()
+    if not inv: return rq.err(404, 'Инвайт не найден')
+
+    room_id, uses, max_uses, expires_at, room_name = inv
+    if max_uses and uses >= max_uses: return rq.err(410, 'Инвайт исчерпан')
+    if expires_at:
+        cur.execute("SELECT now() > %s", (expires_at,))
+        if cur.fetchone()[0]: return rq.err(410, 'Инвайт истёк')
+
+    already = not add_room_member(cur, schema, room_id, uid)
+    if not already:
+        cur.execute(f"UPDATE {schema}.invites SET uses=uses+1 WHERE code=%s", (code,))
+        bump(cur, schema, 'rooms')
+    return rq.resp(200, {'ok':True,'room_id':room_id,'room_name':room_name,'already_member':already})
+
+def create_invite(rq):
+    cur, schema, params, token = rq.cur, rq.schema, rq.params, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid, uname, _, _, is_admin, *_ = user
+
+    rid = params.get('room_id', '')
+    if not str(rid).isdigit(): return rq.err(400, 'Укажи room_id')
+    rid = int(rid)
+    cur.execute(f"SELECT owner_id FROM {schema}.rooms WHERE id={rid}")
+    room = cur.fetchone()
+    if not room: return rq.err(404, 'Комната не найдена')
+    if room[0] != uid and not is_admin: return rq.err(403, 'Только владелец')
+
+    code = secrets.token_urlsafe(8)
+    cur.execute(f"INSERT INTO {schema}.invites(code,room_id,created_by) VALUES(%s,{rid},{uid})", (code,))
+    return rq.resp(201, {'invite_code': code})
+
+# ─── INVITE FRIEND TO ROOM ────────────────────────────────
+
+def invite_friend(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid, uname, _, _, is_admin, *_ = user
+
+    room_id = int(body.get('room_id', 0))
+    friend_id = int(body.get('friend_id', 0))
+    if not room_id or not friend_id: return rq.err(400, 'Укажи room_id и friend_id')
+
+    cur.execute(f"SELECT 1 FROM {schema}.room_members WHERE room_id={room_id} AND user_id={uid}")
+    if not cur.fetchone(): return rq.err(403, 'Ты не участник этой комнаты')
+
+    if not is_friend(cur, schema, uid, friend_id): return rq.err(403, 'Не друзья')
+
+    already = not add_room_member(cur, schema, room_id, friend_id)
+    if not already:
+        bump(cur, schema, 'rooms')
+
+    return rq.resp(200, {'ok': True, 'already_member': already})
+
+# ─── EDIT MESSAGE ─────────────────────────────────────────
+
+def edit_message(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+    msg_id = int(body.get('msg_id', 0))
+    content = sanitize(body.get('content') or '')
+    if not msg_id: return rq.err(400, 'Укажи msg_id')
+    if not content: return rq.err(400, 'Пустое сообщение')
+    if len(content) > 2000: return rq.err(400, 'Максимум 2000 символов')
+    cur.execute(f"SELECT user_id FROM {schema}.messages WHERE id={msg_id} AND is_removed=FALSE")
+    row = cur.fetchone()
+    if not row: return rq.err(404, 'Сообщение не найдено')
+    if row[0] != uid: return rq.err(403, 'Нет прав')
+    cur.execute(f"UPDATE {schema}.messages SET content=%s, edited=TRUE, rev=nextval('{schema}.messages_rev_seq') WHERE id={msg_id}", (content,))
+    notify_message(cur, schema, msg_id)
+    return rq.resp(200, {'ok': True, 'content': content})
+
+# ─── PROFILE ─────────────────────────────────────────────
+
+def get_profile(rq):
+    cur, schema, params = rq.cur, rq.schema, rq.params
+    target_username = params.get('username', '')
+    if not target_username: return rq.err(400, 'Укажи username')
+    db.query(
+        cur, 'profile',
+        f"SELECT u.id,u.username,u.favorite_game,u.avatar_url,u.created_at,ao.variants FROM {schema}.users u "
+        f"LEFT JOIN {schema}.image_objects ao ON ao.hash=u.avatar_hash "
+        f"WHERE u.username=%s AND u.is_banned=FALSE",
+        (target_username,)
+    )
+    row = cur.fetchone()
+    if not row: return rq.err(404, 'Пользователь не найден')
+    uid2, uname2, fav2, avatar2, created2, avatar_variants2 = row
+    cur.execute(f"SELECT COUNT(*) FROM {schema}.messages WHERE user_id={uid2} AND is_removed=FALSE")
+    msg_count = cur.fetchone()[0]
+    return rq.resp(200, {'id': uid2, 'username': uname2, 'favorite_game': fav2 or '', 'avatar_url': avatar2 or '', 'avatar_variants': avatar_variants2 or {}, 'created_at': str(created2), 'message_count': msg_count})
+
+# ─── AVATAR UPLOAD ────────────────────────────────────────
+
+def upload_avatar(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    import storage
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+    data_url = body.get('image', '')
+    if not data_url: return rq.err(400, 'Нет изображения')
+    if ',' not in data_url: return rq.err(400, 'Неверный формат')
+    header, b64data = data_url.split(',', 1)
+    if 'image/jpeg' in header or 'image/jpg' in header:
+        ext, ct = 'jpg', 'image/jpeg'
+    elif 'image/png' in header:
+        ext, ct = 'png', 'image/png'
+    elif 'image/webp' in header:
+        ext, ct = 'webp', 'image/webp'
+    else:
+        return rq.err(400, 'Допустимы только JPG, PNG, WebP')
+    img_bytes = base64.b64decode(b64data)
+    if len(img_bytes) > 2 * 1024 * 1024: return rq.err(400, 'Файл больше 2MB')
+    sha = hashlib.sha256(img_bytes).hexdigest()
+    url = find_image(cur, schema, sha, 'avatar')
+    if not url:
+        key = image_key(sha, ext)
+        storage.client().put_object(Bucket=storage.S3_BUCKET, Key=key, Body=img_bytes, ContentType=ct)
+        url = save_image(cur, schema, sha, key, ct, len(img_bytes), 'avatar')
+    return rq.resp(200, upload_result(cur, schema, uid, 'avatar', url, sha))
+
+# ─── IMAGE UPLOAD ────────────────────────────────────────
+
+def upload_image(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    import storage
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+    data_url = body.get('image', '')
+    if not data_url: return rq.err(400, 'Нет изображения')
+    if ',' not in data_url: return rq.err(400, 'Неверный формат')
+    header, b64data = data_url.split(',', 1)
+    if 'image/jpeg' in header or 'image/jpg' in header:
+        ext, ct = 'jpg', 'image/jpeg'
+    elif 'image/png' in header:
+        ext, ct = 'png', 'image/png'
+    elif 'image/webp' in header:
+        ext, ct = 'webp', 'image/webp'
+    elif 'image/gif' in header:
+        ext, ct = 'gif', 'image/gif'
+    else:
+        return rq.err(400, 'Допустимы только JPG, PNG, WebP, GIF')
+    img_bytes = base64.b64decode(b64data)
+    if len(img_bytes) > 8 * 1024 * 1024: return rq.err(400, 'Файл больше 8MB')
+    sha = hashlib.sha256(img_bytes).hexdigest()
+    url = find_image(cur, schema, sha, 'image')
+    if not url:
+        key = image_key(sha, ext)
+        storage.client().put_object(Bucket=storage.S3_BUCKET, Key=key, Body=img_bytes, ContentType=ct)
+        url = save_image(cur, schema, sha, key, ct, len(img_bytes), 'image')
+    return rq.resp(200, upload_result(cur, schema, uid, 'image', url, sha))
+
+# ─── DIRECT UPLOAD ───────────────────────────────────────
+# Браузер грузит файл прямо в хранилище по presigned POST, функция байты не видит.
+# upload_image / upload_avatar с base64 в теле оставлены для старых клиентов
+
+def upload_url(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    import storage
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+    kind = body.get('kind', '')
+    if kind not in UPLOAD_KINDS: return rq.err(400, 'Неизвестный тип загрузки')
+    _, max_bytes, types = UPLOAD_KINDS[kind]
+    ct = body.get('content_type', '')
+    if ct not in types: return rq.err(400, 'Недопустимый формат файла')
+    size = int(body.get('size') or 0)
+    if size <= 0 or size > max_bytes: return rq.err(400, f'Файл больше {max_bytes // (1024 * 1024)}MB')
+    sha = str(body.get('sha256', '')).lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', sha): return rq.err(400, 'Укажи sha256 файла')
+    # Такой файл уже есть — загружать нечего
+    url = find_image(cur, schema, sha, kind)
+    if url:
+        return rq.resp(200, upload_result(cur, schema, uid, kind, url, sha))
+    if db.rate_limit(cur, schema, f'upload:{uid}', 20, 60): return rq.err(429, 'Слишком много загрузок')
+    key = staging_key(uid, types[ct])
+    # Политика фиксирует размер, тип и контрольную сумму; confirm_upload дополнительно требует,
+    # чтобы хранилище вернуло эту сумму в HEAD
+    checksum = base64.b64encode(bytes.fromhex(sha)).decode()
+    post = storage.client().generate_presigned_post(
+        storage.S3_BUCKET, key,
+        Fields={'Content-Type': ct, 'x-amz-checksum-algorithm': 'SHA256', 'x-amz-checksum-sha256': checksum},
+        Conditions=[{'Content-Type': ct}, {'x-amz-checksum-algorithm': 'SHA256'}, {'x-amz-checksum-sha256': checksum},
+                    ['content-length-range', 1, max_bytes]],
+        ExpiresIn=UPLOAD_URL_TTL_SEC,
+    )
+    cur.execute(f"INSERT INTO {schema}.uploads(user_id,kind,key,content_type,sha256) VALUES({uid},%s,%s,%s,%s) RETURNING id", (kind, key, ct, sha))
+    upload_id = cur.fetchone()[0]
+    return rq.resp(200, {'upload_id': upload_id, 'url': post['url'], 'fields': post['fields'], 'expires_in': UPLOAD_URL_TTL_SEC})
+
+def confirm_upload(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    import storage
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+    upload_id = int(body.get('upload_id') or 0)
+    cur.execute(
+        f"SELECT kind, key, content_type, sha256 FROM {schema}.uploads "
+        f"WHERE id={upload_id} AND user_id={uid} AND confirmed_at IS NULL "
+        f"AND created_at > now() - interval '{UPLOAD_URL_TTL_SEC * 2} seconds'"
+    )
+    row = cur.fetchone()
+    if not row: return rq.err(404, 'Загрузка не найдена')
+    kind, key, ct, sha = row
+    s3 = storage.client()
+    try:
+        head = s3.head_object(Bucket=storage.S3_BUCKET, Key=key, ChecksumMode='ENABLED')
+    except Exception:
+        return rq.err(409, 'Файл ещё не загружен')
+    size = head.get('ContentLength', 0)
+    checksum = head.get('ChecksumSHA256')
+    # Без суммы от хранилища файл не принимается: байты через функцию не гоняем, заявленному sha256 не верим
+    ok = (size <= UPLOAD_KINDS[kind][1] and head.get('ContentType') == ct
+          and checksum == base64.b64encode(bytes.fromhex(sha)).decode())
+    cur.execute(f"UPDATE {schema}.uploads SET confirmed_at=now() WHERE id=%s", (upload_id,))
+    if not ok:
+        s3.delete_object(Bucket=storage.S3_BUCKET, Key=key)
+        return rq.err(400, 'Файл не прошёл проверку')
+    url = find_image(cur, schema, sha, kind)
+    if not url:
+        final = image_key(sha, UPLOAD_KINDS[kind][2][ct])
+        s3.copy_object(Bucket=storage.S3_BUCKET, Key=final, CopySource={'Bucket': storage.S3_BUCKET, 'Key': key},
+                       ContentType=ct, MetadataDirective='REPLACE')
+        url = save_image(cur, schema, sha, final, ct, size, kind)
+    s3.delete_object(Bucket=storage.S3_BUCKET, Key=key)
+    return rq.resp(200, upload_result(cur, schema, uid, kind, url, sha))
+
+# ─── SETTINGS ────────────────────────────────────────────
+
+def settings(rq):
+    cur, schema, body, token, method = rq.cur, rq.schema, rq.body, rq.token, rq.method
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid, uname, fav_game, *_ = user
+
+    if method == 'GET':
+        cur.execute(f"SELECT username, favorite_game, email, avatar_url FROM {schema}.users WHERE id={uid}")
+        row = cur.fetchone()
+        if not row: return rq.err(404, 'Пользователь не найден')
+        return rq.resp(200, {'username': row[0], 'favorite_game': row[1] or '', 'email': row[2], 'avatar_url': row[3] or ''})
+
+    if method == 'POST':
+        new_game = sanitize(body.get('favorite_game') or '')
+        new_username = sanitize(body.get('username') or '')
+        if new_username and (len(new_username) < 2 or len(new_username) > 32):
+            return rq.err(400, 'Никнейм: 2–32 символа')
+        if new_username and new_username != uname:
+            cur.execute(f"SELECT id FROM {schema}.users WHERE username=%s AND id!={uid}", (new_username,))
+            if cur.fetchone(): return rq.err(409, 'Никнейм занят')
+            cur.execute(f"UPDATE {schema}.users SET username=%s WHERE id={uid}", (new_username,))
+        if new_game is not None:
+            cur.execute(f"UPDATE {schema}.users SET favorite_game=%s WHERE id={uid}", (new_game,))
+        bump(cur, schema, 'profiles')
+        invalidate_user(uid)
+        cur.execute(f"SELECT username, favorite_game, avatar_url FROM {schema}.users WHERE id={uid}")
+        row = cur.fetchone()
+        return rq.resp(200, {'ok': True, 'username': row[0], 'favorite_game': row[1] or '', 'avatar_url': row[2] or ''})
+    return rq.err(404, 'Not found')
+
+# ─── ADMIN ───────────────────────────────────────────────
+
+def admin_stats(rq):
+    cur, schema, token = rq.cur, rq.schema, rq.token
+    user = get_user(cur, schema, token, require_admin=True)
+    if not user: return rq.err(403, 'Доступ запрещён')
+    # Счётчики пересчитывает backend/maintenance в stats_snapshot; здесь — чтение одной строки
+    if time.monotonic() - _stats_cache['at'] > STATS_CACHE_SEC:
+        cur.execute(f"SELECT data, refreshed_at FROM {schema}.stats_snapshot WHERE id=1")
+        row = cur.fetchone()
+        _stats_cache.update(at=time.monotonic(), data={'stats': row[0] if row else {}, 'as_of': str(row[1]) if row else None})
+    return rq.resp(200, {**_stats_cache['data'], 'session_cache': session_cache_stats()})
+
+def admin_logs(rq):
+    cur, schema, params, token = rq.cur, rq.schema, rq.params, rq.token
+    user = get_user(cur, schema, token, require_admin=True)
+    if not user: return rq.err(403, 'Доступ запрещён')
+    limit = min(int(params.get('limit', 50)), 200)
+    level = params.get('level', '')
+    lf = "AND level=%s" if level else ''
+    kf, kargs = keyset_filter(params)
+    args = ((level,) if level else ()) + kargs
+    cur.execute(f"SELECT id,level,source,message,details,ip,user_id,created_at,repeat_count FROM {schema}.error_logs WHERE 1=1 {lf}{kf} ORDER BY created_at DESC, id DESC LIMIT {limit + 1}",
+                args or None)
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = {'before_ts': str(rows[-1][7]), 'before_id': rows[-1][0]} if has_more else None
+    return rq.resp(200, {'logs':[{'id':r[0],'level':r[1],'source':r[2],'message':r[3],'details':r[4],'ip':r[5],'user_id':r[6],'created_at':str(r[7]),'repeat_count':r[8]} for r in rows],
+                      'next_cursor': next_cursor})
+
+def admin_users(rq):
+    cur, schema, params, token = rq.cur, rq.schema, rq.params, rq.token
+    user = get_user(cur, schema, token, require_admin=True)
+    if not user: return rq.err(403, 'Доступ запрещён')
+    limit = min(int(params.get('limit', 50)), 200)
+    q = params.get('q', '').strip().lower()
+    # Выражение совпадает с users_search_trgm_idx; от 3 символов поиск идёт по индексу
+    pattern = '%' + re.sub(r'([\\%_])', r'\\\1', q) + '%'
+    sf = "AND (lower(username) || ' ' || lower(email)) LIKE %s" if q else ''
+    kf, kargs = keyset_filter(params)
+    args = ((pattern,) if q else ()) + kargs
+    cur.execute(f"SELECT id,username,email,favorite_game,is_admin,is_banned,created_at FROM {schema}.users WHERE 1=1 {sf}{kf} ORDER BY created_at DESC, id DESC LIMIT {limit + 1}",
+                args or None)
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = {'before_ts': str(rows[-1][6]), 'before_id': rows[-1][0]} if has_more else None
+    return rq.resp(200, {'users':[{'id':r[0],'username':r[1],'email':r[2],'favorite_game':r[3],'is_admin':r[4],'is_banned':r[5],'created_at':str(r[6])} for r in rows],
+                      'next_cursor': next_cursor})
+
+def admin_ban(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token, require_admin=True)
+    if not user: return rq.err(403, 'Доступ запрещён')
+    uid_admin = user[0]
+    target_id = body.get('user_id')
+    ban = bool(body.get('ban', True))
+    if not target_id: return rq.err(400, 'Укажи user_id')
+
+    cur.execute(f"SELECT id,is_admin FROM {schema}.users WHERE id={int(target_id)}")
+    target = cur.fetchone()
+    if not target: return rq.err(404, 'Пользователь не найден')
+    if target[1]: return rq.err(403, 'Нельзя банить администратора')
+
+    action_val = 'TRUE' if ban else 'FALSE'
+    cur.execute(f"UPDATE {schema}.users SET is_banned={action_val} WHERE id={int(target_id)}")
+    bump(cur, schema, 'bans')
+    invalidate_user(int(target_id))
+    invalidate_friends(int(target_id))
+    if ban:
+        cur.execute(f"SELECT COUNT(*) FROM {schema}.sessions WHERE user_id={int(target_id)}")
+    db.log_event('info', 'admin', f"{'Ban' if ban else 'Unban'} user {target_id}", user_id=uid_admin, urgent=True)
+    return rq.resp(200, {'ok':True,'banned':ban})
+
+def admin_messages(rq):
+    cur, schema, params, token = rq.cur, rq.schema, rq.params, rq.token
+    user = get_user(cur, schema, token, require_admin=True)
+    if not user: return rq.err(403, 'Доступ запрещён')
+    channel = params.get('channel', 'general')
+    room_id_str = params.get('room_id', '')
+    limit = min(int(params.get('limit', 50)), 200)
+    if room_id_str and str(room_id_str).isdigit():
+        room_id = int(room_id_str)
+        cur.execute(
+            f"SELECT m.id,m.content,m.created_at,u.username,m.is_removed,m.room_id,NULL as channel "
+            f"FROM {schema}.messages m JOIN {schema}.users u ON u.id=m.user_id "
+            f"WHERE m.room_id={room_id} ORDER BY m.created_at DESC LIMIT {limit}"
+        )
+    else:
+        cur.execute(
+            f"SELECT m.id,m.content,m.created_at,u.username,m.is_removed,m.room_id,m.channel "
+            f"FROM {schema}.messages m JOIN {schema}.users u ON u.id=m.user_id "
+            f"WHERE m.channel=%s AND m.room_id IS NULL ORDER BY m.created_at DESC LIMIT {limit}",
+            (channel,)
+        )
+    rows = cur.fetchall()
+    msgs = [{'id':r[0],'content':r[1],'created_at':str(r[2]),'username':r[3],'is_removed':r[4],'room_id':r[5],'channel':r[6]} for r in rows]
+    return rq.resp(200, {'messages': msgs})
+
+def admin_clear(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token, require_admin=True)
+    if not user: return rq.err(403, 'Доступ запрещён')
+    uid_admin = user[0]
+    channel = body.get('channel', '')
+    room_id = body.get('room_id')
+    msg_id = body.get('msg_id')
+    if msg_id:
+        cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE,rev=nextval('{schema}.messages_rev_seq') WHERE id={int(msg_id)}")
+        count = cur.rowcount
+        notify_message(cur, schema, int(msg_id))
+        db.log_event('info', 'admin', f"Deleted msg {msg_id}", user_id=uid_admin, urgent=True)
+        return rq.resp(200, {'ok':True,'deleted':count})
+    elif room_id:
+        cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE,rev=nextval('{schema}.messages_rev_seq') WHERE room_id={int(room_id)} AND is_removed=FALSE")
+        count = cur.rowcount
+        db.notify(cur, schema, f"room:{int(room_id)}")
+        db.log_event('info', 'admin', f"Cleared room {room_id} ({count} msgs)", user_id=uid_admin, urgent=True)
+        return rq.resp(200, {'ok':True,'deleted':count})
+    elif channel:
+        if channel not in VALID_CHANNELS: return rq.err(400, 'Неверный канал')
+        cur.execute(f"UPDATE {schema}.messages SET is_removed=TRUE,rev=nextval('{schema}.messages_rev_seq') WHERE channel=%s AND room_id IS NULL AND is_removed=FALSE", (channel,))
+        count = cur.rowcount
+        db.notify(cur, schema, f"ch:{channel}")
+        db.log_event('info', 'admin', f"Cleared channel #{channel} ({count} msgs)", user_id=uid_admin, urgent=True)
+        return rq.resp(200, {'ok':True,'deleted':count})
+    else:
+        return rq.err(400, 'Укажи channel, room_id или msg_id')
+
+def admin_set_badge(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token, require_admin=True)
+    if not user: return rq.err(403, 'Доступ запрещён')
+    uid_admin = user[0]
+    target_id = body.get('user_id')
+    badge = (body.get('badge') or '').strip()
+    if not target_id: return rq.err(400, 'Укажи user_id')
+    if len(badge) > 64: return rq.err(400, 'Тег слишком длинный (макс. 64 символа)')
+    cur.execute(f"UPDATE {schema}.users SET badge=%s WHERE id={int(target_id)}", (badge or None,))
+    bump(cur, schema, 'profiles')
+    invalidate_user(int(target_id))
+    db.log_event('info', 'admin', f"Set badge '{badge}' for user {target_id}", user_id=uid_admin, urgent=True)
+    return rq.resp(200, {'ok': True, 'badge': badge})
+
+# ─── FRIENDS ─────────────────────────────────────────────
+
+def update_friends(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+
+    sub = body.get('sub', '')
+    if sub == 'send':
+        to_username = sanitize(body.get('username') or '')
+        if not to_username: return rq.err(400, 'Укажи username')
+        cur.execute(f"SELECT id FROM {schema}.users WHERE username=%s AND is_banned=FALSE", (to_username,))
+        row = cur.fetchone()
+        if not row: return rq.err(404, 'Пользователь не найден')
+        to_id = row[0]
+        if to_id == uid: return rq.err(400, 'Нельзя добавить себя')
+        cur.execute(f"SELECT id,status FROM {schema}.friend_requests WHERE (from_user_id={uid} AND to_user_id={to_id}) OR (from_user_id={to_id} AND to_user_id={uid})")
+        existing = cur.fetchone()
+        if existing:
+            if existing[1] == 'accepted': return rq.err(409, 'Уже друзья')
+            if existing[1] == 'pending': return rq.err(409, 'Запрос уже отправлен')
+        cur.execute(f"INSERT INTO {schema}.friend_requests(from_user_id,to_user_id,status) VALUES({uid},{to_id},'pending')")
+        bump(cur, schema, f'friends:{uid}', f'friends:{to_id}')
+        return rq.resp(200, {'ok': True})
+
+    if sub == 'accept':
+        req_id = int(body.get('request_id', 0))
+        cur.execute(f"SELECT from_user_id FROM {schema}.friend_requests WHERE id={req_id} AND to_user_id={uid} AND status='pending'")
+        row = cur.fetchone()
+        if not row: return rq.err(404, 'Запрос не найден')
+        cur.execute(f"UPDATE {schema}.friend_requests SET status='accepted' WHERE id={req_id}")
+        cur.execute(
+            f"INSERT INTO {schema}.friendships(user_lo,user_hi) VALUES({min(uid, row[0])},{max(uid, row[0])}) "
+            f"ON CONFLICT DO NOTHING"
+        )
+        invalidate_friends(uid, row[0])
+        bump(cur, schema, f'friends:{uid}', f'friends:{row[0]}')
+        return rq.resp(200, {'ok': True})
 
-    # ─── FRIENDS ─────────────────────────────────────────────
+    if sub == 'decline':
+        req_id = int(body.get('request_id', 0))
+        cur.execute(f"UPDATE {schema}.friend_requests SET status='declined' WHERE id={req_id} AND to_user_id={uid} RETURNING from_user_id")
+        row = cur.fetchone()
+        if row:
+            # Отклонение уже принятого запроса разрывает дружбу
+            cur.execute(f"DELETE FROM {schema}.friendships WHERE user_lo={min(uid, row[0])} AND user_hi={max(uid, row[0])}")
+            invalidate_friends(uid, row[0])
+            bump(cur, schema, f'friends:{uid}', f'friends:{row[0]}')
+        return rq.resp(200, {'ok': True})
+    return rq.err(404, 'Not found')
+
+# ─── DIRECT MESSAGES ─────────────────────────────────────
+
+def send_dm(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+
+    other_id = int(body.get('to', 0))
+    content = sanitize(body.get('content') or '')
+    if not content: return rq.err(400, 'Пустое сообщение')
+    if len(content) > 2000: return rq.err(400, 'Максимум 2000 символов')
+    if db.rate_limit(cur, schema, f'dm:{uid}', 10, 10): return rq.err(429, 'Слишком быстро')
+    if not is_friend(cur, schema, uid, other_id): return rq.err(403, 'Не друзья')
+    cur.execute(f"INSERT INTO {schema}.direct_messages(sender_id,receiver_id,content) VALUES({uid},{other_id},%s) RETURNING id,created_at", (content,))
+    msg_id, created_at = cur.fetchone()
+    bump(cur, schema, dm_topic(uid, other_id))
+    db.notify(cur, schema, dm_topic(uid, other_id))
+    return rq.resp(200, {'ok':True,'message':{'id':msg_id,'content':content,'created_at':str(created_at),'username':user[1],'is_removed':False}})
+
+# ─── DELETE DM ────────────────────────────────────────────
+
+def delete_dm(rq):
+    cur, schema, body, token = rq.cur, rq.schema, rq.body, rq.token
+    user = get_user(cur, schema, token)
+    if not user: return rq.err(401, 'Необходима авторизация')
+    uid = user[0]
+    msg_id = int(body.get('msg_id', 0))
+    if not msg_id: return rq.err(400, 'Укажи msg_id')
+    cur.execute(f"SELECT sender_id, receiver_id FROM {schema}.direct_messages WHERE id={msg_id}")
+    row = cur.fetchone()
+    if not row: return rq.err(404, 'Сообщение не найдено')
+    if row[0] != uid: return rq.err(403, 'Нет прав')
+    cur.execute(f"UPDATE {schema}.direct_messages SET is_removed=TRUE, rev=nextval('{schema}.direct_messages_rev_seq') WHERE id={msg_id}")
+    bump(cur, schema, dm_topic(row[0], row[1]))
+    db.notify(cur, schema, dm_topic(row[0], row[1]))
+    return rq.resp(200, {'ok': True})
+
+# ─── ROUTES ──────────────────────────────────────────────────
+# (action, method) -> обработчик. Чтения из READ_ACTIONS обслуживаются отдельно, перед таблицей
+
+ROUTES = {
+    ('batch', 'POST'): batch,
+    ('messages', 'POST'): send_message,
+    ('delete_msg', 'POST'): delete_message,
+    ('react', 'POST'): react,
+    ('rooms', 'POST'): create_room,
+    ('join', 'POST'): join_room,
+    ('invite', 'POST'): create_invite,
+    ('invite_friend', 'POST'): invite_friend,
+    ('edit_msg', 'POST'): edit_message,
+    ('profile', 'GET'): get_profile,
+    ('upload_avatar', 'POST'): upload_avatar,
+    ('upload_image', 'POST'): upload_image,
+    ('upload_url', 'POST'): upload_url,
+    ('confirm_upload', 'POST'): confirm_upload,
+    ('settings', 'GET'): settings,
+    ('settings', 'POST'): settings,
+    ('admin_stats', 'GET'): admin_stats,
+    ('admin_logs', 'GET'): admin_logs,
+    ('admin_users', 'GET'): admin_users,
+    ('admin_ban', 'POST'): admin_ban,
+    ('admin_messages', 'GET'): admin_messages,
+    ('admin_clear', 'POST'): admin_clear,
+    ('admin_set_badge', 'POST'): admin_set_badge,
+    ('friends', 'POST'): update_friends,
+    ('dm', 'POST'): send_dm,
+    ('delete_dm', 'POST'): delete_dm,
+}
 
-    if action == 'friends':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid = user[0]
+@db.pooled
+def handler(event: dict, context) -> dict:
+    """Единый API: сообщения, реакции, удаление, комнаты, инвайты, друзья, DM, настройки. ?action="""
 
-        if method == 'GET':
-            sub = params.get('sub', 'list')
-            if sub == 'list':
-                cur.execute(
-                    f"SELECT u.id, u.username, u.favorite_game FROM {schema}.friend_requests fr "
-                    f"JOIN {schema}.users u ON u.id = CASE WHEN fr.from_user_id={uid} THEN fr.to_user_id ELSE fr.from_user_id END "
-                    f"WHERE (fr.from_user_id={uid} OR fr.to_user_id={uid}) AND fr.status='accepted' AND u.is_banned=FALSE"
-                )
-                friends = [{'id':r[0],'username':r[1],'favorite_game':r[2] or ''} for r in cur.fetchall()]
-                return resp(200, {'friends': friends})
-            if sub == 'requests':
-                cur.execute(
-                    f"SELECT fr.id, u.id, u.username, u.favorite_game, fr.created_at FROM {schema}.friend_requests fr "
-                    f"JOIN {schema}.users u ON u.id=fr.from_user_id "
-                    f"WHERE fr.to_user_id={uid} AND fr.status='pending' AND u.is_banned=FALSE "
-                    f"ORDER BY fr.created_at DESC"
-                )
-                reqs = [{'request_id':r[0],'user_id':r[1],'username':r[2],'favorite_game':r[3] or '','created_at':str(r[4])} for r in cur.fetchall()]
-                return resp(200, {'requests': reqs})
-
-        if method == 'POST':
-            sub = body.get('sub', '')
-            if sub == 'send':
-                to_username = sanitize(body.get('username') or '').replace("'","''")
-                if not to_username: return err(400, 'Укажи username')
-                cur.execute(f"SELECT id FROM {schema}.users WHERE username='{to_username}' AND is_banned=FALSE")
-                row = cur.fetchone()
-                if not row: return err(404, 'Пользователь не найден')
-                to_id = row[0]
-                if to_id == uid: return err(400, 'Нельзя добавить себя')
-                cur.execute(f"SELECT id,status FROM {schema}.friend_requests WHERE (from_user_id={uid} AND to_user_id={to_id}) OR (from_user_id={to_id} AND to_user_id={uid})")
-                existing = cur.fetchone()
-                if existing:
-                    if existing[1] == 'accepted': return err(409, 'Уже друзья')
-                    if existing[1] == 'pending': return err(409, 'Запрос уже отправлен')
-                cur.execute(f"INSERT INTO {schema}.friend_requests(from_user_id,to_user_id,status) VALUES({uid},{to_id},'pending')")
-                return resp(200, {'ok': True})
-
-            if sub == 'accept':
-                req_id = int(body.get('request_id', 0))
-                cur.execute(f"SELECT id FROM {schema}.friend_requests WHERE id={req_id} AND to_user_id={uid} AND status='pending'")
-                if not cur.fetchone(): return err(404, 'Запрос не найден')
-                cur.execute(f"UPDATE {schema}.friend_requests SET status='accepted' WHERE id={req_id}")
-                return resp(200, {'ok': True})
-
-            if sub == 'decline':
-                req_id = int(body.get('request_id', 0))
-                cur.execute(f"UPDATE {schema}.friend_requests SET status='declined' WHERE id={req_id} AND to_user_id={uid}")
-                return resp(200, {'ok': True})
-
-    # ─── DIRECT MESSAGES ─────────────────────────────────────
-
-    if action == 'dm':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid = user[0]
+    if event.get('httpMethod') == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_H, 'body': ''}
 
-        if method == 'GET':
-            other_id_str = params.get('with', '')
-            if not str(other_id_str).isdigit(): return err(400, 'Укажи with=user_id')
-            other_id = int(other_id_str)
-            cur.execute(
-                f"SELECT 1 FROM {schema}.friend_requests "
-                f"WHERE ((from_user_id={uid} AND to_user_id={other_id}) OR (from_user_id={other_id} AND to_user_id={uid})) "
-                f"AND status='accepted'"
-            )
-            if not cur.fetchone(): return err(403, 'Не друзья')
-            cur.execute(f"UPDATE {schema}.users SET last_seen=now() WHERE id={uid}")
-            cur.execute(
-                f"SELECT dm.id, dm.content, dm.created_at, u.username, dm.is_removed FROM {schema}.direct_messages dm "
-                f"JOIN {schema}.users u ON u.id=dm.sender_id "
-                f"WHERE (dm.sender_id={uid} AND dm.receiver_id={other_id}) OR (dm.sender_id={other_id} AND dm.receiver_id={uid}) "
-                f"ORDER BY dm.created_at ASC LIMIT 100"
-            )
-            msgs = []
-            for r in cur.fetchall():
-                msgs.append({
-                    'id': r[0],
-                    'content': r[1] if not r[4] else '',
-                    'created_at': str(r[2]),
-                    'username': r[3],
-                    'is_removed': bool(r[4])
-                })
-            return resp(200, {'messages': msgs})
-
-        if method == 'POST':
-            other_id = int(body.get('to', 0))
-            content = sanitize(body.get('content') or '')
-            if not content: return err(400, 'Пустое сообщение')
-            if len(content) > 2000: return err(400, 'Максимум 2000 символов')
-            if rate_limit(cur, schema, f'dm:{uid}', 10, 10): return err(429, 'Слишком быстро')
-            cur.execute(
-                f"SELECT 1 FROM {schema}.friend_requests "
-                f"WHERE ((from_user_id={uid} AND to_user_id={other_id}) OR (from_user_id={other_id} AND to_user_id={uid})) "
-                f"AND status='accepted'"
-            )
-            if not cur.fetchone(): return err(403, 'Не друзья')
-            sc = content.replace("'","''")
-            cur.execute(f"INSERT INTO {schema}.direct_messages(sender_id,receiver_id,content) VALUES({uid},{other_id},'{sc}') RETURNING id,created_at")
-            msg_id, created_at = cur.fetchone()
-            return resp(200, {'ok':True,'message':{'id':msg_id,'content':content,'created_at':str(created_at),'username':user[1],'is_removed':False}})
-
-    # ─── DELETE DM ────────────────────────────────────────────
-
-    if action == 'delete_dm' and method == 'POST':
-        user = get_user(cur, schema, token)
-        if not user: return err(401, 'Необходима авторизация')
-        uid = user[0]
-        msg_id = int(body.get('msg_id', 0))
-        if not msg_id: return err(400, 'Укажи msg_id')
-        cur.execute(f"SELECT sender_id FROM {schema}.direct_messages WHERE id={msg_id}")
-        row = cur.fetchone()
-        if not row: return err(404, 'Сообщение не найдено')
-        if row[0] != uid: return err(403, 'Нет прав')
-        cur.execute(f"UPDATE {schema}.direct_messages SET is_removed=TRUE WHERE id={msg_id}")
-        return resp(200, {'ok': True})
+    rq = Request(event, db.getconn())
+
+    if rq.method == 'GET' and rq.action in READ_ACTIONS:
+        code, data, tag = READ_ACTIONS[rq.action](rq.cur, rq.schema, get_user(rq.cur, rq.schema, rq.token), rq.params, rq.seen_tags)
+        if code == 304: return rq.not_modified(tag)
+        return rq.resp(code, data, cache_headers(tag) if tag else None)
 
-    return err(404, 'Not found')
\ No newline at end of file
+    fn = ROUTES.get((rq.action, rq.method))
+    if not fn: return rq.err(404, 'Not found')
+    return fn(rq)
@@ -0,0 +1,21 @@
+import os
+import boto3
+
+# Работа с хранилищем файлов. boto3 импортируется сотни миллисекунд, поэтому модуль
+# подгружают только действия загрузки (import внутри функции), а не index.py при старте
+
+# Переопределяется для локального S3-совместимого стенда (MinIO и т.п.)
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'files')
+
+_client = None
+
+
+def client():
+    """Один клиент на контейнер — переиспользуется между вызовами"""
+    global _client
+    if _client is None:
+        _client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL,
+                               aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                               aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+    return _client
@@ -2,7 +2,7 @@ import json
 import os
 import re
 import bcrypt
-import psycopg2
+import db
 
 CORS = {
     'Access-Control-Allow-Origin': '*',
@@ -10,36 +10,13 @@ CORS = {
     'Access-Control-Allow-Headers': 'Content-Type',
     'Access-Control-Max-Age': '86400',
 }
-
-def log_error(cur, schema, source, message, details=None, ip=None, user_id=None):
-    safe_msg = message.replace("'", "''")
-    safe_det = (details or '').replace("'", "''")
-    cur.execute(
-        f"INSERT INTO {schema}.error_logs (level, source, message, details, ip, user_id) "
-        f"VALUES ('error', '{source}', '{safe_msg}', '{safe_det}', '{ip or ''}', {user_id or 'NULL'})"
-    )
-
-def check_rate_limit(cur, schema, key, limit=5, window_sec=60):
-    cur.execute(f"SELECT count, window_start FROM {schema}.rate_limits WHERE key = '{key}'")
-    row = cur.fetchone()
-    if row:
-        count, window_start = row
-        cur.execute(f"SELECT EXTRACT(EPOCH FROM (now() - '{window_start}'::timestamp))")
-        elapsed = cur.fetchone()[0]
-        if elapsed > window_sec:
-            cur.execute(f"UPDATE {schema}.rate_limits SET count = 1, window_start = now() WHERE key = '{key}'")
-            return False
-        if count >= limit:
-            return True
-        cur.execute(f"UPDATE {schema}.rate_limits SET count = count + 1 WHERE key = '{key}'")
-    else:
-        cur.execute(f"INSERT INTO {schema}.rate_limits (key, count, window_start) VALUES ('{key}', 1, now()) ON CONFLICT (key) DO UPDATE SET count = rate_limits.count + 1")
-    return False
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))  # совпадает с login, иначе там будет rehash
 
 def sanitize(value: str) -> str:
     value = re.sub(r'[<>"\']', '', value)
     return value.strip()
 
+@db.pooled
 def handler(event: dict, context) -> dict:
     """Регистрация нового пользователя в Frikords (bcrypt, защита от инъекций)"""
 
@@ -69,40 +46,36 @@ def handler(event: dict, context) -> dict:
         return {'statusCode': 400, 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Пароль должен быть не менее 8 символов'})}
 
-    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
     schema = os.environ['MAIN_DB_SCHEMA']
-    safe_user = username.replace("'", "''")
-    safe_email = email.replace("'", "''")
-    safe_game = favorite_game.replace("'", "''")
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = db.getconn()
     cur = conn.cursor()
 
-    if check_rate_limit(cur, schema, f'register:{ip}', limit=5, window_sec=300):
+    if db.rate_limit(cur, schema, f'register:{ip}', limit=5, window_sec=300):
         conn.commit()
         cur.close()
-        conn.close()
+        db.putconn(conn)
         return {'statusCode': 429, 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Слишком много попыток. Подожди 5 минут.'})}
 
-    cur.execute(f"SELECT id FROM {schema}.users WHERE email = '{safe_email}' OR username = '{safe_user}'")
+    cur.execute(f"SELECT id FROM {schema}.users WHERE email = %s OR username = %s", (email, username))
     if cur.fetchone():
         conn.commit()
         cur.close()
-        conn.close()
+        db.putconn(conn)
         return {'statusCode': 409, 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Пользователь с таким email или никнеймом уже существует'})}
 
-    # Хеш передаём через %s — bcrypt содержит спецсимволы, f-string сломает SQL
     cur.execute(
         f"INSERT INTO {schema}.users (username, email, password_hash, favorite_game) "
-        f"VALUES ('{safe_user}', '{safe_email}', %s, '{safe_game}') RETURNING id",
-        (password_hash,)
+        f"VALUES (%s, %s, %s, %s) RETURNING id",
+        (username, email, password_hash, favorite_game)
     )
     user_id = cur.fetchone()[0]
     conn.commit()
     cur.close()
-    conn.close()
+    db.putconn(conn)
 
     return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'success': True, 'user': {'id': user_id, 'username': username, 'email': email}})}
\ No newline at end of file
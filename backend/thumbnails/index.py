@@ -0,0 +1,173 @@
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from PIL import Image, ImageOps
+import db
+
+CH = {'Access-Control-Allow-Origin': '*'}
+BATCH_SIZE = int(os.environ.get('THUMB_BATCH', '16'))
+WORKERS = int(os.environ.get('THUMB_WORKERS', '4'))
+BUDGET_SEC = float(os.environ.get('THUMB_BUDGET_SEC', '20'))
+SLOW_RUN_MS = (BUDGET_SEC + 5) * 1000  # запуск по задумке длится секунды; медленный — вышедший за бюджет
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'files')
+AVATAR_SIZES = (64, 128)  # квадрат с обрезкой по центру, для kind='avatar'
+PREVIEW_WIDTHS = (320, 640)  # ширина превью в чате без увеличения, для kind='image'
+WEBP_QUALITY = 80
+CLAIM_TIMEOUT = '10 minutes'  # заявку упавшего запуска подхватит следующий
+
+
+class BadImage(Exception):
+    """Файл не декодируется — повторять бесполезно"""
+
+
+def s3_client():
+    return boto3.client('s3', endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+
+
+def cdn_url(key):
+    base = os.environ.get('CDN_BASE_URL') or f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket"
+    return f"{base}/{key}"
+
+
+def variant_key(key, name):
+    return f"{key.rsplit('.', 1)[0]}_{name}.webp"
+
+
+def encode(im):
+    buf = io.BytesIO()
+    im.save(buf, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return buf.getvalue()
+
+
+def render(data, kinds):
+    """Оригинал -> {имя варианта: байты WebP} для видов kinds (пусто — все). У GIF берётся первый кадр"""
+    with Image.open(io.BytesIO(data)) as src:
+        im = ImageOps.exif_transpose(src)
+        im = im.convert('RGBA' if im.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    out = {}
+    for size in AVATAR_SIZES if not kinds or 'avatar' in kinds else ():
+        out[f'a{size}'] = encode(ImageOps.fit(im, (size, size), Image.LANCZOS))
+    for width in PREVIEW_WIDTHS if not kinds or 'image' in kinds else ():
+        if im.width > width:
+            out[f'w{width}'] = encode(im.resize((width, round(im.height * width / im.width)), Image.LANCZOS))
+    return out
+
+
+def process(s3, key, kinds):
+    """Скачивает оригинал, делает варианты и кладёт их рядом. Возвращает {имя: url}"""
+    try:
+        data = s3.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()
+    except s3.exceptions.NoSuchKey as e:
+        raise BadImage(f'NoSuchKey: {key}') from e
+    try:
+        rendered = render(data, kinds)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        # render работает только с памятью: OSError здесь — битый или неизвестный формат
+        raise BadImage(f'{type(e).__name__}: {e}') from e
+    variants = {}
+    for name, body in rendered.items():
+        vkey = variant_key(key, name)
+        s3.put_object(Bucket=S3_BUCKET, Key=vkey, Body=body, ContentType='image/webp',
+                      CacheControl='public, max-age=31536000, immutable')
+        variants[name] = cdn_url(vkey)
+    return variants
+
+
+def claim(conn, schema):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"UPDATE {schema}.image_objects SET variants_claimed_at=now() WHERE hash IN ("
+            f"SELECT hash FROM {schema}.image_objects WHERE variants IS NULL "
+            f"AND (variants_claimed_at IS NULL OR variants_claimed_at < now() - interval '{CLAIM_TIMEOUT}') "
+            f"ORDER BY created_at LIMIT %s FOR UPDATE SKIP LOCKED) RETURNING hash, key, kinds",
+            (BATCH_SIZE,)
+        )
+        rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+
+def run_batch(conn, schema, pool, s3):
+    rows = claim(conn, schema)
+    if not rows:
+        return 0, 0
+
+    def safe(row):
+        try:
+            return row[0], row[2], process(s3, row[1], row[2]), None
+        except BadImage as e:
+            return row[0], row[2], {}, str(e)
+        except Exception as e:
+            # Сеть или хранилище: строку подхватит запуск после истечения заявки
+            return row[0], row[2], None, str(e)
+
+    # Pillow отпускает GIL на декодировании и ресайзе, сеть — тоже, поэтому потоки
+    results = list(pool.map(safe, rows))
+    with conn.cursor() as cur:
+        for sha, kinds, variants, error in results:
+            if error:
+                db.log_event('error', 'thumbnails', 'Variant render failed', details=f'{sha}: {error}'[:500])
+            if variants is None:
+                continue
+            # Пока рисовали, файлу мог добавиться вид — тогда строку подхватит следующий запуск
+            cur.execute(f"UPDATE {schema}.image_objects SET variants=%s WHERE hash=%s AND kinds=%s::varchar[]",
+                        (json.dumps(variants), sha, kinds))
+        done = [sha for sha, _, variants, _ in results if variants]
+        if done:
+            cur.execute(
+                f"UPDATE {schema}.messages SET rev=nextval('{schema}.messages_rev_seq') WHERE image_hash = ANY(%s) "
+                f"RETURNING CASE WHEN room_id IS NULL THEN 'ch:'||channel ELSE 'room:'||room_id END",
+                (done,)
+            )
+            topics = [r[0] for r in cur.fetchall()]
+            if topics:
+                db.notify(cur, schema, *topics)
+            cur.execute(f"SELECT 1 FROM {schema}.users WHERE avatar_hash = ANY(%s) LIMIT 1", (done,))
+            if cur.fetchone():
+                cur.execute(
+                    f"INSERT INTO {schema}.change_counters(topic,version) VALUES ('profiles',1) "
+                    f"ON CONFLICT(topic) DO UPDATE SET version=change_counters.version+1,updated_at=now()"
+                )
+        db.flush_logs(cur, schema, force=True)
+    conn.commit()
+    return len(rows), len(results) - len(done)
+
+
+@db.pooled(slow_ms=SLOW_RUN_MS)
+def handler(event: dict, context) -> dict:
+    """Уменьшенные WebP-копии загруженных изображений: аватарки 64/128, превью 320/640. Запуск по таймеру"""
+
+    # HTTP-вызов разрешён только с токеном; вызов по расписанию приходит без httpMethod
+    if event.get('httpMethod'):
+        if event.get('httpMethod') == 'OPTIONS':
+            return {'statusCode': 200, 'headers': {**CH, 'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                    'Access-Control-Allow-Headers': 'Content-Type, X-Maintenance-Token'}, 'body': ''}
+        expected = os.environ.get('MAINTENANCE_TOKEN', '')
+        got = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == 'x-maintenance-token'), '')
+        if not expected or got != expected:
+            return {'statusCode': 403, 'headers': CH, 'body': json.dumps({'error': 'Доступ запрещён'})}
+
+    schema = os.environ['MAIN_DB_SCHEMA']
+    deadline = time.monotonic() + BUDGET_SEC
+    s3 = s3_client()
+    processed, failed = 0, 0
+
+    conn = db.getconn()
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        while time.monotonic() < deadline:
+            n, f = run_batch(conn, schema, pool, s3)
+            processed += n
+            failed += f
+            print(f"thumbnails: batch of {n}, failed {f} (total {processed})")
+            if n < BATCH_SIZE:
+                break
+    db.putconn(conn)
+
+    return {'statusCode': 200, 'headers': CH,
+            'body': json.dumps({'ok': True, 'processed': processed, 'failed': failed})}
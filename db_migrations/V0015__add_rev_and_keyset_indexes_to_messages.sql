@@ -0,0 +1,11 @@
+-- Ревизия сообщения: растёт при создании, редактировании, удалении и реакциях.
+-- По ней клиент забирает изменения старых сообщений (since_rev), по id — новые (since_id)
+CREATE SEQUENCE IF NOT EXISTS t_p75051746_data_analytics_initi.messages_rev_seq;
+
+ALTER TABLE t_p75051746_data_analytics_initi.messages
+  ADD COLUMN IF NOT EXISTS rev BIGINT NOT NULL DEFAULT nextval('t_p75051746_data_analytics_initi.messages_rev_seq');
+
+CREATE INDEX IF NOT EXISTS messages_channel_id_idx ON t_p75051746_data_analytics_initi.messages (channel, id) WHERE room_id IS NULL;
+CREATE INDEX IF NOT EXISTS messages_room_id_idx ON t_p75051746_data_analytics_initi.messages (room_id, id) WHERE room_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS messages_channel_rev_idx ON t_p75051746_data_analytics_initi.messages (channel, rev) WHERE room_id IS NULL;
+CREATE INDEX IF NOT EXISTS messages_room_rev_idx ON t_p75051746_data_analytics_initi.messages (room_id, rev) WHERE room_id IS NOT NULL;
@@ -0,0 +1,7 @@
+-- Счётчики версий для условных GET (ETag): писатели увеличивают версию темы,
+-- читатели сравнивают её с If-None-Match и отвечают 304 без тяжёлых запросов
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.change_counters (
+  topic VARCHAR(64) NOT NULL PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
@@ -0,0 +1,17 @@
+-- Серверные отметки прочтения: scope = 'dm:<user_id>' | 'ch:<channel>' | 'room:<room_id>'
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.read_markers (
+  user_id INTEGER NOT NULL,
+  scope VARCHAR(64) NOT NULL,
+  last_read_id INTEGER NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP NOT NULL DEFAULT now(),
+  PRIMARY KEY (user_id, scope)
+);
+
+CREATE INDEX IF NOT EXISTS idx_dm_receiver_sender ON t_p75051746_data_analytics_initi.direct_messages (receiver_id, sender_id, id) WHERE is_removed = FALSE;
+
+-- Уже существующая переписка считается прочитанной (раньше отметки жили в localStorage)
+INSERT INTO t_p75051746_data_analytics_initi.read_markers (user_id, scope, last_read_id)
+SELECT receiver_id, 'dm:' || sender_id, MAX(id)
+FROM t_p75051746_data_analytics_initi.direct_messages
+GROUP BY receiver_id, sender_id
+ON CONFLICT (user_id, scope) DO NOTHING;
@@ -0,0 +1,4 @@
+-- Token bucket: tokens — остаток на момент window_start, allowed — вердикт последнего обращения
+ALTER TABLE t_p75051746_data_analytics_initi.rate_limits
+  ADD COLUMN IF NOT EXISTS tokens DOUBLE PRECISION,
+  ADD COLUMN IF NOT EXISTS allowed BOOLEAN NOT NULL DEFAULT TRUE;
@@ -0,0 +1,10 @@
+-- Узкая таблица присутствия: частые heartbeat-записи больше не переписывают широкую строку users.
+-- fillfactor оставляет место на странице для HOT-обновлений
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.presence (
+  user_id INTEGER NOT NULL PRIMARY KEY,
+  last_seen TIMESTAMP NOT NULL DEFAULT now()
+) WITH (fillfactor = 50);
+
+INSERT INTO t_p75051746_data_analytics_initi.presence (user_id, last_seen)
+SELECT id, last_seen FROM t_p75051746_data_analytics_initi.users WHERE last_seen IS NOT NULL
+ON CONFLICT (user_id) DO NOTHING;
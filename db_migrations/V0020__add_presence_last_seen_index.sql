@@ -0,0 +1,2 @@
+-- «Кто онлайн» — диапазонный скан по свежим heartbeat-ам вместо полного скана users
+CREATE INDEX IF NOT EXISTS presence_last_seen_idx ON t_p75051746_data_analytics_initi.presence (last_seen, user_id);
@@ -0,0 +1,14 @@
+-- Денормализованные счётчики реакций: чтение сообщений больше не агрегирует message_reactions
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.message_reaction_counts (
+  message_id INTEGER NOT NULL,
+  emoji VARCHAR(16) NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (message_id, emoji)
+);
+
+INSERT INTO t_p75051746_data_analytics_initi.message_reaction_counts (message_id, emoji, count)
+SELECT message_id, emoji, COUNT(*)
+FROM t_p75051746_data_analytics_initi.message_reactions
+WHERE is_active = TRUE
+GROUP BY message_id, emoji
+ON CONFLICT (message_id, emoji) DO NOTHING;
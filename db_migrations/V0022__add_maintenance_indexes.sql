@@ -0,0 +1,4 @@
+-- Индексы под пакетную очистку в функции maintenance
+CREATE INDEX IF NOT EXISTS sessions_created_idx ON t_p75051746_data_analytics_initi.sessions (created_at);
+CREATE INDEX IF NOT EXISTS rate_limits_window_idx ON t_p75051746_data_analytics_initi.rate_limits (window_start);
+CREATE INDEX IF NOT EXISTS messages_removed_created_idx ON t_p75051746_data_analytics_initi.messages (created_at) WHERE is_removed = TRUE;
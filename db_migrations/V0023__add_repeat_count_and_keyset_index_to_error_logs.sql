@@ -0,0 +1,8 @@
+-- Повторы одного события схлопываются в одну строку с repeat_count
+ALTER TABLE t_p75051746_data_analytics_initi.error_logs
+  ADD COLUMN IF NOT EXISTS repeat_count INTEGER NOT NULL DEFAULT 1;
+
+-- Постраничный просмотр логов курсором (created_at, id), с фильтром по level и без
+CREATE INDEX IF NOT EXISTS error_logs_level_created_idx ON t_p75051746_data_analytics_initi.error_logs (level, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS error_logs_created_id_idx ON t_p75051746_data_analytics_initi.error_logs (created_at DESC, id DESC);
+DROP INDEX IF EXISTS t_p75051746_data_analytics_initi.error_logs_created_idx;
@@ -0,0 +1,20 @@
+-- Снимок счётчиков для admin_stats, пересчитывается функцией maintenance по расписанию
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.stats_snapshot (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  data JSONB NOT NULL,
+  refreshed_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+INSERT INTO t_p75051746_data_analytics_initi.stats_snapshot (id, data, refreshed_at)
+SELECT 1, json_build_object(
+  'total_users', (SELECT COUNT(*) FROM t_p75051746_data_analytics_initi.users),
+  'banned_users', (SELECT COUNT(*) FROM t_p75051746_data_analytics_initi.users WHERE is_banned = TRUE),
+  'total_messages', (SELECT COUNT(*) FROM t_p75051746_data_analytics_initi.messages),
+  'total_rooms', (SELECT COUNT(*) FROM t_p75051746_data_analytics_initi.rooms),
+  'errors_24h', (SELECT COALESCE(SUM(repeat_count), 0) FROM t_p75051746_data_analytics_initi.error_logs WHERE created_at > now() - interval '24 hours'),
+  'new_users_24h', (SELECT COUNT(*) FROM t_p75051746_data_analytics_initi.users WHERE created_at > now() - interval '24 hours'),
+  'messages_24h', (SELECT COUNT(*) FROM t_p75051746_data_analytics_initi.messages WHERE created_at > now() - interval '24 hours'),
+  'db_size', (SELECT pg_size_pretty(COALESCE(SUM(pg_total_relation_size(quote_ident(schemaname) || '.' || quote_ident(tablename))), 0)) FROM pg_tables WHERE schemaname = 't_p75051746_data_analytics_initi'),
+  'db_bytes', (SELECT COALESCE(SUM(pg_total_relation_size(quote_ident(schemaname) || '.' || quote_ident(tablename))), 0) FROM pg_tables WHERE schemaname = 't_p75051746_data_analytics_initi')
+)::jsonb, now()
+ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,8 @@
+-- Поиск пользователей по подстроке в нике/email через триграммный индекс
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS users_search_trgm_idx ON t_p75051746_data_analytics_initi.users
+  USING gin ((lower(username) || ' ' || lower(email)) gin_trgm_ops);
+
+-- Постраничный список пользователей курсором (created_at, id)
+CREATE INDEX IF NOT EXISTS users_created_id_idx ON t_p75051746_data_analytics_initi.users (created_at DESC, id DESC);
@@ -0,0 +1,17 @@
+-- Ключ диалога — упорядоченная пара собеседников; история и дельты читаются по (user_lo, user_hi, id)
+ALTER TABLE t_p75051746_data_analytics_initi.direct_messages
+  ADD COLUMN IF NOT EXISTS user_lo INTEGER GENERATED ALWAYS AS (LEAST(sender_id, receiver_id)) STORED;
+ALTER TABLE t_p75051746_data_analytics_initi.direct_messages
+  ADD COLUMN IF NOT EXISTS user_hi INTEGER GENERATED ALWAYS AS (GREATEST(sender_id, receiver_id)) STORED;
+
+-- Ревизия личного сообщения, как messages.rev: по ней клиент забирает удаления (since_rev)
+CREATE SEQUENCE IF NOT EXISTS t_p75051746_data_analytics_initi.direct_messages_rev_seq;
+ALTER TABLE t_p75051746_data_analytics_initi.direct_messages
+  ADD COLUMN IF NOT EXISTS rev BIGINT NOT NULL DEFAULT nextval('t_p75051746_data_analytics_initi.direct_messages_rev_seq');
+
+CREATE INDEX IF NOT EXISTS direct_messages_conv_id_idx ON t_p75051746_data_analytics_initi.direct_messages (user_lo, user_hi, id);
+CREATE INDEX IF NOT EXISTS direct_messages_conv_rev_idx ON t_p75051746_data_analytics_initi.direct_messages (user_lo, user_hi, rev);
+
+-- Заменены индексом диалога и idx_dm_receiver_sender (непрочитанные)
+DROP INDEX IF EXISTS t_p75051746_data_analytics_initi.idx_dm_sender;
+DROP INDEX IF EXISTS t_p75051746_data_analytics_initi.idx_dm_receiver;
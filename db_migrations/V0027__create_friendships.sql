@@ -0,0 +1,17 @@
+-- Принятые дружбы парой (user_lo < user_hi): проверка «друзья ли» — поиск по первичному ключу
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.friendships (
+  user_lo INTEGER NOT NULL,
+  user_hi INTEGER NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT now(),
+  PRIMARY KEY (user_lo, user_hi),
+  CHECK (user_lo < user_hi)
+);
+
+CREATE INDEX IF NOT EXISTS friendships_hi_lo_idx ON t_p75051746_data_analytics_initi.friendships (user_hi, user_lo);
+
+INSERT INTO t_p75051746_data_analytics_initi.friendships (user_lo, user_hi, created_at)
+SELECT LEAST(from_user_id, to_user_id), GREATEST(from_user_id, to_user_id), MIN(created_at)
+FROM t_p75051746_data_analytics_initi.friend_requests
+WHERE status = 'accepted' AND from_user_id <> to_user_id
+GROUP BY 1, 2
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,12 @@
+-- Число участников хранится в комнате и обновляется при вступлении
+ALTER TABLE t_p75051746_data_analytics_initi.rooms
+  ADD COLUMN IF NOT EXISTS member_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE t_p75051746_data_analytics_initi.rooms r
+SET member_count = c.cnt
+FROM (SELECT room_id, COUNT(*) AS cnt FROM t_p75051746_data_analytics_initi.room_members GROUP BY room_id) c
+WHERE c.room_id = r.id;
+
+-- Лобби: последние публичные комнаты; «мои комнаты» — по участнику
+CREATE INDEX IF NOT EXISTS rooms_public_created_idx ON t_p75051746_data_analytics_initi.rooms (is_public, created_at DESC);
+CREATE INDEX IF NOT EXISTS room_members_user_room_idx ON t_p75051746_data_analytics_initi.room_members (user_id, room_id);
@@ -0,0 +1,12 @@
+-- Выданные presigned-загрузки: подтверждение принимается только по своей записи
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.uploads (
+  id BIGSERIAL PRIMARY KEY,
+  user_id INTEGER NOT NULL,
+  kind VARCHAR(16) NOT NULL,
+  key TEXT NOT NULL UNIQUE,
+  content_type VARCHAR(32) NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT now(),
+  confirmed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS uploads_user_created_idx ON t_p75051746_data_analytics_initi.uploads (user_id, created_at DESC);
@@ -0,0 +1,19 @@
+-- Изображения хранятся по sha256 содержимого: одинаковый файл загружается один раз.
+-- ref_count — число сообщений и аватарок, которые на него ссылаются; объекты с нулём
+-- удаляет backend/maintenance после паузы от touched_at
+CREATE TABLE IF NOT EXISTS t_p75051746_data_analytics_initi.image_objects (
+  hash CHAR(64) PRIMARY KEY,
+  key TEXT NOT NULL,
+  url TEXT NOT NULL UNIQUE,
+  content_type VARCHAR(32) NOT NULL,
+  size INTEGER NOT NULL,
+  ref_count INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMP NOT NULL DEFAULT now(),
+  touched_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS image_objects_gc_idx ON t_p75051746_data_analytics_initi.image_objects (touched_at) WHERE ref_count <= 0;
+
+ALTER TABLE t_p75051746_data_analytics_initi.messages ADD COLUMN IF NOT EXISTS image_hash CHAR(64);
+ALTER TABLE t_p75051746_data_analytics_initi.users ADD COLUMN IF NOT EXISTS avatar_hash CHAR(64);
+ALTER TABLE t_p75051746_data_analytics_initi.uploads ADD COLUMN IF NOT EXISTS sha256 CHAR(64);
@@ -0,0 +1,9 @@
+-- Уменьшенные WebP-копии изображения: {"a64": url, "a128": url, "w320": url, "w640": url}.
+-- NULL — ещё не готовы, их делает backend/thumbnails
+ALTER TABLE t_p75051746_data_analytics_initi.image_objects ADD COLUMN IF NOT EXISTS variants JSONB;
+ALTER TABLE t_p75051746_data_analytics_initi.image_objects ADD COLUMN IF NOT EXISTS variants_claimed_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS image_objects_pending_variants_idx ON t_p75051746_data_analytics_initi.image_objects (created_at) WHERE variants IS NULL;
+
+-- Готовые копии поднимают rev сообщений с этим изображением, чтобы клиенты получили их дельтой
+CREATE INDEX IF NOT EXISTS messages_image_hash_idx ON t_p75051746_data_analytics_initi.messages (image_hash) WHERE image_hash IS NOT NULL;
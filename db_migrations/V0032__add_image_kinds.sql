@@ -0,0 +1,9 @@
+-- Для чего загружено изображение: 'avatar' — нужны квадраты a64/a128, 'image' — превью w320/w640.
+-- backend/thumbnails делает только копии своих видов; пустой массив — все копии (старые записи)
+ALTER TABLE t_p75051746_data_analytics_initi.image_objects ADD COLUMN IF NOT EXISTS kinds VARCHAR(16)[] NOT NULL DEFAULT '{}';
+
+UPDATE t_p75051746_data_analytics_initi.image_objects o SET kinds = array_remove(ARRAY[
+  CASE WHEN EXISTS (SELECT 1 FROM t_p75051746_data_analytics_initi.users u WHERE u.avatar_hash = o.hash) THEN 'avatar' END,
+  CASE WHEN EXISTS (SELECT 1 FROM t_p75051746_data_analytics_initi.messages m WHERE m.image_hash = o.hash) THEN 'image' END
+]::VARCHAR(16)[], NULL)
+WHERE o.kinds = '{}';
@@ -0,0 +1,2 @@
+-- Очистка устаревших presigned-загрузок в backend/maintenance идёт по created_at
+CREATE INDEX IF NOT EXISTS uploads_created_idx ON t_p75051746_data_analytics_initi.uploads (created_at);
@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { X, AlertTriangle, Users, BarChart2, Ban, Search, MessageSquare, Trash2, Hash, Tag, Check } from "lucide-react";
 import { Button } from "@/components/ui/button";
 import { api } from "@/lib/api";
@@ -15,8 +15,12 @@ const CHANNELS = ["general", "meet", "memes", "teammates"];
 const AdminPanel = ({ token, onClose }: AdminPanelProps) => {
   const [tab, setTab] = useState<Tab>("stats");
   const [stats, setStats] = useState<Record<string, number> | null>(null);
+  const [statsAsOf, setStatsAsOf] = useState<string | null>(null);
   const [users, setUsers] = useState<Record<string, unknown>[]>([]);
+  const [usersCursor, setUsersCursor] = useState<{ before_ts: string; before_id: number } | null>(null);
+  const usersReqRef = useRef(0);
   const [logs, setLogs] = useState<Record<string, unknown>[]>([]);
+  const [logsCursor, setLogsCursor] = useState<{ before_ts: string; before_id: number } | null>(null);
   const [messages, setMessages] = useState<Record<string, unknown>[]>([]);
   const [search, setSearch] = useState("");
   const [loading, setLoading] = useState(false);
@@ -39,23 +43,45 @@ const AdminPanel = ({ token, onClose }: AdminPanelProps) => {
     setLoading(true);
     const data = await api.admin.stats(token);
     if (data.stats) setStats(data.stats as Record<string, number>);
+    setStatsAsOf((data.as_of as string) || null);
     setLoading(false);
   };
 
   const loadUsers = async (q = "") => {
+    const req = ++usersReqRef.current;
     setLoading(true);
     const data = await api.admin.users(token, q);
+    // Ответ на устаревший запрос (пользователь уже ввёл следующий символ) отбрасываем
+    if (req !== usersReqRef.current) return;
     if (data.users) setUsers(data.users as Record<string, unknown>[]);
+    setUsersCursor((data.next_cursor as { before_ts: string; before_id: number } | null) || null);
     setLoading(false);
   };
 
+  const loadMoreUsers = async () => {
+    if (!usersCursor) return;
+    const req = usersReqRef.current;
+    const data = await api.admin.users(token, search, 50, usersCursor);
+    if (req !== usersReqRef.current) return;
+    if (data.users) setUsers(prev => [...prev, ...(data.users as Record<string, unknown>[])]);
+    setUsersCursor((data.next_cursor as { before_ts: string; before_id: number } | null) || null);
+  };
+
   const loadLogs = async () => {
     setLoading(true);
     const data = await api.admin.logs(token, 100);
     if (data.logs) setLogs(data.logs as Record<string, unknown>[]);
+    setLogsCursor((data.next_cursor as { before_ts: string; before_id: number } | null) || null);
     setLoading(false);
   };
 
+  const loadMoreLogs = async () => {
+    if (!logsCursor) return;
+    const data = await api.admin.logs(token, 100, "", logsCursor);
+    if (data.logs) setLogs(prev => [...prev, ...(data.logs as Record<string, unknown>[])]);
+    setLogsCursor((data.next_cursor as { before_ts: string; before_id: number } | null) || null);
+  };
+
   const loadMessages = async (channel: string) => {
     setLoading(true);
     const data = await api.admin.messages(token, channel);
@@ -174,6 +200,11 @@ const AdminPanel = ({ token, onClose }: AdminPanelProps) => {
                   <div className="text-white text-2xl font-bold">{stats.db_size as string}</div>
                 </div>
               )}
+              {statsAsOf && (
+                <div className="col-span-2 sm:col-span-3 text-[#72767d] text-xs">
+                  Данные на {new Date(statsAsOf).toLocaleString("ru-RU")}
+                </div>
+              )}
             </div>
           )}
 
@@ -249,6 +280,11 @@ const AdminPanel = ({ token, onClose }: AdminPanelProps) => {
                   </div>
                 ))}
                 {users.length === 0 && <div className="text-[#72767d] text-sm text-center py-4">Нет пользователей</div>}
+                {usersCursor && (
+                  <Button variant="ghost" size="sm" className="w-full text-[#b9bbbe] hover:text-white hover:bg-[#40444b]" onClick={loadMoreUsers}>
+                    Загрузить ещё
+                  </Button>
+                )}
               </div>
             </div>
           )}
@@ -322,6 +358,7 @@ const AdminPanel = ({ token, onClose }: AdminPanelProps) => {
                   <div className="flex items-center gap-2 mb-0.5">
                     <span className={LEVEL_COLOR[log.level as string] || "text-[#b9bbbe]"}>[{(log.level as string).toUpperCase()}]</span>
                     <span className="text-[#8e9297]">{log.source as string}</span>
+                    {(log.repeat_count as number) > 1 && <span className="text-[#faa61a]">×{log.repeat_count as number}</span>}
                     <span className="text-[#72767d] ml-auto">{new Date(log.created_at as string).toLocaleString("ru-RU")}</span>
                   </div>
                   <div className="text-[#dcddde]">{log.message as string}</div>
@@ -329,6 +366,11 @@ const AdminPanel = ({ token, onClose }: AdminPanelProps) => {
                 </div>
               ))}
               {logs.length === 0 && <div className="text-[#72767d] text-sm text-center py-4">Логов нет</div>}
+              {logsCursor && (
+                <Button variant="ghost" size="sm" className="w-full text-[#b9bbbe] hover:text-white hover:bg-[#40444b]" onClick={loadMoreLogs}>
+                  Загрузить ещё
+                </Button>
+              )}
             </div>
           )}
         </div>
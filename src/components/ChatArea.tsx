@@ -9,10 +9,13 @@ import MessageItem from "@/components/chat/MessageItem";
 import OnlinePanel from "@/components/chat/OnlinePanel";
 import MessageInput from "@/components/chat/MessageInput";
 import {
-  Message, OnlineUser, ContextMenu,
-  CHANNEL_LABELS, sendNotification,
+  Message, MessageCursor, OnlineUser, ContextMenu,
+  CHANNEL_LABELS, sendNotification, mergeMessages, applyDelta,
 } from "@/components/chat/chatTypes";
 
+const LONG_POLL_SEC = 20;
+const POLL_RETRY_MS = 3000;
+
 interface ChatAreaProps {
   onSidebarOpen: () => void;
   onRegisterClick: () => void;
@@ -43,7 +46,11 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
   const [imagePreview, setImagePreview] = useState<string | null>(null);
   const [imageUrl, setImageUrl] = useState<string | null>(null);
   const [imageUploading, setImageUploading] = useState(false);
+  const [hasMore, setHasMore] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const lastMsgIdRef = useRef<number | null>(null);
+  const cursorRef = useRef<MessageCursor | null>(null);
+  const scopeRef = useRef(`${channel}:${roomId ?? ""}`);
   const bottomRef = useRef<HTMLDivElement>(null);
   const scrollContainerRef = useRef<HTMLDivElement>(null);
   const inputRef = useRef<HTMLInputElement>(null);
@@ -61,34 +68,58 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
     setNewMsgCount(0);
   };
 
-  const fetchMessages = useCallback(async () => {
-    const data = await api.messages.get(channel, token, roomId);
-    if (Array.isArray(data.messages)) {
-      const msgs = data.messages as Message[];
-      setMessages(prev => {
-        if (prev.length > 0 && msgs.length > prev.length) {
-          const newOnes = msgs.slice(prev.length);
-          const fromOthers = newOnes.filter(m => m.username !== user?.username).length;
-          if (fromOthers > 0 && !isAtBottom()) {
-            setNewMsgCount(c => c + fromOthers);
-          } else if (isAtBottom()) {
-            setTimeout(() => bottomRef.current?.scrollIntoView({ behavior: "smooth" }), 50);
-          }
-        } else if (prev.length === 0) {
-          setTimeout(() => bottomRef.current?.scrollIntoView({ behavior: "instant" as ScrollBehavior }), 50);
-        }
-        return msgs;
-      });
-      if (msgs.length > 0) {
-        const last = msgs[msgs.length - 1];
-        if (lastMsgIdRef.current !== null && last.id !== lastMsgIdRef.current && last.username !== user?.username) {
-          sendNotification(last.username, last.content);
+  // С курсором запрос — long-poll: сервер отвечает, как только в канале что-то изменилось, или через LONG_POLL_SEC
+  const fetchMessages = useCallback(async (): Promise<boolean> => {
+    const scope = scopeRef.current;
+    const cursor = cursorRef.current;
+    const data = await api.messages.get(channel, token, roomId, cursor ? { since_id: cursor.last_id, since_rev: cursor.rev, wait: LONG_POLL_SEC } : undefined);
+    if (scope !== scopeRef.current) return true;
+    if (!Array.isArray(data.messages)) return false;
+    const msgs = data.messages as Message[];
+    if (data.cursor) cursorRef.current = data.cursor as MessageCursor;
+    if (!cursor) {
+      setHasMore(Boolean(data.has_more));
+      setMessages(msgs);
+      setTimeout(() => bottomRef.current?.scrollIntoView({ behavior: "instant" as ScrollBehavior }), 50);
+    } else if (msgs.length > 0) {
+      const newOnes = msgs.filter(m => m.id > cursor.last_id);
+      setMessages(prev => applyDelta(prev, msgs));
+      if (newOnes.length > 0) {
+        const fromOthers = newOnes.filter(m => m.username !== user?.username).length;
+        if (fromOthers > 0 && !isAtBottom()) {
+          setNewMsgCount(c => c + fromOthers);
+        } else if (isAtBottom()) {
+          setTimeout(() => bottomRef.current?.scrollIntoView({ behavior: "smooth" }), 50);
         }
-        lastMsgIdRef.current = last.id;
       }
     }
+    const newest = msgs.filter(m => !cursor || m.id > cursor.last_id);
+    if (newest.length > 0) {
+      const last = newest[newest.length - 1];
+      if (lastMsgIdRef.current !== null && last.id !== lastMsgIdRef.current && last.username !== user?.username) {
+        sendNotification(last.username, last.content);
+      }
+      lastMsgIdRef.current = last.id;
+    }
+    // Все слоты long-poll на сервере заняты — обычный опрос с паузой
+    if (typeof data.retry_after === "number") await new Promise(r => setTimeout(r, (data.retry_after as number) * 1000));
+    return true;
   }, [channel, token, roomId, user]);
 
+  const loadOlder = async () => {
+    if (messages.length === 0 || loadingOlder) return;
+    const scope = scopeRef.current;
+    const el = scrollContainerRef.current;
+    const prevHeight = el?.scrollHeight ?? 0;
+    setLoadingOlder(true);
+    const data = await api.messages.get(channel, token, roomId, { before_id: messages[0].id });
+    setLoadingOlder(false);
+    if (scope !== scopeRef.current || !Array.isArray(data.messages)) return;
+    setHasMore(Boolean(data.has_more));
+    setMessages(prev => mergeMessages(prev, data.messages as Message[]));
+    setTimeout(() => { if (el) el.scrollTop += el.scrollHeight - prevHeight; }, 0);
+  };
+
   const fetchOnline = useCallback(async () => {
     const data = await api.online.get();
     if (typeof data.online === "number") setOnline(data.online);
@@ -97,14 +128,25 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
 
   useEffect(() => {
     setMessages([]);
+    setHasMore(false);
     setNewMsgCount(0);
     lastMsgIdRef.current = null;
+    cursorRef.current = null;
+    scopeRef.current = `${channel}:${roomId ?? ""}`;
     setReplyTo(null);
     setEditingMsg(null);
-    fetchMessages();
+    const scope = scopeRef.current;
+    // Следующий запрос уходит сразу после ответа; после ошибки — пауза
+    const poll = async () => {
+      while (scope === scopeRef.current) {
+        const ok = await fetchMessages();
+        if (!ok) await new Promise(r => setTimeout(r, POLL_RETRY_MS));
+      }
+    };
+    poll();
     fetchOnline();
-    const interval = setInterval(() => { fetchMessages(); fetchOnline(); }, 5000);
-    return () => clearInterval(interval);
+    const interval = setInterval(fetchOnline, 15000);
+    return () => { scopeRef.current = ""; clearInterval(interval); };
   }, [channel, roomId]);
 
   useEffect(() => {
@@ -114,7 +156,7 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
     return () => window.removeEventListener("click", close);
   }, []);
 
-  const compressImage = (file: File): Promise<string> => {
+  const compressImage = (file: File): Promise<Blob> => {
     return new Promise((resolve, reject) => {
       const img = new Image();
       const url = URL.createObjectURL(file);
@@ -130,7 +172,7 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
         canvas.width = width; canvas.height = height;
         const ctx = canvas.getContext("2d")!;
         ctx.drawImage(img, 0, 0, width, height);
-        resolve(canvas.toDataURL("image/jpeg", 0.82));
+        canvas.toBlob(blob => (blob ? resolve(blob) : reject(new Error("toBlob"))), "image/jpeg", 0.82);
       };
       img.onerror = reject;
       img.src = url;
@@ -141,9 +183,9 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
     if (!token) return;
     setImageUploading(true);
     try {
-      const dataUrl = await compressImage(file);
-      setImagePreview(dataUrl);
-      const res = await api.messages.uploadImage(token, dataUrl);
+      const blob = await compressImage(file);
+      setImagePreview(URL.createObjectURL(blob));
+      const res = await api.messages.uploadImage(token, blob);
       if (res.ok && res.image_url) {
         setImageUrl(res.image_url as string);
       } else {
@@ -211,8 +253,7 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
       if (m.id !== msgId) return m;
       const others = (m.reactions || []).filter(r => r.emoji !== emoji);
       const count = data.count as number;
-      const users = data.users as number[];
-      if (count > 0) return { ...m, reactions: [...others, { emoji, count, users }] };
+      if (count > 0) return { ...m, reactions: [...others, { emoji, count, reacted_by_me: Boolean(data.reacted_by_me) }] };
       return { ...m, reactions: others };
     }));
   };
@@ -294,6 +335,17 @@ const ChatArea = ({ onSidebarOpen, onRegisterClick, user, token, channel, roomId
         {/* Messages */}
         <div className="relative flex-1 min-h-0">
           <div ref={scrollContainerRef} className="h-full overflow-y-auto p-3 md:p-3 space-y-0.5 md:space-y-1">
+            {hasMore && (
+              <div className="flex justify-center py-2">
+                <button
+                  onClick={loadOlder}
+                  disabled={loadingOlder}
+                  className="text-xs text-[#b9bbbe] hover:text-white bg-[#2f3136] hover:bg-[#40444b] px-3 py-1.5 rounded-full transition-colors disabled:opacity-50"
+                >
+                  {loadingOlder ? "Загрузка…" : "Показать более ранние"}
+                </button>
+              </div>
+            )}
             {messages.length === 0 && (
               <div className="text-center text-[#72767d] text-sm py-12">
                 Сообщений пока нет. Будь первым!
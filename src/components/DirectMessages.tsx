@@ -2,20 +2,23 @@ import { useState, useEffect, useRef } from "react";
 import { User } from "@/hooks/useAuth";
 import DMChat from "@/components/dm/DMChat";
 import DMFriendsList from "@/components/dm/DMFriendsList";
+import { MessageCursor, applyDelta, mergeMessages } from "@/components/chat/chatTypes";
 import {
   Friend, FriendRequest, DMessage, DMContextMenu, Tab,
-  apiFriends, apiSendFriendReq, apiRespondReq, apiGetDM, apiSendDM,
-  authHeaders, BASE, getSeenMap, markSeen,
+  apiBatch, apiSendFriendReq, apiRespondReq, apiGetDM, apiSendDM,
+  authHeaders, BASE,
 } from "@/components/dm/dmTypes";
 
+const LONG_POLL_SEC = 20;
+const POLL_RETRY_MS = 3000;
+
 interface Props {
   user: User;
   token: string;
   onClose: () => void;
-  seenKey?: string;
 }
 
-export default function DirectMessages({ user, token, onClose, seenKey = "frikords_dm_seen" }: Props) {
+export default function DirectMessages({ user, token, onClose }: Props) {
   const [tab, setTab] = useState<Tab>("friends");
   const [friends, setFriends] = useState<Friend[]>([]);
   const [requests, setRequests] = useState<FriendRequest[]>([]);
@@ -27,11 +30,15 @@ export default function DirectMessages({ user, token, onClose, seenKey = "frikor
   const [msgText, setMsgText] = useState("");
   const [loading, setLoading] = useState(false);
   const [newMsgCount, setNewMsgCount] = useState(0);
+  const [hasMore, setHasMore] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const [dmContextMenu, setDmContextMenu] = useState<DMContextMenu | null>(null);
   const [profileUsername, setProfileUsername] = useState<string | null>(null);
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const scrollContainerRef = useRef<HTMLDivElement>(null);
-  const pollRef = useRef<ReturnType<typeof setInterval> | null>(null);
+  const cursorRef = useRef<MessageCursor | null>(null);
+  const lastIdRef = useRef<number | null>(null);
+  const activeIdRef = useRef<number | null>(null);
 
   const uid = (user as unknown as { id: number }).id;
 
@@ -46,68 +53,89 @@ export default function DirectMessages({ user, token, onClose, seenKey = "frikor
     setNewMsgCount(0);
   };
 
-  const loadFriends = async () => {
-    const data = await apiFriends("list", token);
-    if (!data.friends) return;
-    setFriends(data.friends);
-    const seen = getSeenMap(seenKey);
-    const counts: Record<number, number> = {};
-    await Promise.all(
-      data.friends.map(async (f: Friend) => {
-        const d = await apiGetDM(f.id, token);
-        if (!d.messages?.length) return;
-        const seenId = seen[String(f.id)] || 0;
-        counts[f.id] = d.messages.filter((m: DMessage) => m.id > seenId && m.username !== user.username).length;
-      })
-    );
-    setUnreadPerFriend(counts);
-  };
-
-  const loadRequests = async () => {
-    const data = await apiFriends("requests", token);
-    if (data.requests) setRequests(data.requests);
+  // Друзья, непрочитанные и (при открытии) заявки — одним вызовом action=batch
+  const loadFriends = async (withRequests = false) => {
+    const { results } = await apiBatch({
+      friends: { action: "friends", sub: "list" },
+      unread: { action: "unread_summary" },
+      ...(withRequests ? { requests: { action: "friends", sub: "requests" } } : {}),
+    }, token).catch(() => ({ results: null }));
+    if (!results) return;
+    if (results.friends?.status === 200) setFriends(results.friends.body.friends);
+    if (results.unread?.status === 200) {
+      const counts: Record<number, number> = {};
+      (results.unread.body.dm || []).forEach((d: { user_id: number; count: number }) => { counts[d.user_id] = d.count; });
+      setUnreadPerFriend(counts);
+    }
+    if (results.requests?.status === 200) setRequests(results.requests.body.requests);
   };
 
   useEffect(() => {
-    loadFriends();
-    loadRequests();
+    loadFriends(true);
   }, []);
 
   useEffect(() => {
     if (!activeFriend) return;
     setNewMsgCount(0);
-    const load = async (isFirst = false) => {
-      const data = await apiGetDM(activeFriend.id, token);
-      if (data.messages) {
-        setMessages(prev => {
-          const msgs: DMessage[] = data.messages;
-          if (!isFirst && msgs.length > prev.length) {
-            const newOnes = msgs.slice(prev.length).filter((m: DMessage) => m.username !== user.username);
-            if (newOnes.length > 0 && !isAtBottom()) {
-              setNewMsgCount(c => c + newOnes.length);
-            } else if (isAtBottom()) {
-              setTimeout(() => messagesEndRef.current?.scrollIntoView({ behavior: "smooth" }), 50);
-            }
-          }
-          return msgs;
-        });
-        if (data.messages.length > 0) {
-          markSeen(seenKey, activeFriend.id, data.messages[data.messages.length - 1].id);
-        }
-        if (isFirst) {
-          setTimeout(() => messagesEndRef.current?.scrollIntoView({ behavior: "instant" as ScrollBehavior }), 50);
-        }
+    setMessages([]);
+    setHasMore(false);
+    cursorRef.current = null;
+    activeIdRef.current = activeFriend.id;
+    let active = true;
+    // Первый запрос — последняя страница, дальше дельта по курсору через long-poll
+    const load = async (): Promise<boolean> => {
+      const cursor = cursorRef.current;
+      const data = await apiGetDM(activeFriend.id, token, cursor ? { since_id: cursor.last_id, since_rev: cursor.rev, wait: LONG_POLL_SEC } : undefined)
+        .catch(() => null);
+      if (!active) return true;
+      if (!data || !Array.isArray(data.messages)) return false;
+      const msgs: DMessage[] = data.messages;
+      if (data.cursor) cursorRef.current = data.cursor as MessageCursor;
+      if (!cursor) {
+        setHasMore(Boolean(data.has_more));
+        setMessages(msgs);
+        setTimeout(() => messagesEndRef.current?.scrollIntoView({ behavior: "instant" as ScrollBehavior }), 50);
+      } else if (msgs.length > 0) {
+        const fromOthers = msgs.filter(m => m.id > cursor.last_id && m.username !== user.username).length;
+        if (fromOthers > 0 && !isAtBottom()) setNewMsgCount(c => c + fromOthers);
+        setMessages(prev => applyDelta(prev, msgs));
+      }
+      // Все слоты long-poll на сервере заняты — обычный опрос с паузой
+      if (typeof data.retry_after === "number") await new Promise(r => setTimeout(r, data.retry_after * 1000));
+      return true;
+    };
+    const poll = async () => {
+      while (active) {
+        if (!(await load())) await new Promise(r => setTimeout(r, POLL_RETRY_MS));
       }
     };
-    load(true);
-    pollRef.current = setInterval(() => load(false), 3000);
-    return () => { if (pollRef.current) clearInterval(pollRef.current); };
+    poll();
+    return () => { active = false; };
   }, [activeFriend]);
 
+  // Прокрутка вниз только когда появилось новое последнее сообщение, а не при подгрузке истории
   useEffect(() => {
-    messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
+    const lastId = messages.length ? messages[messages.length - 1].id : null;
+    if (lastId !== null && lastId !== lastIdRef.current) {
+      messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
+    }
+    lastIdRef.current = lastId;
   }, [messages]);
 
+  const loadOlder = async () => {
+    if (!activeFriend || messages.length === 0 || loadingOlder) return;
+    const friendId = activeFriend.id;
+    const el = scrollContainerRef.current;
+    const prevHeight = el?.scrollHeight ?? 0;
+    setLoadingOlder(true);
+    const data = await apiGetDM(friendId, token, { before_id: messages[0].id });
+    setLoadingOlder(false);
+    if (friendId !== activeIdRef.current || !Array.isArray(data.messages)) return;
+    setHasMore(Boolean(data.has_more));
+    setMessages(prev => mergeMessages(prev, data.messages as DMessage[]));
+    setTimeout(() => { if (el) el.scrollTop += el.scrollHeight - prevHeight; }, 0);
+  };
+
   const handleAdd = async () => {
     if (!addUsername.trim()) return;
     setLoading(true);
@@ -162,6 +190,9 @@ export default function DirectMessages({ user, token, onClose, seenKey = "frikor
         messages={messages}
         msgText={msgText}
         newMsgCount={newMsgCount}
+        hasMore={hasMore}
+        loadingOlder={loadingOlder}
+        onLoadOlder={loadOlder}
         dmContextMenu={dmContextMenu}
         profileUsername={profileUsername}
         scrollContainerRef={scrollContainerRef}
@@ -1,12 +1,14 @@
 import { useEffect, useState } from "react";
 import Icon from "@/components/ui/icon";
 import { api } from "@/lib/api";
+import { ImageVariants } from "@/components/chat/chatTypes";
 
 interface ProfileData {
   id: number;
   username: string;
   favorite_game: string;
   avatar_url: string;
+  avatar_variants?: ImageVariants;
   created_at: string;
   message_count: number;
   badge?: string;
@@ -132,7 +134,7 @@ export default function ProfileModal({ username, onClose, onSendFriend, onOpenDM
           <div className="relative -mt-10 mb-3 w-fit">
             {showAvatar ? (
               <img
-                src={profile!.avatar_url}
+                src={profile!.avatar_variants?.a128 || profile!.avatar_url}
                 alt={profile!.username}
                 className="w-20 h-20 rounded-full border-4 border-[#36393f] object-cover"
                 onError={() => setAvatarError(true)}
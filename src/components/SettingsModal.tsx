@@ -32,22 +32,17 @@ export default function SettingsModal({ user, token, onClose, onUpdate }: Props)
     setError(null);
     setStatus(null);
     setAvatarError(false);
-    const reader = new FileReader();
-    reader.onload = async (ev) => {
-      const dataUrl = ev.target?.result as string;
-      setAvatarPreview(dataUrl);
-      const data = await api.profile.uploadAvatar(token, dataUrl);
-      setUploadingAvatar(false);
-      if (data.ok) {
-        const newUrl = data.avatar_url as string;
-        setAvatarPreview(newUrl);
-        onUpdate({ avatar_url: newUrl });
-        setStatus("Аватарка обновлена!");
-      } else {
-        setError((data.error as string) || "Ошибка загрузки");
-      }
-    };
-    reader.readAsDataURL(file);
+    setAvatarPreview(URL.createObjectURL(file));
+    const data = await api.profile.uploadAvatar(token, file);
+    setUploadingAvatar(false);
+    if (data.ok) {
+      const newUrl = data.avatar_url as string;
+      setAvatarPreview(newUrl);
+      onUpdate({ avatar_url: newUrl });
+      setStatus("Аватарка обновлена!");
+    } else {
+      setError((data.error as string) || "Ошибка загрузки");
+    }
   };
 
   const handleSave = async () => {
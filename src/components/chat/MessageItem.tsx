@@ -1,5 +1,5 @@
 import Icon from "@/components/ui/icon";
-import { Message, Reaction, EMOJI_LIST, avatarBg, formatTime } from "@/components/chat/chatTypes";
+import { Message, Reaction, EMOJI_LIST, avatarBg, avatarSrc, formatTime, previewSrc } from "@/components/chat/chatTypes";
 import { User } from "@/hooks/useAuth";
 
 interface Props {
@@ -40,7 +40,7 @@ export default function MessageItem({
         onClick={() => onProfileClick(msg.username)}
       >
         {msg.avatar_url
-          ? <img src={msg.avatar_url} alt={msg.username} className="w-full h-full object-cover" />
+          ? <img {...avatarSrc(msg.avatar_url, msg.avatar_variants)} alt={msg.username} className="w-full h-full object-cover" />
           : <span className="text-white text-sm font-semibold">{msg.username[0].toUpperCase()}</span>
         }
       </div>
@@ -73,7 +73,7 @@ export default function MessageItem({
               <div className="mt-1">
                 <a href={msg.image_url} target="_blank" rel="noopener noreferrer">
                   <img
-                    src={msg.image_url}
+                    {...previewSrc(msg.image_url, msg.image_variants)}
                     alt="фото"
                     className="max-w-xs max-h-72 rounded-lg object-contain cursor-pointer hover:opacity-90 transition-opacity border border-[#40444b]"
                     loading="lazy"
@@ -87,7 +87,7 @@ export default function MessageItem({
         {!msg.is_removed && (msg.reactions || []).length > 0 && (
           <div className="flex flex-wrap gap-1 mt-1">
             {(msg.reactions || []).map((r: Reaction) => {
-              const iMine = user && uid !== undefined && r.users.includes(uid);
+              const iMine = user && r.reacted_by_me;
               return (
                 <button
                   key={r.emoji}
@@ -1,7 +1,22 @@
 export interface Reaction {
   emoji: string;
   count: number;
-  users: number[];
+  reacted_by_me: boolean;
+}
+
+// WebP-копии из backend/thumbnails: a64/a128 — квадрат для аватарки, w320/w640 — превью по ширине.
+// Пока копий нет (или картинка старая), используется оригинал
+export type ImageVariants = Partial<Record<"a64" | "a128" | "w320" | "w640", string>>;
+
+export function avatarSrc(url: string, v?: ImageVariants) {
+  if (!v?.a64) return { src: url };
+  return { src: v.a64, srcSet: v.a128 ? `${v.a64} 1x, ${v.a128} 2x` : undefined };
+}
+
+export function previewSrc(url: string, v?: ImageVariants) {
+  const set = [v?.w320 && `${v.w320} 320w`, v?.w640 && `${v.w640} 640w`].filter(Boolean);
+  if (set.length === 0) return { src: url };
+  return { src: v?.w640 || v?.w320 || url, srcSet: set.join(", "), sizes: "(max-width: 640px) 80vw, 320px" };
 }
 
 export interface Message {
@@ -13,6 +28,8 @@ export interface Message {
   avatar_url?: string;
   badge?: string;
   image_url?: string;
+  image_variants?: ImageVariants;
+  avatar_variants?: ImageVariants;
   is_removed?: boolean;
   author_id?: number;
   edited?: boolean;
@@ -20,6 +37,28 @@ export interface Message {
   replyTo?: { id: number; username: string; content: string };
 }
 
+export interface MessageCursor {
+  last_id: number;
+  rev: number;
+}
+
+export function mergeMessages<T extends { id: number }>(prev: T[], delta: T[]): T[] {
+  if (delta.length === 0) return prev;
+  const byId = new Map(delta.map(m => [m.id, m]));
+  const known = new Set(prev.map(m => m.id));
+  const merged = prev.map(m => byId.get(m.id) ?? m);
+  const added = delta.filter(m => !known.has(m.id));
+  return added.length > 0 ? [...merged, ...added].sort((a, b) => a.id - b.id) : merged;
+}
+
+// Дельта long-poll: правки старых сообщений за пределами загруженной истории не вставляются —
+// иначе loadOlder пойдёт от чужого id и пропустит всё между ними
+export function applyDelta<T extends { id: number }>(prev: T[], delta: T[]): T[] {
+  if (prev.length === 0) return mergeMessages(prev, delta);
+  const oldest = prev[0].id;
+  return mergeMessages(prev, delta.filter(m => m.id >= oldest));
+}
+
 export interface OnlineUser {
   username: string;
   favorite_game: string;
@@ -12,6 +12,9 @@ interface Props {
   messages: DMessage[];
   msgText: string;
   newMsgCount: number;
+  hasMore: boolean;
+  loadingOlder: boolean;
+  onLoadOlder: () => void;
   dmContextMenu: DMContextMenu | null;
   profileUsername: string | null;
   scrollContainerRef: RefObject<HTMLDivElement>;
@@ -29,7 +32,7 @@ interface Props {
 }
 
 export default function DMChat({
-  user, token, uid, activeFriend, messages, msgText, newMsgCount,
+  user, token, uid, activeFriend, messages, msgText, newMsgCount, hasMore, loadingOlder, onLoadOlder,
   dmContextMenu, profileUsername, scrollContainerRef, messagesEndRef,
   onBack, onClose, onMsgTextChange, onSend, onKey, onScrollToBottom,
   onSetContextMenu, onSetProfileUsername, onDeleteDM, setMessages,
@@ -104,6 +107,17 @@ export default function DMChat({
         {/* Messages */}
         <div className="relative flex-1 min-h-0">
           <div ref={scrollContainerRef} className="h-full overflow-y-auto px-4 py-3 flex flex-col gap-2">
+            {hasMore && (
+              <div className="flex justify-center py-1">
+                <button
+                  onClick={onLoadOlder}
+                  disabled={loadingOlder}
+                  className="text-xs text-[#b9bbbe] hover:text-white bg-[#2f3136] hover:bg-[#40444b] px-3 py-1.5 rounded-full transition-colors disabled:opacity-50"
+                >
+                  {loadingOlder ? "Загрузка…" : "Показать более ранние"}
+                </button>
+              </div>
+            )}
             {messages.length === 0 && (
               <div className="text-center text-[#72767d] text-sm mt-8">
                 Начни переписку с {activeFriend.username}
@@ -4,11 +4,6 @@ export function authHeaders(token: string) {
   return { "Content-Type": "application/json", "X-Authorization": `Bearer ${token}` };
 }
 
-export async function apiFriends(sub: string, token: string) {
-  const res = await fetch(`${BASE}?action=friends&sub=${sub}`, { headers: authHeaders(token) });
-  return res.json();
-}
-
 export async function apiSendFriendReq(username: string, token: string) {
   const res = await fetch(`${BASE}?action=friends`, {
     method: "POST",
@@ -27,8 +22,27 @@ export async function apiRespondReq(request_id: number, accept: boolean, token:
   return res.json();
 }
 
-export async function apiGetDM(withId: number, token: string) {
-  const res = await fetch(`${BASE}?action=dm&with=${withId}`, { headers: authHeaders(token) });
+export async function apiGetDM(
+  withId: number,
+  token: string,
+  page?: { since_id?: number; since_rev?: number; before_id?: number; wait?: number },
+) {
+  const qs = new URLSearchParams({ action: "dm", with: String(withId) });
+  if (page?.since_id) qs.set("since_id", String(page.since_id));
+  if (page?.since_rev !== undefined) qs.set("since_rev", String(page.since_rev));
+  if (page?.before_id) qs.set("before_id", String(page.before_id));
+  if (page?.wait) qs.set("wait", String(page.wait));
+  const res = await fetch(`${BASE}?${qs}`, { headers: authHeaders(token) });
+  return res.json();
+}
+
+// Несколько чтений за один запрос: { ключ: { action, ...параметры } } -> { results: { ключ: { status, body, etag? } } }
+export async function apiBatch(requests: Record<string, Record<string, string>>, token: string) {
+  const res = await fetch(`${BASE}?action=batch`, {
+    method: "POST",
+    headers: authHeaders(token),
+    body: JSON.stringify({ requests }),
+  });
   return res.json();
 }
 
@@ -63,13 +77,3 @@ export function avatarColor(name: string) {
   for (let i = 0; i < name.length; i++) h = (h * 31 + name.charCodeAt(i)) & 0xffffffff;
   return colors[Math.abs(h) % colors.length];
 }
-
-export function getSeenMap(key: string): Record<string, number> {
-  try { return JSON.parse(localStorage.getItem(key) || "{}"); } catch { return {}; }
-}
-
-export function markSeen(key: string, friendId: number, lastId: number) {
-  const m = getSeenMap(key);
-  m[String(friendId)] = lastId;
-  localStorage.setItem(key, JSON.stringify(m));
-}
\ No newline at end of file
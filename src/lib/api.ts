@@ -12,7 +12,8 @@ async function req(action: string, method: string, token?: string | null, body?:
   const params = new URLSearchParams({ action, ...extra });
   try {
     const controller = new AbortController();
-    const timeout = setTimeout(() => controller.abort(), 8000);
+    // Long-poll держит ответ до wait секунд — таймаут с запасом
+    const timeout = setTimeout(() => controller.abort(), extra?.wait ? (Number(extra.wait) + 10) * 1000 : 8000);
     const res = await fetch(`${BASE}?${params}`, {
       method,
       headers: headers(method, token),
@@ -30,14 +31,43 @@ async function req(action: string, method: string, token?: string | null, body?:
   }
 }
 
+async function sha256Hex(file: Blob): Promise<string> {
+  const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, "0")).join("");
+}
+
+// Файл уходит прямо в хранилище по presigned POST, функция только выдаёт политику и подтверждает загрузку.
+// Если файл с таким sha256 уже есть, upload_url сразу возвращает его адрес
+async function uploadDirect(token: string, kind: "image" | "avatar", file: Blob): Promise<Record<string, unknown>> {
+  const sha256 = await sha256Hex(file);
+  const ticket = await req("upload_url", "POST", token, { kind, content_type: file.type, size: file.size, sha256 });
+  if (ticket.ok || !ticket.url) return ticket;
+  const form = new FormData();
+  Object.entries(ticket.fields as Record<string, string>).forEach(([k, v]) => form.append(k, v));
+  form.append("file", file);
+  try {
+    const res = await fetch(ticket.url as string, { method: "POST", body: form });
+    if (!res.ok) return { error: "Не удалось загрузить файл" };
+  } catch {
+    return { error: "Нет соединения с хранилищем" };
+  }
+  return req("confirm_upload", "POST", token, { upload_id: ticket.upload_id });
+}
+
 export const api = {
   messages: {
-    get: (channel: string, token?: string | null, room_id?: number) =>
-      req("messages", "GET", token, undefined, room_id ? { channel, room_id: String(room_id) } : { channel }),
+    get: (channel: string, token?: string | null, room_id?: number, page?: { since_id?: number; since_rev?: number; before_id?: number; wait?: number }) => {
+      const extra: Record<string, string> = { channel };
+      if (room_id) extra.room_id = String(room_id);
+      if (page?.since_id !== undefined) extra.since_id = String(page.since_id);
+      if (page?.since_rev !== undefined) extra.since_rev = String(page.since_rev);
+      if (page?.before_id !== undefined) extra.before_id = String(page.before_id);
+      if (page?.wait) extra.wait = String(page.wait);
+      return req("messages", "GET", token, undefined, extra);
+    },
     send: (token: string, content: string, channel: string, room_id?: number, image_url?: string) =>
       req("messages", "POST", token, { content, channel, ...(room_id ? { room_id } : {}), ...(image_url ? { image_url } : {}) }),
-    uploadImage: (token: string, image: string) =>
-      req("upload_image", "POST", token, { image }),
+    uploadImage: (token: string, image: Blob) => uploadDirect(token, "image", image),
     remove: (token: string, msg_id: number) =>
       req("delete_msg", "POST", token, { msg_id }),
     edit: (token: string, msg_id: number, content: string) =>
@@ -51,8 +81,7 @@ export const api = {
   },
   profile: {
     get: (username: string) => req("profile", "GET", null, undefined, { username }),
-    uploadAvatar: (token: string, image: string) =>
-      req("upload_avatar", "POST", token, { image }),
+    uploadAvatar: (token: string, image: Blob) => uploadDirect(token, "avatar", image),
   },
   rooms: {
     list: (token?: string | null) => req("rooms", "GET", token),
@@ -76,6 +105,9 @@ export const api = {
   online: {
     get: () => req("online", "GET"),
   },
+  unread: {
+    summary: (token: string) => req("unread_summary", "GET", token),
+  },
   settings: {
     get: (token: string) => req("settings", "GET", token),
     save: (token: string, data: { username?: string; favorite_game?: string }) =>
@@ -91,14 +123,22 @@ export const api = {
   },
   admin: {
     stats: (token: string) => req("admin_stats", "GET", token),
-    logs: (token: string, limit = 50, level = "") => {
+    logs: (token: string, limit = 50, level = "", cursor?: { before_ts: string; before_id: number } | null) => {
       const extra: Record<string, string> = { limit: String(limit) };
       if (level) extra.level = level;
+      if (cursor) {
+        extra.before_ts = cursor.before_ts;
+        extra.before_id = String(cursor.before_id);
+      }
       return req("admin_logs", "GET", token, undefined, extra);
     },
-    users: (token: string, q = "", limit = 50, offset = 0) => {
-      const extra: Record<string, string> = { limit: String(limit), offset: String(offset) };
+    users: (token: string, q = "", limit = 50, cursor?: { before_ts: string; before_id: number } | null) => {
+      const extra: Record<string, string> = { limit: String(limit) };
       if (q) extra.q = q;
+      if (cursor) {
+        extra.before_ts = cursor.before_ts;
+        extra.before_id = String(cursor.before_id);
+      }
       return req("admin_users", "GET", token, undefined, extra);
     },
     ban: (token: string, user_id: number, ban: boolean) =>
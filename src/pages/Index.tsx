@@ -12,13 +12,9 @@ import ProfileModal from "@/components/ProfileModal";
 import { useAuth } from "@/hooks/useAuth";
 import { User } from "@/hooks/useAuth";
 import Icon from "@/components/ui/icon";
+import { api } from "@/lib/api";
 
-const BASE = "https://functions.poehali.dev/b1a16ec3-c9d7-4e46-bb90-e30137e5c534";
-const SEEN_KEY = "frikords_dm_seen";
-
-function getSeenMap(): Record<string, number> {
-  try { return JSON.parse(localStorage.getItem(SEEN_KEY) || "{}"); } catch { return {}; }
-}
+interface UnreadDM { user_id: number; username: string; count: number; last_id: number; }
 
 function requestNotifPermission() {
   if ("Notification" in window && Notification.permission === "default") {
@@ -46,34 +42,21 @@ const Index = () => {
   const [activeRoomId, setActiveRoomId] = useState<number | undefined>();
   const [activeRoomName, setActiveRoomName] = useState<string | undefined>();
   const pollRef = useRef<ReturnType<typeof setInterval> | null>(null);
+  const lastUnreadRef = useRef<Record<number, number> | null>(null);
 
   const checkUnread = useCallback(async () => {
     if (!user || !token) return;
-    try {
-      const res = await fetch(`${BASE}?action=friends&sub=list`, {
-        headers: { "X-Authorization": `Bearer ${token}` },
+    const data = await api.unread.summary(token);
+    if (!Array.isArray(data.dm)) return;
+    const dms = data.dm as UnreadDM[];
+    const prev = lastUnreadRef.current;
+    if (prev) {
+      dms.filter(d => d.last_id > (prev[d.user_id] || 0)).forEach(d => {
+        sendNotif(`💬 ${d.username}`, `Новых сообщений: ${d.count}`);
       });
-      const data = await res.json();
-      if (!data.friends) return;
-      const seen = getSeenMap();
-      let total = 0;
-      await Promise.all(
-        data.friends.map(async (f: { id: number; username: string }) => {
-          const r = await fetch(`${BASE}?action=dm&with=${f.id}`, {
-            headers: { "X-Authorization": `Bearer ${token}` },
-          });
-          const d = await r.json();
-          if (!d.messages?.length) return;
-          const seenId: number = seen[String(f.id)] || 0;
-          const newMsgs = d.messages.filter((m: { id: number; username: string }) => m.id > seenId && m.username !== user.username);
-          if (newMsgs.length > 0 && seenId > 0) {
-            sendNotif(`💬 ${f.username}`, newMsgs[newMsgs.length - 1].content.slice(0, 80));
-          }
-          total += newMsgs.length;
-        })
-      );
-      setUnreadCount(total);
-    } catch (_e) { /* ignore */ }
+    }
+    lastUnreadRef.current = Object.fromEntries(dms.map(d => [d.user_id, d.last_id]));
+    setUnreadCount(dms.reduce((sum, d) => sum + d.count, 0));
   }, [user, token]);
 
   useEffect(() => {
@@ -111,7 +94,7 @@ const Index = () => {
         <LoginModal onClose={() => setShowLoginModal(false)} onSuccess={login} onRegisterClick={() => setShowRegModal(true)} />
       )}
       {showAdmin && token && <AdminPanel token={token} onClose={() => setShowAdmin(false)} />}
-      {showDM && user && token && <DirectMessages user={user} token={token} onClose={handleCloseDM} seenKey={SEEN_KEY} />}
+      {showDM && user && token && <DirectMessages user={user} token={token} onClose={handleCloseDM} />}
       {showSettings && user && token && (
         <SettingsModal
           user={user}